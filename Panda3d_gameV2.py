@@ -1,7 +1,16 @@
+import time
+# Taken before anything else is imported, so the startup time reported includes loading Panda3D
+STARTED = time.perf_counter()
 from panda3d.core import Point3, Vec3
 """
 
-This module defines a 3D Game of Life using Panda3D and PyQt6 for GUI elements.
+This module defines a 3D Game of Life using Panda3D, with PyQt6 file dialogs when it is installed.
+PyQt6 is only imported when a file dialog is first opened, so it costs nothing at startup, and a
+DirectGui file picker takes its place when it is not installed. The time from starting to the
+first frame drawn is printed and shown; run with --startup to exit after the first frame, for
+timing the startup from a script. The Perf button shows the time per step and per scene update,
+the live cells, scene nodes and frame rate; run with --trace PATH to write the time of every step,
+scene update and frame to a trace file that chrome://tracing or Perfetto opens.
 Classes:
     GameOfLife3D: Main class for the 3D Game of Life, inheriting from ShowBase.
 
@@ -11,32 +20,40 @@ from direct.showbase.ShowBase import ShowBase
 from direct.task import Task
 
 from direct.gui.DirectGui import *
-from random import randrange
 from panda3d.core import TextNode
 from panda3d.core import ClockObject
 
-from PyQt6.QtWidgets import QApplication, QFileDialog
 import sys
 import math 
-import random
-import sys
-import json
 import os
 from panda3d.core import WindowProperties
 
+from life3d import ENGINES, Recorder, Recording, read_pattern, save_pattern
+from life3d.cycles import describe
+from life3d.filepicker import FilePicker
+from life3d.library import PatternLibrary, default_cache_path
+from life3d.profiler import profiler
+from life3d.render import MESHES, LodMesh
+from life3d.rules import Rule
+from life3d.scheduler import StepScheduler
+from life3d.worker import CYCLE_ACTIONS, SimulationWorker
+
 class GameOfLife3D(ShowBase):
     """
-    This module defines a 3D Game of Life using Panda3D and PyQt6 for GUI elements.
+    This module defines a 3D Game of Life using Panda3D, with PyQt6 file dialogs when it is installed.
     Classes:
     GameOfLife3D: Main class for the 3D Game of Life, inheriting from ShowBase.
     A 3D implementation of Conway's Game of Life using Panda3D and PyQt.
     Attributes:
-        qt_app (QApplication): The PyQt application instance.
+        qt_app (QApplication): The PyQt application instance, created when a file dialog is first opened.
+        filepicker (FilePicker): The DirectGui file picker shown when PyQt6 is not installed, or None.
+        startup_time (float): The seconds from starting to the first frame drawn.
         grid_size (int): The size of the grid.
         radius (int): The radius of the grid.
         cube_size (float): The size of each cube in the grid.
-        time_counter (int): A counter to keep track of time.
-        update_rate (int): The rate at which the grid updates.
+        time_counter (int): A counter of the frames drawn.
+        update_rate (int): The number of generations per second while running.
+        scheduler (StepScheduler): Works out how many generations to step each frame from wall clock time.
         cursorX (int): The X coordinate of the cursor.
         cursorY (int): The Y coordinate of the cursor.
         cursorZ (int): The Z coordinate of the cursor.
@@ -46,12 +63,23 @@ class GameOfLife3D(ShowBase):
         birthrate (int): The birth rate for the game.
         deathrate (int): The death rate for the game.
         aliverate (int): The alive rate for the game.
+        rulestring (str): A B/S rulestring used instead of the rates, or empty to use the rates.
         population_rate (int): The population rate for the game.
         sliderscale (int): The scale of the sliders.
         tilt (int): The tilt of the camera.
-        grid (dict): The grid representing the game state.
-        birthgrid (dict): The grid representing the birth state.
-        cubes (list): A list of cubes in the grid.
+        engine_name (str): The name of the engine in life3d.ENGINES.
+        worker (SimulationWorker): The background thread that owns and steps the engine.
+        recording (bool): Whether every generation is being recorded to a file.
+        replay (Recording): The recording being played back instead of the engine, or None.
+        replay_position (int): The frame of the recording shown.
+        playback (StepScheduler): Paces the frames while a recording plays.
+        library (PatternLibrary): The preset patterns, from this directory and LIFE3D_PATTERNS.
+        drawn_version (int): The version of the worker snapshot drawn by the cubes.
+        drawn_cells (ndarray): The coordinates of the worker snapshot drawn by the cubes.
+        drawn_cycle (Cycle): The cycle shown in the text display, or None.
+        drawn_error (int): The version of the snapshot whose error was last shown, or None.
+        drawn_position (int): The frame of the recording drawn by the cubes, or None.
+        cellmesh (LodMesh): The cubes of the live cells near the camera and the density voxels of those further away.
         runlife (bool): A flag to indicate if the game is running.
         startbutton (DirectButton): The start button.
         stepbutton (DirectButton): The step button.
@@ -72,6 +100,14 @@ class GameOfLife3D(ShowBase):
         optionAlivebutton (DirectOptionMenu): The alive options menu.
         optionRatebutton (DirectOptionMenu): The population rate options menu.
         optionSizebutton (DirectOptionMenu): The size options menu.
+        optionEnginebutton (DirectOptionMenu): The engine options menu.
+        optionSpeedbutton (DirectOptionMenu): The generations per second options menu.
+        optionCyclebutton (DirectOptionMenu): The menu of what to do when the pattern settles or repeats.
+        perfbutton (DirectButton): The button showing and hiding the performance display.
+        optionMeshbutton (DirectOptionMenu): The menu of how the cells near the camera are drawn.
+        perfDisplay (OnscreenText): The performance display.
+        show_perf (bool): Whether the performance display is shown.
+        ruleEntry (DirectEntry): The rulestring entry, showing the rule in use.
         TiltLabel (dict): A dictionary of tilt labels.
         taskMgr (TaskManager): The task manager for updating the game.
         cam (Camera): The camera for viewing the game.
@@ -80,7 +116,7 @@ class GameOfLife3D(ShowBase):
         __init__(): Initializes the GameOfLife3D instance.
         buttonOptionClicked(value): Handles the event when an option button is clicked.
         ButtonNothingClicked(): Handles the event when a button with no action is clicked.
-        find_lif_files(directory): Finds .lif files in the specified directory.
+        load_pattern(gridlist, griditems): Applies the settings of a pattern and loads its cells.
         ButtonRotateClicked(): Handles the event when the rotate button is clicked.
         calculate_circle(place): Calculates the x and y coordinates of points on a circle.
         ButtonSaveClicked(): Handles the event when the save button is clicked.
@@ -98,20 +134,43 @@ class GameOfLife3D(ShowBase):
         buttonDeath(value): Handles the event when the death button is clicked.
         buttonAlive(value): Handles the event when the alive button is clicked.
         buttonSize(value): Handles the event when the size button is clicked.
+        buttonEngine(value): Handles the event when the engine button is clicked.
+        buttonSpeed(value): Handles the event when the speed button is clicked.
+        buttonCycle(value): Handles the event when the cycle button is clicked.
+        buttonMesh(value): Handles the event when the mesh button is clicked.
+        enterRule(text): Handles the event when a rulestring is entered.
         buttonStep(): Handles the event when the step button is clicked.
         buttonReset(): Handles the event when the reset button is clicked.
         buttonClicked(): Handles the event when the start/stop button is clicked.
-        ClearGrid(): Clears the grid.
-        initialize_grid(): Initializes the grid.
+        buttonRecord(): Handles the event when the record button is clicked.
+        buttonReplay(): Handles the event when the replay button is clicked.
+        sliderReplay(): Handles the event when the replay slider is moved.
+        openReplay(file_path): Plays back a recording instead of the engine.
+        closeReplay(): Goes back from a recording to the engine.
+        next_frame(): Moves the replay on by one frame.
+        show_frame(): Draws the frame of the recording at the replay position.
+        current_rule(): Returns the rule chosen in the gui.
+        sync_engine(): Copies the grid size and rules to the engine.
         create_cubes(): Creates the cubes in the grid.
+        move_cursor(): Moves the cursor cube to the cursor position.
         step(): Advances the game by one step.
-        update(Task): Updates the game state.
-        count_alive_neighbors(x, y, z, mature=False): Counts the alive neighbors of a cell.
+        update(Task): Updates the game state, timed by the profiler.
+        update_frame(): Draws the newest generation or replay frame.
+        show_error(snapshot): Shows an error from the worker and resets the Start and Record buttons.
+        buttonPerf(): Handles the event when the perf button is clicked.
+        update_perf(): Refreshes the performance display.
+        finish_trace(): Finishes the trace file when the application exits.
         update_cubes(): Updates the cubes in the grid.
         adjust_camera(): Adjusts the camera position.
-        openFileDialog(): Opens a file dialog to load a .lif file.
-        convert_string_to_grid(grid_string): Converts a grid string to coordinates.
-        saveFileDialog(): Opens a file dialog to save a .lif file.
+        first_frame(Task): Reports the startup time once the first frame is drawn.
+        file_dialog(): Returns the PyQt6 QFileDialog, importing it on first use, or None without PyQt6.
+        choose_file(title, filters, save, callback): Asks for a file and calls callback with its path.
+        openFileDialog(): Opens a file dialog to load a .lif, .lifb or .lifr file.
+        saveFileDialog(): Opens a file dialog to save a .lif or .lifb file.
+        saveFile(file_path): Saves the grid and settings to a .lif or .lifb file.
+        recordFileDialog(): Opens a file dialog to choose where to record.
+        startRecording(file_path): Records every generation to a file.
+        replayFileDialog(): Opens a file dialog to choose a recording to replay.
     """
 
     def __init__(self):
@@ -124,11 +183,16 @@ class GameOfLife3D(ShowBase):
         props = WindowProperties()
         props.setSize(1920, 1080)  # Set the window size 
         self.win.requestProperties(props)
-        # Initialize PyQt application
-        
-        self.qt_app = QApplication.instance()
-        if not self.qt_app:
-            self.qt_app = QApplication(sys.argv)      
+        # The PyQt application is created by the first file dialog
+        self.qt_app = None
+        self.filepicker = None
+        # The timings of every step, scene update and frame go to a trace file with --trace PATH
+        if "--trace" in sys.argv[:-1]:
+            profiler.start_trace(sys.argv[sys.argv.index("--trace") + 1])
+        self.exitFunc = self.finish_trace
+        self.show_perf = False
+        self.perf_time = 0.0
+        self.startup_time = None
         self.grid_size = 10
         self.zoom = 1.0
         self.ZoomSliderValue = 0
@@ -146,19 +210,33 @@ class GameOfLife3D(ShowBase):
         self.birthrate = 3
         self.deathrate = 4
         self.aliverate = 2
+        self.rulestring = ""
         self.population_rate = 10
         self.sliderscale = 10
         self.tilt = 0
-        self.grid = self.ClearGrid()
-        self.birthgrid = self.ClearGrid()
-        self.cubes = []
-        self.create_cubes()
+        self.engine_name = "chunked"
         self.runlife=False
+        self.recording = False
+        self.replay = None
+        self.replay_position = 0
+        self.drawn_position = None
+        self.drawn_cells = None
+        self.drawn_cycle = None
+        self.drawn_error = None
+        self.playback = StepScheduler(self.update_rate)
+        self.scheduler = StepScheduler(self.update_rate)
+        # The engine runs on a worker thread so a slow generation never blocks the render loop
+        engine = ENGINES[self.engine_name](self.grid_size, self.birthrate, self.deathrate, self.aliverate)
+        self.worker = SimulationWorker(engine, self.scheduler)
+        self.worker.start()
+        self.cellmesh = LodMesh(self.render, self.cube_size)
+        self.create_cubes()
 
         # Get library of shapes
+        # Only the file names are listed here, a pattern is parsed when it is first chosen
         current_directory = os.path.dirname(os.path.abspath(__file__))
-        lif_files = self.find_lif_files(current_directory)
-        print("LIF files in current directory:", lif_files)
+        self.library = PatternLibrary([current_directory], default_cache_path())
+        lif_files = self.library.names()
 
         # Create GUI elements using DirectGui
         self.startbutton = DirectButton( text="Start", scale=0.08,  pos=(0.95, 0.96, 0.9), command=self.buttonClicked )
@@ -203,6 +281,34 @@ class GameOfLife3D(ShowBase):
                                              items=["10", "20","30","50","100","500","1000"], 
                                              initialitem="10",  pos=(-0.95, 0.96, -0.97), 
                                              highlightColor=(0.65, 0.65, 0.9, 1)) 
+        self.optionEnginebutton = DirectOptionMenu(text="engine", scale=0.08, command=self.buttonEngine, 
+                                             items=sorted(ENGINES), 
+                                             initialitem=self.engine_name,  pos=(-0.95, 0.96, 0.75), 
+                                             highlightColor=(0.65, 0.65, 0.9, 1)) 
+        self.speed_options = ["1","2","5","10","20","50","100","max"]
+        self.optionSpeedbutton = DirectOptionMenu(text="speed", scale=0.08, command=self.buttonSpeed, 
+                                             items=self.speed_options, 
+                                             initialitem=str(self.update_rate),  pos=(0.95, 0.96, 0.3), 
+                                             highlightColor=(0.65, 0.65, 0.9, 1)) 
+        self.SpeedLabel = DirectButton( text="Gen/s", scale=0.07,  pos=(0.75, 0.96, 0.3), command=self.ButtonNothingClicked)
+        self.recordbutton = DirectButton( text="Record", scale=0.08,  pos=(0.95, 0.96, 0.2), command=self.buttonRecord )
+        self.replaybutton = DirectButton( text="Replay", scale=0.08,  pos=(0.95, 0.96, 0.1), command=self.buttonReplay )
+        self.optionCyclebutton = DirectOptionMenu(text="cycle", scale=0.08, command=self.buttonCycle,
+                                             items=list(CYCLE_ACTIONS),
+                                             initialitem="run",  pos=(0.95, 0.96, 0.0),
+                                             highlightColor=(0.65, 0.65, 0.9, 1))
+        self.CycleLabel = DirectButton( text="Cycle", scale=0.07,  pos=(0.75, 0.96, 0.0), command=self.ButtonNothingClicked)
+        self.perfbutton = DirectButton( text="Perf", scale=0.08,  pos=(0.95, 0.96, -0.1), command=self.buttonPerf )
+        self.optionMeshbutton = DirectOptionMenu(text="mesh", scale=0.08, command=self.buttonMesh,
+                                             items=list(MESHES),
+                                             initialitem=self.cellmesh.mesh,  pos=(0.95, 0.96, -0.2),
+                                             highlightColor=(0.65, 0.65, 0.9, 1))
+        self.MeshLabel = DirectButton( text="Mesh", scale=0.07,  pos=(0.75, 0.96, -0.2), command=self.ButtonNothingClicked)
+        self.replaySlider = None
+        self.EngineLabel = DirectButton( text="Engine", scale=0.07,  pos=(-1.15, 0.96, 0.75), command=self.ButtonNothingClicked)
+        self.ruleEntry = DirectEntry(text="", scale=0.06, width=8, numLines=1, pos=(-1.02, 0.96, 0.64),
+                                     command=self.enterRule, initialText=str(self.current_rule()))
+        self.RuleLabel = DirectButton( text="Rule", scale=0.07,  pos=(-1.15, 0.96, 0.65), command=self.ButtonNothingClicked)
         self.TiltLabel={}
         labels=["Presets","Birth","Death","Alive","Population","Size"]
         for i in range(0,len(labels)):
@@ -211,8 +317,12 @@ class GameOfLife3D(ShowBase):
                                              pos=(-1.15, 0.96, -0.5-i*0.095), command=self.ButtonNothingClicked)
         self.textDisplay = OnscreenText(text="Game of Life 3D", pos=(-1.2, 0.9), scale=0.07, mayChange=True)
         self.textDisplay.setText("Game of Life 3D")
+        self.perfDisplay = OnscreenText(text="", pos=(-1.7, 0.82), scale=0.05, mayChange=True, align=TextNode.ALeft)
+        self.perfDisplay.hide()
         self.update_display()
         self.taskMgr.add(self.update, "update")
+        # Sorted after the render loop, so it runs once the first frame is drawn
+        self.taskMgr.add(self.first_frame, "first_frame", sort=60)
         
         
 
@@ -224,9 +334,12 @@ class GameOfLife3D(ShowBase):
         self.cursorZ = self.grid_size // 2
         self.optionSizebutton.set(str(self.grid_size))
         self.optionRatebutton.set(str(self.population_rate))
-        self.optionAlivebutton.set(self.aliverate)      
-        self.optionDeathbutton.set(self.deathrate)
-        self.optionBirthbutton.set(self.birthrate)
+        self.optionAlivebutton.set(self.aliverate, fCommand=False)
+        self.optionDeathbutton.set(self.deathrate, fCommand=False)
+        self.optionBirthbutton.set(self.birthrate, fCommand=False)
+        if str(self.update_rate) in self.speed_options and not self.scheduler.max_speed:
+            self.optionSpeedbutton.set(str(self.update_rate), fCommand=False)
+        self.sync_engine()
         self.RotateSlider.value = self.rotate
         self.TiltSlider.value = self.tilt
         self.ZoomSlider.value = self.ZoomSliderValue
@@ -237,22 +350,27 @@ class GameOfLife3D(ShowBase):
 
     def buttonOptionClicked(self, value):
         # Handle the event when an option button is clicked
-        # Loads a .lif file passed in the dropped down and updates the grid
+        # Loads the pattern chosen in the drop down from the library and updates the grid
+        # Patterns chosen recently come from the library's cache without reading the file
         print("Button Option clicked")
         print(value)
-        self.grid = self.ClearGrid()
-        self.readFile_and_Load(value+'.lif')
+        try:
+            with profiler.section("load"):
+                gridlist, griditems = self.library.load(value)
+        except Exception as e:
+            self.textDisplay.setText(f"Error reading file: {str(e)}")
+            return
+        self.closeReplay()
+        self.load_pattern(gridlist, griditems)
+        info = self.library.info(value)
+        self.textDisplay.setText(f"{value}: {info.count} cells, rule {self.current_rule()}")
+        self.library.save_index()
 
     def ButtonNothingClicked(self):
         # Handle the event when a button with no action is clicked
         # Label and others that do nothing
         print("Button Nothing clicked")
 
-    def find_lif_files(self,directory):
-        # Find .lif files in the specified directory to load into dropdown
-        lif_files = [f[:-4] for f in os.listdir(directory) if f.endswith('.lif')]
-        return lif_files
-    
     def ButtonZoomClicked(self):
         # Handle the event when the zoom button is clicked
         # This zooms the camera based on the slider value
@@ -307,61 +425,48 @@ class GameOfLife3D(ShowBase):
         # This moves the cursor up
         print("Button Up clicked")
         self.cursorZ += 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
     
     def buttonDownClicked(self):
         # Handle the event when the down button is clicked
         # This moves the cursor down
         print("Button Down clicked")
         self.cursorZ -= 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
 
     def buttonLeftClicked(self):
         # Handle the event when the left button is clicked
         # This moves the cursor to the left
         print("Button Left clicked")
         self.cursorX -= 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
 
     def buttonRightClicked(self):
         # Handle the event when the right button is clicked
         # This moves the cursor to the right
         print("Button Right clicked")
         self.cursorX += 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
     
     def buttonForwardClicked(self):
         # Handle the event when the forward button is clicked
         # This moves the cursor forward
         print("Button Forward clicked")
         self.cursorY += 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
 
     def buttonBackwardClicked(self):
         # Handle the event when the backward button is clicked
         # This moves the cursor backward        
         print("Button Backward clicked")
         self.cursorY -= 1
-        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
-        self.update_cubes()
+        self.move_cursor()
 
     def buttonToggleClicked(self):
         # Handle the event when the toggle button is clicked
         # This toggles the state of the cube at the cursor position
         print("Button Toggle clicked")
-        pos= f"{self.cursorX}-{self.cursorY}-{self.cursorZ}" 
-        if pos in self.grid:
-            if self.grid[pos] > 1:
-                self.grid[pos] = 1
-            self.grid[pos] = 1 - self.grid[pos]
-        else:
-            self.grid[pos] = 1
-        self.update_cubes()
+        self.worker.call("toggle_cell", self.cursorX, self.cursorY, self.cursorZ)
 
 
     def buttonClear(self):
@@ -369,8 +474,7 @@ class GameOfLife3D(ShowBase):
         # This clears the grid
         # The update the display
         print("Button Clear clicked")
-        self.grid = self.ClearGrid()
-        self.update_cubes()
+        self.worker.clear()
 
     def buttonPopulation(self, value): 
         # Handle the event when the population button is clicked
@@ -385,6 +489,8 @@ class GameOfLife3D(ShowBase):
         print("Button Birth clicked")
         print(value)
         self.birthrate = int(value)
+        self.rulestring = ""
+        self.sync_engine()
     
     def buttonDeath(self, value):
         # Handle the event when the death button is clicked
@@ -392,6 +498,8 @@ class GameOfLife3D(ShowBase):
         print("Button Death clicked")
         print(value)
         self.deathrate = int(value)
+        self.rulestring = ""
+        self.sync_engine()
 
     def buttonAlive(self, value):
         # Handle the event when the alive button is clicked
@@ -399,11 +507,14 @@ class GameOfLife3D(ShowBase):
         print("Button Alive clicked")
         print(value)
         self.aliverate = int(value)
+        self.rulestring = ""
+        self.sync_engine()
 
     def buttonSize(self, value):
         # Handle the event when the size button is clicked
         # This sets the size of the grid
         # The update the display and camera and cursor position
+        # The engine keeps the cells that fit, and the chunked engine keeps every cell
         print("Button Size clicked")
         print(value)
         self.grid_size = int(value)
@@ -411,215 +522,449 @@ class GameOfLife3D(ShowBase):
         self.cursorX = self.grid_size // 2
         self.cursorY = self.grid_size // 2
         self.cursorZ = self.grid_size // 2
-        self.grid = self.ClearGrid()
-        self.update_cubes()
+        self.sync_engine()
         self.adjust_camera()
         
+    def buttonEngine(self, value):
+        # Handle the event when the engine button is clicked
+        # This moves the live cells into a new engine of the chosen type
+        print("Button Engine clicked")
+        print(value)
+        if value == self.engine_name:
+            return
+        engine_class = ENGINES[value]
+        def make(old):
+            # Runs on the worker thread, so the old engine is not stepping
+            engine = engine_class(old.grid_size, old.birthrate, old.deathrate, old.aliverate)
+            engine.rule = old.rule
+            engine.set_cells(*old.cell_arrays())
+            engine.generation = old.generation
+            close = getattr(old, "close", None)
+            if close is not None:
+                close()
+            return engine
+        self.engine_name = value
+        self.worker.replace_engine(make)
+
+    def buttonSpeed(self, value):
+        # Handle the event when the speed button is clicked
+        # This sets the generations per second, or runs as many as fit in a frame for max
+        print("Button Speed clicked")
+        print(value)
+        self.scheduler.max_speed = self.playback.max_speed = value == "max"
+        if not self.scheduler.max_speed:
+            self.update_rate = int(value)
+            self.scheduler.generations_per_second = self.update_rate
+            self.playback.generations_per_second = self.update_rate
+
+    def buttonCycle(self, value):
+        # Handle the event when the cycle button is clicked
+        # This chooses whether a pattern that died out, settled or repeats keeps stepping,
+        # pauses, or fast forwards by showing the generations of one period again
+        print("Button Cycle clicked")
+        print(value)
+        self.worker.set_cycle_action(value)
+
+    def buttonMesh(self, value):
+        # Handle the event when the mesh button is clicked
+        # This draws the cells near the camera as solid surfaces, with only the faces between
+        # live and dead cells, or as a separate cube per cell
+        print("Button Mesh clicked")
+        print(value)
+        with profiler.section("scene build"):
+            self.cellmesh.set_mesh(value)
+
+    def enterRule(self, text):
+        # Handle the event when a rulestring is entered
+        # A rulestring such as B5/S45 replaces the birth, death and alive rates,
+        # an empty one goes back to the rates
+        print("Rule entered")
+        print(text)
+        try:
+            self.rulestring = str(Rule.parse(text)) if text.strip() else ""
+        except ValueError as e:
+            self.textDisplay.setText(str(e))
+            return
+        self.sync_engine()
+
     def buttonStep(self):  
         # Handle the event when the step button is clicked
         # This advances the game by one step
         print("Button Step clicked")
+        if self.replay is not None:
+            self.next_frame()
+            return
         self.step()
 
     def buttonReset(self):  
         # Handle the event when the reset button is clicked
         # This resets the grid to a random state based on the population rate
         print("Button Reset clicked")
-        self.grid = self.initialize_grid()
-        for i in range(self.population_rate):
-            self.grid[f"{randrange(self.grid_size)}-{randrange(self.grid_size)}-{randrange(self.grid_size)}"]=1
-        self.update_cubes()
+        self.worker.call("randomize", self.population_rate)
 
     def buttonClicked(self):
         # Handle the event when the start/stop button is clicked
         # This run the model until the button is clicked again 
         self.runlife = not self.runlife
         self.startbutton["text"] = "Stop" if self.runlife else "Start"
+        if self.replay is not None:
+            # While replaying the recording plays instead of the engine
+            self.playback.reset(time.perf_counter())
+        elif self.runlife:
+            self.worker.resume()
+        else:
+            self.worker.pause()
         print("Button clicked")
         print(self.runlife)
     
-    def ClearGrid(self):
-        # Clear the grid by create a new empty dictionary
-        return {}
-
-    
-    def initialize_grid(self):
-        # Initialize the grid by creating a new empty dictionary
-        return {}
+    def buttonRecord(self):
+        # Handle the event when the record button is clicked
+        # Every generation stepped from now on is streamed to a recording file until clicked again
+        if self.recording:
+            self.worker.stop_recording()
+            self.recording = False
+        else:
+            self.recordFileDialog()
+            return
+        self.recordbutton["text"] = "Record"
+
+    def startRecording(self, file_path):
+        # Record every generation from now on to a file chosen in the record dialog
+        if not file_path:
+            return
+        self.worker.start_recording(lambda engine: Recorder.for_engine(file_path, engine))
+        self.recording = True
+        self.recordbutton["text"] = "Stop rec"
+
+    def buttonReplay(self):
+        # Handle the event when the replay button is clicked
+        # This plays back a recording with a slider to scrub through it, until clicked again
+        if self.replay is not None:
+            self.closeReplay()
+        else:
+            self.replayFileDialog()
+
+    def sliderReplay(self):
+        # Handle the event when the replay slider is moved
+        # The frame is drawn by the update task, so dragging never waits on a decode
+        if self.replay is not None:
+            self.replay_position = int(round(self.replaySlider["value"]))
+
+    def openReplay(self, file_path):
+        # Play back a recording instead of the engine
+        # The recording is memory mapped, so even a long one opens at once and is never re-simulated
+        if not file_path:
+            return
+        try:
+            replay = Recording(file_path)
+        except (OSError, ValueError) as e:
+            self.textDisplay.setText(f"Error reading recording: {str(e)}")
+            return
+        if len(replay) == 0:
+            replay.close()
+            self.textDisplay.setText("The recording has no frames")
+            return
+        self.closeReplay()
+        if self.runlife:
+            # Stop the engine, the Start button plays the recording from now on
+            self.buttonClicked()
+        self.replay = replay
+        self.replay_position = 0
+        self.drawn_position = None
+        self.replaySlider = DirectSlider(range=(0, max(1, len(replay) - 1)), value=0, pageSize=1,
+                                         scale=0.6, pos=(0, 0, -0.9), command=self.sliderReplay)
+        self.replaybutton["text"] = "Live"
+
+    def closeReplay(self):
+        # Go back from a recording to drawing the engine
+        if self.replay is None:
+            return
+        if self.runlife:
+            self.buttonClicked()
+        self.replay.close()
+        self.replay = None
+        self.replaySlider.destroy()
+        self.replaySlider = None
+        self.replaybutton["text"] = "Replay"
+        self.textDisplay.setText("Game of Life 3D")
+        # Redraw the engine's newest generation and its cycle on the next frame
+        self.drawn_version = None
+        self.drawn_cells = None
+        self.drawn_cycle = None
+
+    def next_frame(self):
+        # Move the replay on by one frame, stopping at the end of the recording
+        if self.replay_position + 1 < len(self.replay):
+            self.replay_position += 1
+        elif self.runlife:
+            self.buttonClicked()
+
+    def show_frame(self):
+        # Draw the frame of the recording at the replay position
+        # Frames close after the last one drawn only apply their deltas
+        with profiler.section("replay frame"):
+            coords, states = self.replay.frame(self.replay_position)
+        self.cellmesh.cube_size = self.cube_size
+        with profiler.section("scene update"):
+            self.cellmesh.update(coords, states)
+        self.drawn_position = self.replay_position
+        if int(round(self.replaySlider["value"])) != self.replay_position:
+            self.replaySlider["value"] = self.replay_position
+        self.textDisplay.setText(f"Replay generation {self.replay.generations[self.replay_position]} "
+                                 f"({self.replay_position + 1}/{len(self.replay)})")
+        self.move_cursor()
+
+    def current_rule(self):
+        # The rule chosen in the gui, the rulestring if there is one or else the rates
+        if self.rulestring:
+            return Rule.parse(self.rulestring)
+        return Rule.from_rates(self.birthrate, self.deathrate, self.aliverate)
+
+    def sync_engine(self):
+        # Send the grid size and rules chosen in the gui to the engine on the worker thread
+        # The rule is compiled here once per change and sent with the rates and the size in one
+        # message, so the worker settles and publishes once
+        rule = self.current_rule()
+        self.worker.configure(grid_size=self.grid_size, rule=rule, birthrate=self.birthrate,
+                              deathrate=self.deathrate, aliverate=self.aliverate)
+        self.ruleEntry.enterText(str(rule))
+        self.scheduler.generations_per_second = self.update_rate
 
     def create_cubes(self):
         # Create the cubes in the grid
-        # This creates a cube for each cell in the grid dictionary
-        for ii,jj in self.grid.items():
-            # Convert the grid string (dictionary key) to coordinates
-            x,y,z=self.convert_string_to_grid(ii)
-            # Create a cube at the coordinates
-            cube = self.loader.loadModel("models/box")
-            cube.setScale(self.cube_size)
-            cube.setPos(Point3(x, y, z) * self.cube_size * 2)
-            # Set the color of the cube based on the value in the grid
-            # 1 is alive, -1 is dead next cycle. greater than 1 is alive and mature
-            if jj == 1:
-                cube.setColor(0, 1, 0, 1)  # Set cube color to green
-            elif jj == -1:
-                cube.setColor(1, 0, 0, 1)
-            else:
-                cube.setColor(0, 0, 1, 1)
-            # add the cube to the render engine
-            cube.reparentTo(self.render)
-            self.cubes.append(cube)
+        # All of the live cells are drawn as one mesh built in a single pass over the
+        # newest generation published by the worker. The colour is set by the value in the grid:
+        # 1 is alive, -1 is dead next cycle. greater than 1 is alive and mature
+        snapshot = self.worker.latest
+        self.cellmesh.cube_size = self.cube_size
+        with profiler.section("scene build"):
+            self.cellmesh.rebuild(snapshot.coords, snapshot.states)
+        self.drawn_version = snapshot.version
+        self.drawn_cells = snapshot.coords
         # Create a cursor cube at the cursor position            
         cursorcube = self.loader.loadModel("models/box")
-        cursorcube.setScale(self.cube_size)
-        cursorcube.setPos(self.cursorpoint * self.cube_size * 2)
         cursorcube.setColor(1, 1, 1, 1)  # Set cube color to white
         self.cursorcube = cursorcube
         cursorcube.reparentTo(self.render)
+        self.move_cursor()
+
+    def move_cursor(self):
+        # Move the cursor cube to the cursor position without touching the cells
+        self.cursorpoint = Point3(self.cursorX, self.cursorY, self.cursorZ)
+        self.cursorcube.setScale(self.cube_size)
+        self.cursorcube.setPos(self.cursorpoint * self.cube_size * 2)
 
     def step(self):
         # Advance the game by one step
-        new_grid = self.ClearGrid()
-        # create a grid of possible new births
-        self.birthgrid = self.ClearGrid()
-        # loop through the grid dictionary update the state of each cell by the rules of the game 
-        # which is the number of alive neighbors
-        for ii,jj in self.grid.items():
-            # Convert the grid string (dictionary key) to coordinates
-            x,y,z=self.convert_string_to_grid(ii)
-            # Count the number of alive neighbors for the cell
-            alive_neighbors = self.count_alive_neighbors(x, y, z, True)
-            #print(f"{x}-{y}-{z} life{jj}  neighbours{alive_neighbors}")
-            # If the cell is alive and has the right number of alive neighbors, keep it alive
-            if alive_neighbors>= self.aliverate and alive_neighbors < self.deathrate:
-                new_grid[f"{int(x)}-{int(y)}-{int(z)}"] = jj+1
-
-        # loop through the birthgrid dictionary update the state of each cell by the rules of the game
-        for ii,jj in self.birthgrid.items():
-            # Convert the grid string (dictionary key) to coordinates
-            x,y,z=self.convert_string_to_grid(ii)
-            # Check the number of alive neighbors for the cell to see if it should be born         
-            if jj>= self.birthrate and jj < self.deathrate:
-                #print(f"{x}-{y}-{z} birth{jj}")
-                new_grid[f"{int(x)}-{int(y)}-{int(z)}"] = 1
-
-        # Update the grid with the new state        
-        self.grid = new_grid
-
-        # loop through the grid dictionary to check if any cells should die next cycle
-        for ii,jj in self.grid.items():
-            x,y,z=self.convert_string_to_grid(ii)
-            if self.count_alive_neighbors(x, y, z, False) >= self.deathrate:
-                self.grid[ii]=-1
-        
-        print(f"Active Cells {len(self.grid)}")
-
-        # Update the display
-        self.update_cubes()
+        # The worker steps the engine and the update task draws the result
+        self.worker.step()
 
     def update(self, Task):
-        # Since the frame rate is much higher than the update rate, we need to keep track of time so that we can update the game at the correct
-        # rate. We do this by incrementing the time counter and checking if it is time to update the game.
-        self.time_counter += 1
-        if self.runlife and self.time_counter % self.update_rate == 0:
-            self.step()
+        # The worker thread steps the game by wall clock time, so the speed does not depend on
+        # the frame rate and a slow generation never blocks this task. Each frame picks up the
+        # newest finished generation without waiting and redraws the cubes if it changed.
+        with profiler.section("update"):
+            self.update_frame()
+        if self.show_perf:
+            self.update_perf()
         return Task.cont
 
-    def count_alive_neighbors(self, x, y, z,mature=False):
-        # Count the number of alive neighbors for a cell
-        # This checks the 26 neighbors of the cell in the grid
-        # and returns the number of alive neighbors
-        # If mature is True, it also checks if the neighbors so we keep track of possibe birth locations
-        directions = [Vec3(dx, dy, dz) for dx in [-1, 0, 1] for dy in [-1, 0, 1] for dz in [-1, 0, 1] if not (dx == dy == dz == 0)]
-        count = 0
-        for direction in directions:
-            nx, ny, nz = x + direction.x, y + direction.y, z + direction.z
-            if 0 <= nx < self.grid_size and 0 <= ny < self.grid_size and 0 <= nz < self.grid_size:
-                grid_key = f"{int(nx)}-{int(ny)}-{int(nz)}"
-                if grid_key in self.grid:
-                    #print( x, y, z,grid_key)
-                    count += 1
-                elif mature:
-                    self.birthgrid[grid_key] = self.count_alive_neighbors(nx, ny, nz, False)
-        return count
+    def update_frame(self):
+        # Draw the newest generation of the worker, or the frame of the recording being replayed
+        self.time_counter += 1
+        if self.replay is not None:
+            # A recording is playing back, the frames are paced by wall clock time like the engine
+            # At max speed every frame of the recording is drawn, one per rendered frame
+            if self.runlife and self.playback.max_speed:
+                self.next_frame()
+            elif self.runlife:
+                self.playback.run(self.next_frame)
+            if self.replay_position != self.drawn_position:
+                self.show_frame()
+            return
+        if self.runlife and self.worker.auto_paused:
+            # The worker paused itself on finding a cycle
+            self.runlife = False
+            self.startbutton["text"] = "Start"
+        snapshot = self.worker.latest
+        if snapshot.cycle != self.drawn_cycle:
+            self.textDisplay.setText(describe(snapshot.cycle) or "Game of Life 3D")
+            self.drawn_cycle = snapshot.cycle
+        if snapshot.error is not None and snapshot.version != self.drawn_error:
+            self.show_error(snapshot)
+        if snapshot.version != self.drawn_version:
+            if snapshot.coords is self.drawn_cells:
+                # A generation of a cycle shown again while fast forwarding, already drawn
+                self.drawn_version = snapshot.version
+                return
+            print(f"Active Cells {len(snapshot.states)}")
+            self.update_cubes()
+
+    def show_error(self, snapshot):
+        # Show an error the worker ran into. The worker has paused and dropped its recorder,
+        # so the Start and Record buttons go back to match
+        print(snapshot.error)
+        self.textDisplay.setText(snapshot.error)
+        self.drawn_error = snapshot.version
+        if self.runlife:
+            self.runlife = False
+            self.startbutton["text"] = "Start"
+        if self.recording:
+            self.recording = False
+            self.recordbutton["text"] = "Record"
+
+    def buttonPerf(self):
+        # Handle the event when the perf button is clicked
+        # This shows or hides the performance display. The profiler only times anything while
+        # the display is shown or a trace is being written
+        self.show_perf = not self.show_perf
+        profiler.enabled = self.show_perf or profiler.trace_path is not None
+        if self.show_perf:
+            profiler.reset()
+            self.perfDisplay.show()
+        else:
+            self.perfDisplay.hide()
+
+    def update_perf(self):
+        # Refresh the performance display a few times a second
+        now = time.perf_counter()
+        if now - self.perf_time < 0.25:
+            return
+        self.perf_time = now
+        cells = len(self.worker.latest.states) if self.replay is None else self.cellmesh.population
+        self.perfDisplay.setText(
+            f"step {profiler.mean_ms('step'):.2f} ms   scene {profiler.mean_ms('scene update'):.2f} ms   "
+            f"frame {profiler.mean_ms('update'):.2f} ms\n"
+            f"{cells} cells   {self.cellmesh.voxel_count} voxels   {self.cellmesh.triangle_count} triangles   "
+            f"{self.render.countNumDescendants()} nodes   "
+            f"{ClockObject.getGlobalClock().getAverageFrameRate():.0f} fps")
+
+    def finish_trace(self):
+        # Finish the trace file when the application exits
+        profiler.stop_trace()
 
     def update_cubes(self):
         # Update the cubes in the game engine
-        for cube in self.cubes:
-            cube.removeNode()
-        self.cursorcube.removeNode()
-        self.cubes = []
-        self.create_cubes()
+        # Only the cells born or died since the last update and the cells whose colour
+        # changed are written to the mesh
+        snapshot = self.worker.latest
+        self.cellmesh.cube_size = self.cube_size
+        with profiler.section("scene update"):
+            self.cellmesh.update(snapshot.coords, snapshot.states)
+        self.drawn_version = snapshot.version
+        self.drawn_cells = snapshot.coords
+        self.move_cursor()
 
     def adjust_camera(self):
         # Adjust the camera position based upon the grid size and direction of the rotation
+        # The cells far from the camera are then drawn as voxels
         self.cam.setPos(self.x, self.y, self.tilt*3)
         self.cam.lookAt(Point3(self.grid_size / 2, 
                                self.grid_size / 2, 
                                self.grid_size / 2))
+        self.cellmesh.set_camera(self.cam.getPos(self.render))
         
     
+    def first_frame(self, Task):
+        # Report the time from starting to the first frame drawn
+        self.startup_time = time.perf_counter() - STARTED
+        print(f"Startup to first frame: {self.startup_time:.3f} s")
+        self.textDisplay.setText(f"Game of Life 3D - started in {self.startup_time:.2f} s")
+        if "--startup" in sys.argv:
+            self.userExit()
+        return Task.done
+
+    def file_dialog(self):
+        # Import PyQt6 and create the QApplication when a file dialog is first opened
+        # Returns None when PyQt6 is not installed
+        if self.qt_app is None:
+            try:
+                from PyQt6.QtWidgets import QApplication, QFileDialog
+            except ImportError:
+                return None
+            self.qt_app = QApplication.instance() or QApplication(sys.argv)
+            self.QFileDialog = QFileDialog
+        return self.QFileDialog
+
+    def choose_file(self, title, filters, save, callback):
+        # Ask for a file and call callback with its path, or with "" if cancelled
+        # filters is a list of (description, extensions). Qt's dialog returns at once,
+        # the DirectGui picker calls back when a file is chosen
+        dialog = self.file_dialog()
+        if dialog is not None:
+            qt_filters = ";;".join(f"{name} ({' '.join('*' + e for e in extensions)})"
+                                   for name, extensions in filters) + ";;All Files (*)"
+            ask = dialog.getSaveFileName if save else dialog.getOpenFileName
+            file_path, _ = ask(None, title, "", qt_filters)
+            callback(file_path)
+            return
+        if self.filepicker is not None:
+            self.filepicker.close()
+        def picked(file_path):
+            self.filepicker = None
+            callback(file_path)
+        extensions = tuple(e for name, group in filters for e in group)
+        self.filepicker = FilePicker(title, extensions, save, picked)
+
     def openFileDialog(self):
-        # Open file dialog using PyQt
-        file_path, _ = QFileDialog.getOpenFileName(
-            None,
-            "Choose a life file",
-            "",
-            "Life Files (*.lif);;All Files (*)"
-        )
-        self.readFile_and_Load(file_path)
+        # Open file dialog
+        self.choose_file("Choose a life file", [("Life Files", (".lif", ".lifb")), ("Life Recordings", (".lifr",))],
+                         False, self.readFile_and_Load)
 
     def readFile_and_Load(self, file_path):    
-        if file_path:
+        if file_path and file_path.endswith(".lifr"):
+            # A recording is played back rather than loaded into the engine
+            self.openReplay(file_path)
+        elif file_path:
+            self.closeReplay()
             try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    json_string = file.read()
-                    # Update the display text
-                    gridlist = json.loads(json_string)["grid"]
-                    griditems = json.loads(json_string)["griditems"]
-                    #print(gridlist)
-                    self.grid=self.ClearGrid()
-                    for i,j in griditems.items():
-                        setattr(self,i,j)
-
-                    self.update_display() 
-                    for x,y,z in gridlist:
-                        self.grid[f"{int(x)}-{int(y)}-{int(z)}"] = 1
-                        print(f"{int(x)}-{int(y)}-{int(z)}")   
-                    self.update_cubes()
-                    self.adjust_camera()
+                with profiler.section("load"):
+                    gridlist, griditems = read_pattern(file_path)
+                self.load_pattern(gridlist, griditems)
             except Exception as e:
                 self.textDisplay.setText(f"Error reading file: {str(e)}")
 
-    def convert_string_to_grid(self, grid_string):
-        #print(grid_string)
-        grid_items = [int(i) for i in grid_string.split("-")]
-        return grid_items[0], grid_items[1], grid_items[2]
+    def load_pattern(self, gridlist, griditems):
+        # Apply the settings of a pattern and load its cells into the engine
+        # Files without a rulestring use their rates
+        self.rulestring = ""
+        for i,j in griditems.items():
+            setattr(self,i,j)
+
+        self.update_display() 
+        self.worker.call("load_cells", gridlist)
+        self.adjust_camera()
 
     def saveFileDialog(self):
-        # Open save file dialog using PyQt
-        file_path, _ = QFileDialog.getSaveFileName(
-            None,
-            "Save life file",
-            "",
-            "Life Files (*.lif);;All Files (*)"
-        )
+        # Open save file dialog
+        self.choose_file("Save life file", [("Life Files", (".lif",)), ("Binary Life Files", (".lifb",))],
+                         True, self.saveFile)
+
+    def saveFile(self, file_path):
+        # Save the grid and the settings to the file chosen in the save dialog
         properties=["grid_size","zoom","radius","cube_size","time_counter","update_rate",
                     "cursorX","cursorY","cursorZ","x","y","birthrate","deathrate",
-                    "aliverate","population_rate","sliderscale","tilt"]
+                    "aliverate","rulestring","population_rate","sliderscale","tilt"]
         griditems = {i:getattr(self,i) for i in properties}
         # Save the grid to the file
-        gridlist = []
-        for ii,jj in self.grid.items():
-            x,y,z=self.convert_string_to_grid(ii)
-            gridlist.append((x,y,z))
-        json_string = json.dumps({"grid": gridlist, "griditems":griditems}, indent=4)
+        # .lifb files are written in the binary format, anything else as JSON
+        gridlist = self.worker.latest.coords
         if file_path:
             try:
-                with open(file_path, 'w', encoding='utf-8') as file:
-                    file.write(json_string)
+                with profiler.section("save"):
+                    save_pattern(file_path, gridlist, griditems)
             except Exception as e:
                 self.textDisplay.setText(f"Error saving file: {str(e)}")
 
+    def recordFileDialog(self):
+        # Open a save file dialog for a recording
+        self.choose_file("Record to file", [("Life Recordings", (".lifr",))], True, self.startRecording)
+
+    def replayFileDialog(self):
+        # Open file dialog for a recording
+        self.choose_file("Choose a recording", [("Life Recordings", (".lifr",))], False, self.openReplay)
+
 # Create an instance of the GameOfLife3D class and run the game
-game = GameOfLife3D()
-game.run()
\ No newline at end of file
+if __name__ == "__main__":
+    game = GameOfLife3D()
+    game.run()
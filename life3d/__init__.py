@@ -0,0 +1,25 @@
+"""
+
+Headless simulation core for the 3D Game of Life.
+The Panda3D front end in Panda3d_gameV2.py renders the state of these engines.
+
+
+"""
+from .engine import SparseEngine
+from .dense import DenseEngine
+from .parallel import ParallelDenseEngine
+from .bitpacked import BitPackedEngine
+from .hashlife import HashlifeEngine
+from .chunked import ChunkedEngine
+from .patterns import convert_pattern, read_lif, read_pattern, save_pattern, write_lif, write_pattern
+from .recording import Recorder, Recording
+
+# The engines that can be chosen by name from the command line and the gui
+ENGINES = {
+    "sparse": SparseEngine,
+    "dense": DenseEngine,
+    "parallel": ParallelDenseEngine,
+    "bitpacked": BitPackedEngine,
+    "hashlife": HashlifeEngine,
+    "chunked": ChunkedEngine,
+}
@@ -0,0 +1,234 @@
+"""
+
+This module times the engines and the cell mesh headless, for catching
+performance regressions before they show up as a stuttering demo.
+A case loads a random population at a density of the grid, or a pattern
+file with its own settings, into an engine and steps it for a number of
+generations or until a time limit, whichever comes first. The generation
+throughput is timed on its own, in generations and cells per second, and the
+scene is timed separately: building the whole cell mesh, as create_cubes
+does, and updating it from each generation, as the update task does. The
+times compared between runs are medians of the generations, and the fastest
+of a few builds, so one slow generation does not read as a regression. The
+peak memory of stepping is measured in a short second run, so tracing the
+allocations never slows the timed run. The random populations come from a
+fixed seed, so every run times the same cells.
+Results are written as JSON with the versions they were taken with, and can
+be compared with a stored baseline: a case whose time or memory grew by more
+than a threshold is reported as a regression.
+Classes:
+    BenchResult: The timings of one case.
+    Regression: A measurement that grew past the threshold.
+Functions:
+    random_cells(grid_size, density, seed): Places a fraction of the grid's cells at random.
+    run_case(engine_name, name, grid_size, cells, settings, ...): Times one case.
+    run_suite(engines, sizes, densities, patterns, ...): Times every case, skipping those too big to run.
+    write_results(file_path, results): Writes results to a JSON file.
+    read_results(file_path): Reads results written by write_results.
+    compare(results, baseline, threshold): Returns the regressions from a baseline.
+
+
+"""
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+
+# The grid sizes of the size menu and the fractions of the grid filled at random
+SIZES = (10, 20, 30, 50, 100, 500, 1000)
+DENSITIES = (0.0001, 0.001, 0.01, 0.1)
+# The engines that allocate the whole grid, which are skipped on grids bigger than max_volume
+GRID_ENGINES = ("dense", "parallel", "bitpacked")
+# The measurements compared with a baseline, each a cost where more is worse, with the change
+# below which a difference is put down to noise
+COMPARED = {"step_ms": 0.5, "scene_build_ms": 0.5, "scene_update_ms": 0.5, "peak_mb": 1.0}
+# The version of the results file, a baseline of another version is not compared
+RESULTS_VERSION = 1
+
+# The timings of one case. case names the case across runs, step_ms and scene_update_ms are medians
+# of the generations, scene_build_ms the fastest build, cells_per_second counts the live cells stepped. The scene timings are None without Panda3D,
+# and every timing is None for a case that was skipped, with the reason in skipped
+BenchResult = namedtuple("BenchResult", [
+    "case", "engine", "grid_size", "source", "cells", "generations", "seconds", "generations_per_second",
+    "cells_per_second", "step_ms", "scene_build_ms", "scene_update_ms", "peak_mb", "skipped"])
+
+# A measurement of a case that grew by more than the threshold from the baseline
+Regression = namedtuple("Regression", ["case", "measure", "baseline", "value", "change"])
+
+
+def random_cells(grid_size, density, seed=0):
+    # Place round(density * grid_size**3) cells at random positions, from a repeatable seed
+    # Like the Reset button two may land on the same cell, which keeps the cost independent of the density
+    count = int(round(density * grid_size ** 3))
+    return np.random.default_rng(seed).integers(0, grid_size, size=(count, 3), dtype=np.int64)
+
+
+def _scene():
+    # Return the application's cell mesh on a detached node, or None when Panda3D is not installed
+    # Without a camera every cell is drawn near, so the mesh of every cell is timed
+    try:
+        from panda3d.core import NodePath
+
+        from .render import LodMesh
+    except ImportError:
+        return None
+    return LodMesh(NodePath("benchmark"))
+
+
+def _make_engine(engine_name, grid_size, cells, settings):
+    # Create an engine with a pattern's rates and load its cells
+    from . import ENGINES
+    from .rules import Rule
+    rates = {i: settings[i] for i in ("birthrate", "deathrate", "aliverate") if i in settings}
+    engine = ENGINES[engine_name](grid_size, **rates)
+    if settings.get("rulestring"):
+        engine.rule = Rule.parse(settings["rulestring"])
+    engine.load_cells(cells)
+    return engine
+
+
+def _close(engine):
+    close = getattr(engine, "close", None)
+    if close is not None:
+        close()
+
+
+def _peak_memory(engine_name, grid_size, cells, settings, generations):
+    # The peak MiB allocated while creating, loading and stepping an engine, traced by tracemalloc
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    engine = _make_engine(engine_name, grid_size, cells, settings)
+    for i in range(generations):
+        engine.step()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    _close(engine)
+    if not tracing:
+        tracemalloc.stop()
+    return peak / (1 << 20)
+
+
+def run_case(engine_name, name, grid_size, cells, settings=None, source="random", generations=20,
+             max_seconds=2.0, memory_generations=2, builds=3):
+    # Time one case: stepping, then building and updating the scene from the generations stepped
+    settings = settings or {}
+    engine = _make_engine(engine_name, grid_size, cells, settings)
+    population = engine.population
+    mesh = _scene()
+    scene_build = None
+    if mesh is not None:
+        coords, states = engine.cell_arrays()
+        for i in range(builds):
+            start = time.perf_counter()
+            mesh.rebuild(coords, states)
+            took = time.perf_counter() - start
+            scene_build = took if scene_build is None else min(scene_build, took)
+    step_times, update_times = [], []
+    stepped_cells = 0
+    started = time.perf_counter()
+    while len(step_times) < generations and (not step_times or time.perf_counter() - started < max_seconds):
+        stepped_cells += engine.population
+        start = time.perf_counter()
+        engine.step()
+        step_times.append(time.perf_counter() - start)
+        if mesh is not None:
+            start = time.perf_counter()
+            mesh.update(*engine.cell_arrays())
+            update_times.append(time.perf_counter() - start)
+    _close(engine)
+    if mesh is not None:
+        mesh.removeNode()
+    steps, stepping = len(step_times), sum(step_times)
+    peak = _peak_memory(engine_name, grid_size, cells, settings, min(memory_generations, steps))
+    return BenchResult(
+        f"{engine_name}/{name}", engine_name, grid_size, source, population, steps, stepping,
+        steps / stepping if stepping else None, stepped_cells / stepping if stepping else None,
+        1000 * float(np.median(step_times)), None if scene_build is None else 1000 * scene_build,
+        1000 * float(np.median(update_times)) if update_times else None, peak, None)
+
+
+def _skipped(engine_name, name, grid_size, source, cells, reason):
+    return BenchResult(f"{engine_name}/{name}", engine_name, grid_size, source, cells, 0, None, None, None,
+                       None, None, None, None, reason)
+
+
+def run_suite(engines=("sparse", "dense"), sizes=SIZES, densities=DENSITIES, patterns=(), generations=20,
+              max_seconds=2.0, max_cells=100000, max_volume=1 << 24, seed=0, progress=None):
+    # Time every engine on every size and density and on every pattern file, yielding a BenchResult
+    # for each. A case with more than max_cells live cells, or over max_volume cells of grid for an
+    # engine that allocates the whole grid, is skipped. progress(result) is called after every case
+    from .patterns import read_pattern
+    cases = []
+    for grid_size in sizes:
+        for density in densities:
+            cases.append((f"{grid_size}/{density:g}", grid_size, "random", density, None))
+    for path in patterns:
+        cases.append((os.path.splitext(os.path.basename(path))[0], None, path, None, path))
+    for engine_name in engines:
+        for name, grid_size, source, density, path in cases:
+            if path is not None:
+                cells, settings = read_pattern(path)
+                grid_size = settings.get("grid_size", 10)
+            else:
+                cells, settings = random_cells(grid_size, density, seed), {}
+            if len(cells) > max_cells:
+                result = _skipped(engine_name, name, grid_size, source, len(cells), f"over {max_cells} cells")
+            elif engine_name in GRID_ENGINES and grid_size ** 3 > max_volume:
+                result = _skipped(engine_name, name, grid_size, source, len(cells), f"grid over {max_volume} cells")
+            else:
+                result = run_case(engine_name, name, grid_size, cells, settings, source, generations, max_seconds)
+            if progress is not None:
+                progress(result)
+            yield result
+
+
+def write_results(file_path, results):
+    # Write results to a JSON file with the versions they were taken with and return how many were written
+    results = list(results)
+    data = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processors": os.cpu_count(),
+        "argv": sys.argv[1:],
+        "results": [result._asdict() for result in results],
+    }
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=1)
+    return len(results)
+
+
+def read_results(file_path):
+    # Read results written by write_results, keyed by case
+    with open(file_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    if data.get("version") != RESULTS_VERSION:
+        raise ValueError(f"{file_path} is a version {data.get('version')} results file, expected {RESULTS_VERSION}")
+    return {row["case"]: BenchResult(**row) for row in data["results"]}
+
+
+def compare(results, baseline, threshold=0.2):
+    # Return a Regression for every measurement that grew by more than threshold, 0.2 being 20%,
+    # from the baseline's result for the same case. Cases missing from either side are not compared,
+    # and neither are changes too small to tell from noise
+    regressions = []
+    for result in results:
+        old = baseline.get(result.case)
+        if old is None:
+            continue
+        for measure in COMPARED:
+            before, after = getattr(old, measure), getattr(result, measure)
+            if before is None or after is None or before <= 0:
+                continue
+            change = after / before - 1
+            if change > threshold and after - before > COMPARED[measure]:
+                regressions.append(Regression(result.case, measure, before, after, change))
+    return regressions
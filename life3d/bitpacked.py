@@ -0,0 +1,381 @@
+"""
+
+This module defines a bit-packed engine for the 3D Game of Life.
+The alive cells are stored one bit per cell, 64 cells along the Z axis to a
+uint64 word, so a 1000**3 grid takes 125 MB. Neighbour counts are computed
+on the packed words with bit-sliced adders: each count is held as five bit
+planes and every bit of a word is counted at once. The states that need more
+than one bit, the maturity ages and the dying marks, are kept in a sparse
+side table of sorted packed keys, so they cost memory per live cell rather
+than per grid cell. The grid is processed a block of X planes at a time and
+updated in place, so the temporaries stay small whatever the grid size.
+Keeping the counts between steps would cost five bits per cell, so instead
+the dying marks, which need the counts of the new generation, are only set
+when the states are next read or edited. A run that never looks at the
+states counts every generation once.
+Classes:
+    BitPackedEngine: Engine storing one bit per cell with the states in a side table.
+Functions:
+    pack_bits(alive): Packs a boolean [x, y, z] array into uint64 words along z.
+    unpack_bits(bits, grid_size): Unpacks uint64 words into a boolean [x, y, z] array.
+
+
+"""
+import random
+
+import numpy as np
+
+from .coords import coord_array, pack_array, unpack_array
+from .cycles import GenerationHash
+from .profiler import profiler
+from .rules import RuleSettings
+
+ONE = np.uint64(1)
+TOP = np.uint64(63)
+# The number of bits in a neighbour count including the cell itself, enough for 27
+COUNT_BITS = 5
+
+
+def pack_bits(alive):
+    # Pack a boolean [x, y, z] array into uint64 words along z, bit i of word w being z = 64 * w + i
+    grid_size = alive.shape[2]
+    words = -(-grid_size // 64)
+    padded = np.zeros(alive.shape[:2] + (words * 64,), dtype=bool)
+    padded[..., :grid_size] = alive
+    return np.packbits(padded, axis=2, bitorder="little").view(np.uint64)
+
+
+def unpack_bits(bits, grid_size):
+    # Unpack uint64 words along z into a boolean [x, y, z] array
+    flat = np.ascontiguousarray(bits).view(np.uint8)
+    return np.unpackbits(flat, axis=-1, bitorder="little")[..., :grid_size].astype(bool)
+
+
+def _shift_from_below(a):
+    # Move every bit up one z, so each cell sees its neighbour at z - 1
+    out = a << ONE
+    out[..., 1:] |= a[..., :-1] >> TOP
+    return out
+
+
+def _shift_from_above(a):
+    # Move every bit down one z, so each cell sees its neighbour at z + 1
+    out = a >> ONE
+    out[..., :-1] |= a[..., 1:] << TOP
+    return out
+
+
+def _add(a, b):
+    # Add two bit-sliced numbers given as lists of bit planes, least significant first
+    if len(a) < len(b):
+        a, b = b, a
+    total = []
+    carry = None
+    for i in range(len(a)):
+        x = a[i]
+        y = b[i] if i < len(b) else None
+        if y is None and carry is None:
+            total.append(x)
+            continue
+        if y is None:
+            y, carry = carry, None
+        s = x ^ y
+        c = x & y
+        if carry is not None:
+            c |= s & carry
+            s ^= carry
+        total.append(s)
+        carry = c
+    if carry is not None:
+        total.append(carry)
+    return total
+
+
+def _column_totals(planes):
+    # Sum the 3x3x3 box of every cell, itself included, as COUNT_BITS bit planes
+    # planes holds the words of X planes lo - 1 to hi inclusive, the result is for lo to hi
+    # Along z: the cell and its two neighbours, a full adder giving a 2 bit count
+    below, above = _shift_from_below(planes), _shift_from_above(planes)
+    z = [below ^ planes ^ above, (below & planes) | (above & (below ^ planes))]
+    # Along y: the rows either side, with nothing beyond the edge of the grid
+    y = z
+    for step in (1, -1):
+        shifted = []
+        for plane in z:
+            moved = np.zeros_like(plane)
+            if step == 1:
+                moved[:, 1:] = plane[:, :-1]
+            else:
+                moved[:, :-1] = plane[:, 1:]
+            shifted.append(moved)
+        y = _add(y, shifted)
+    # Along x: the planes either side, which the caller passed as a halo
+    x = _add(_add([p[:-2] for p in y], [p[1:-1] for p in y]), [p[2:] for p in y])
+    while len(x) < COUNT_BITS:
+        x.append(np.zeros_like(x[0]))
+    return x[:COUNT_BITS]
+
+
+def _member(totals, values):
+    # Return the words whose bits are set where the bit-sliced total is one of values
+    result = np.zeros_like(totals[0])
+    for value in values:
+        match = ~np.zeros_like(totals[0])
+        for i, plane in enumerate(totals):
+            match &= plane if (value >> i) & 1 else ~plane
+        result |= match
+    return result
+
+
+class BitPackedEngine(RuleSettings, GenerationHash):
+    """
+    Bit-packed 3D Game of Life engine.
+    It gives the same cells and states as SparseEngine and DenseEngine. The
+    alive cells are one bit each in bits, indexed [x, y, word]. The state of
+    every live cell is in the side table keys/states, sorted by packed key:
+    1 is newly born, greater than 1 is alive and mature, -1 is dead next cycle.
+    Cells outside the grid are ignored.
+    Attributes:
+        grid_size (int): The size of the grid along each axis. Changing it keeps the cells that still fit.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+        rule (Rule): The rule compiled from the rates, or set from a rulestring.
+        generation (int): The number of steps taken since the last clear or load.
+        bits (ndarray): The uint64 words of the alive cells, 64 cells along z to a word.
+        keys (ndarray): The sorted packed keys of the live cells.
+        states (ndarray): The state of each cell in keys. The last step's dying marks are set on first read.
+        block_words (int): The rough number of words processed at once, which bounds the temporaries.
+        hash (int): The Zobrist hash of the live cells, kept up to date by step once read.
+    Methods:
+        clear(): Removes every cell from the grid.
+        set_cell(x, y, z, value=1): Sets the state of a cell.
+        remove_cell(x, y, z): Removes a cell from the grid.
+        toggle_cell(x, y, z): Toggles a cell between alive and dead.
+        load_cells(cells): Replaces the grid with newly born cells.
+        set_cells(coords, states): Replaces the grid with cells of the given states.
+        randomize(count, rng=random): Replaces the grid with randomly placed cells.
+        cells(): Iterates over (x, y, z, state) for every live cell.
+        cell_arrays(): Returns the coordinates and states of the live cells as arrays.
+        step(): Advances the game by one generation.
+    """
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2, block_words=1 << 16):
+        self._set_rates(birthrate, deathrate, aliverate)
+        self.block_words = block_words
+        self.generation = 0
+        self._grid_size = grid_size
+        self.bits = np.zeros((grid_size, grid_size, self.words), dtype=np.uint64)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.states = np.zeros(0, dtype=np.int32)
+        # The rule the last step's dying marks are still to be set with, or None
+        self._unmarked = None
+
+    @property
+    def words(self):
+        # The number of uint64 words along z
+        return -(-self._grid_size // 64)
+
+    @property
+    def grid_size(self):
+        return self._grid_size
+
+    @grid_size.setter
+    def grid_size(self, value):
+        # Reallocate the words, keeping the cells that fit in the new size
+        if value == self._grid_size:
+            return
+        coords, states = self.cell_arrays()
+        inside = np.all((coords >= 0) & (coords < value), axis=1)
+        self._grid_size = value
+        self.bits = np.zeros((value, value, self.words), dtype=np.uint64)
+        self._set_cells(coords[inside], states[inside])
+
+    @property
+    def population(self):
+        # The number of live cells
+        return len(self.keys)
+
+    def in_bounds(self, x, y, z):
+        # Check a coordinate lies inside the grid
+        return 0 <= x < self._grid_size and 0 <= y < self._grid_size and 0 <= z < self._grid_size
+
+    def clear(self):
+        # Remove every cell from the grid
+        self.bits[...] = 0
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.states = np.zeros(0, dtype=np.int32)
+        self._unmarked = None
+        self._hash = None
+        self.generation = 0
+
+    def set_cell(self, x, y, z, value=1):
+        # Set the state of a single cell
+        x, y, z = int(x), int(y), int(z)
+        if not self.in_bounds(x, y, z):
+            return
+        self._mark_dying()
+        self._hash = None
+        self.bits[x, y, z // 64] |= ONE << np.uint64(z % 64)
+        key = pack_array([(x, y, z)])[0]
+        index = np.searchsorted(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            self.states[index] = value
+        else:
+            self.keys = np.insert(self.keys, index, key)
+            self.states = np.insert(self.states, index, value)
+
+    def remove_cell(self, x, y, z):
+        # Remove a single cell, doing nothing if it is not alive
+        x, y, z = int(x), int(y), int(z)
+        if not self.in_bounds(x, y, z):
+            return
+        self._mark_dying()
+        self._hash = None
+        self.bits[x, y, z // 64] &= ~(ONE << np.uint64(z % 64))
+        key = pack_array([(x, y, z)])[0]
+        index = np.searchsorted(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            self.keys = np.delete(self.keys, index)
+            self.states = np.delete(self.states, index)
+
+    def toggle_cell(self, x, y, z):
+        # Toggle a cell between alive and dead
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z) and (int(self.bits[x, y, z // 64]) >> (z % 64)) & 1:
+            self.remove_cell(x, y, z)
+        else:
+            self.set_cell(x, y, z)
+
+    def load_cells(self, cells):
+        # Replace the grid with newly born cells at the given coordinates
+        coords = coord_array(cells)
+        self.set_cells(coords, np.ones(len(coords), dtype=np.int32))
+
+    def set_cells(self, coords, states):
+        # Replace the grid with cells of the given states, the last state given for a cell wins
+        self.clear()
+        self._set_cells(coords, states)
+
+    def randomize(self, count, rng=random):
+        # Replace the grid with count randomly placed cells
+        self.load_cells([(rng.randrange(self._grid_size), rng.randrange(self._grid_size),
+                          rng.randrange(self._grid_size)) for i in range(count)])
+
+    def _set_cells(self, coords, states):
+        # Set many cells at once on an empty grid, the last state given for a cell wins
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        inside = np.all((coords >= 0) & (coords < self._grid_size), axis=1)
+        coords, states = coords[inside], np.asarray(states, dtype=np.int32)[inside]
+        keys = pack_array(coords)
+        # Keep the last occurrence of each key
+        order = np.argsort(keys, kind="stable")[::-1]
+        keys, first = np.unique(keys[order], return_index=True)
+        coords, states = coords[order][first], states[order][first]
+        x, y, z = coords[:, 0], coords[:, 1], coords[:, 2]
+        np.bitwise_or.at(self.bits, (x, y, z // 64), ONE << (z % 64).astype(np.uint64))
+        self.keys, self.states = keys, states
+        self._hash = None
+
+    def cells(self):
+        # Iterate over the coordinates and state of every live cell
+        coords, states = self.cell_arrays()
+        for (x, y, z), state in zip(coords.tolist(), states.tolist()):
+            yield x, y, z, state
+
+    def cell_arrays(self):
+        # Return an (N, 3) int64 array of coordinates and an int32 array of states
+        self._mark_dying()
+        return unpack_array(self.keys), self.states.copy()
+
+    def _blocks(self):
+        # Yield the X plane ranges processed together
+        per_plane = max(1, self._grid_size * self.words)
+        size = max(1, self.block_words // per_plane)
+        for lo in range(0, self._grid_size, size):
+            yield lo, min(lo + size, self._grid_size)
+
+    def _padded(self, lo, hi, below):
+        # Return the words of X planes lo - 1 to hi inclusive, zero beyond the grid
+        # below is the old plane lo - 1, saved because it may already be overwritten
+        planes = np.zeros((hi - lo + 2,) + self.bits.shape[1:], dtype=np.uint64)
+        if below is not None:
+            planes[0] = below
+        planes[1:hi - lo + 1] = self.bits[lo:hi]
+        if hi < self._grid_size:
+            planes[-1] = self.bits[hi]
+        return planes
+
+    def _valid(self):
+        # The words with a bit set for every z inside the grid
+        valid = np.full(self.words, ~np.uint64(0), dtype=np.uint64)
+        if self._grid_size % 64:
+            valid[-1] = (ONE << np.uint64(self._grid_size % 64)) - ONE
+        return valid
+
+    def _block_keys(self, words, lo):
+        # Return the sorted packed keys of the set bits of the words of X planes from lo
+        xs, ys, zs = np.nonzero(unpack_bits(words, self._grid_size))
+        return pack_array(np.stack([xs + lo, ys, zs], axis=1))
+
+    def step(self):
+        # Advance the game by one step
+        # Each count below includes the cell itself, so the rules are shifted by one for live cells
+        rule = self.rule
+        if self._unmarked is not None and (self._unmarked != rule or self._unmarked.dying & rule.survive):
+            # A marked cell could survive as state 0, so the marks are needed
+            self._mark_dying()
+        self._unmarked = None
+        survive_totals = [n + 1 for n in sorted(rule.survive)]
+        birth_totals = sorted(rule.birth)
+        valid = self._valid()
+        below = None
+        new_keys = []
+        for lo, hi in self._blocks():
+            planes = self._padded(lo, hi, below)
+            below = self.bits[hi - 1].copy()
+            if not planes.any():
+                # Nothing alive in or next to the block, so nothing can be born in it
+                continue
+            with profiler.section("neighbour counts"):
+                totals = _column_totals(planes)
+            alive = planes[1:-1]
+            new = ((alive & _member(totals, survive_totals)) | (~alive & _member(totals, birth_totals))) & valid
+            self.bits[lo:hi] = new
+            if new.any():
+                new_keys.append(self._block_keys(new, lo))
+
+        # Carry the states over from the side table: survivors age, new cells are born at 1
+        keys = np.concatenate(new_keys) if new_keys else np.zeros(0, dtype=np.int64)
+        states = np.ones(len(keys), dtype=np.int32)
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.keys):
+            index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[index] == keys
+            states[found] = self.states[index[found]] + 1
+        if self._hash is not None:
+            # The born cells are the new keys not found, the dead cells the old keys not found
+            died = np.ones(len(self.keys), dtype=bool)
+            if len(self.keys):
+                died[index[found]] = False
+            self._hash_changes(np.concatenate([keys[~found], self.keys[died]]))
+        self.keys, self.states = keys, states
+
+        # The dying marks are set when the states are next needed
+        self._unmarked = rule
+        self.generation += 1
+
+    def _mark_dying(self):
+        # Set the dying marks of the last step, which need the counts of the grid as it is now
+        rule = self._unmarked
+        if rule is None:
+            return
+        self._unmarked = None
+        dying_totals = [n + 1 for n in sorted(rule.dying)]
+        for lo, hi in self._blocks():
+            if not self.bits[lo:hi].any():
+                continue
+            planes = self._padded(lo, hi, self.bits[lo - 1] if lo else None)
+            dying = planes[1:-1] & _member(_column_totals(planes), dying_totals)
+            if dying.any():
+                self.states[np.searchsorted(self.keys, self._block_keys(dying, lo))] = -1
@@ -0,0 +1,288 @@
+"""
+
+This module defines an unbounded chunked engine for the 3D Game of Life.
+Space is split into chunks of 16 x 16 x 16 cells, and only the chunks
+holding a live cell are stored, as rows of stacked NumPy blocks found from
+their chunk coordinates through a hash map. A chunk is allocated when a cell
+is set or born in it and freed when its last cell dies, so memory and the
+cost of a step follow the occupied chunks rather than a bounding cube, and a
+growing pattern runs on without ever hitting the edge of a grid.
+A step pads every occupied chunk, and every empty chunk with a live cell
+next to its border, with the border cells of its 26 neighbours, counts the
+neighbours of all of them in one batched box filter and applies the rules
+as DenseEngine does. The copies into the padded blocks are done offset by
+offset for every chunk at once, so a step is a fixed number of array
+operations whatever the number of chunks. As in DenseEngine the counts of
+the new generation both mark the dying cells and apply the rules next step.
+Classes:
+    ChunkedEngine: Engine for an unbounded grid giving the same results as SparseEngine away from its walls.
+
+
+"""
+import random
+
+import numpy as np
+
+from .coords import coord_array, pack_array, unpack_array
+from .cycles import GenerationHash
+from .dense import next_generation
+from .profiler import profiler
+from .rules import RuleSettings
+
+# The edge length of a chunk, a power of two so chunk coordinates are a shift
+CHUNK_BITS = 4
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_SHAPE = (CHUNK_SIZE,) * 3
+LAST = CHUNK_SIZE - 1
+
+
+def _offset_slices(d):
+    # For a chunk s and its neighbour t = s + d along one axis, the slice of s next to t and
+    # where it lands in the block of t padded by one cell on each side
+    if d == 1:
+        return slice(LAST, CHUNK_SIZE), slice(0, 1)
+    if d == -1:
+        return slice(0, 1), slice(CHUNK_SIZE + 1, CHUNK_SIZE + 2)
+    return slice(0, CHUNK_SIZE), slice(1, CHUNK_SIZE + 1)
+
+
+# The 27 chunk offsets of a chunk and its neighbours, with the slices copied for each
+OFFSETS = [((dx, dy, dz), tuple(zip(*[_offset_slices(d) for d in (dx, dy, dz)])))
+           for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+
+def _border(blocks, d, axis):
+    # Reduce a stack of blocks along an axis to the cells next to the neighbour at offset d
+    if d == 1:
+        return np.take(blocks, LAST, axis=axis)
+    if d == -1:
+        return np.take(blocks, 0, axis=axis)
+    return blocks.any(axis=axis)
+
+
+class ChunkedEngine(RuleSettings, GenerationHash):
+    """
+    Chunked 3D Game of Life engine on an unbounded grid.
+    It gives the same cells and states as SparseEngine for patterns that stay
+    clear of the walls of SparseEngine's grid, and keeps going where those
+    patterns would hit them. The live chunks are rows of the stacked alive and
+    state blocks, 1 is newly born, greater than 1 is alive and mature, -1 is
+    dead next cycle. Cells are limited to the range of life3d.coords keys,
+    about a million cells either side of the origin along each axis.
+    Attributes:
+        grid_size (int): The size of the region randomize fills and the viewer frames. Cells outside it live on.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+        rule (Rule): The rule compiled from the rates, or set from a rulestring.
+        generation (int): The number of steps taken since the last clear or load.
+        chunks (ndarray): The (N, 3) chunk coordinates of the live chunks, the row order of the blocks.
+        alive (ndarray): The (N, 16, 16, 16) boolean blocks of the live chunks, indexed [row, x, y, z].
+        state (ndarray): The (N, 16, 16, 16) int32 blocks of the cell states.
+        hash (int): The Zobrist hash of the live cells, kept up to date by step once read.
+    Methods:
+        clear(): Removes every cell from the grid.
+        set_cell(x, y, z, value=1): Sets the state of a cell.
+        remove_cell(x, y, z): Removes a cell from the grid.
+        toggle_cell(x, y, z): Toggles a cell between alive and dead.
+        load_cells(cells): Replaces the grid with newly born cells.
+        set_cells(coords, states): Replaces the grid with cells of the given states.
+        randomize(count, rng=random): Replaces the grid with randomly placed cells.
+        cells(): Iterates over (x, y, z, state) for every live cell.
+        cell_arrays(): Returns the coordinates and states of the live cells as arrays.
+        step(): Advances the game by one generation.
+    """
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2):
+        self.grid_size = grid_size
+        self._set_rates(birthrate, deathrate, aliverate)
+        self.clear()
+
+    @property
+    def population(self):
+        # The number of live cells
+        self._stack()
+        return int(np.count_nonzero(self.alive))
+
+    def clear(self):
+        # Remove every cell from the grid
+        self.chunks = np.zeros((0, 3), dtype=np.int64)
+        self.alive = np.zeros((0,) + CHUNK_SHAPE, dtype=bool)
+        self.state = np.zeros((0,) + CHUNK_SHAPE, dtype=np.int32)
+        # The row of each chunk by chunk coordinates, built when an edit needs it
+        self._index = {}
+        # Chunks allocated by edits since the blocks were last stacked, by chunk coordinates
+        self._pending = {}
+        # The candidate chunks and neighbour counts of the current generation, or None after an edit
+        self._counts = None
+        self._hash = None
+        self.generation = 0
+
+    def _rows(self):
+        # The hash map from chunk coordinates to rows, rebuilt after a step
+        if self._index is None:
+            self._index = dict(zip(map(tuple, self.chunks.tolist()), range(len(self.chunks))))
+        return self._index
+
+    def _block(self, x, y, z, create):
+        # Return the alive and state blocks of the chunk of a cell and its local coordinates,
+        # allocating the chunk if create is set, or None if it is not allocated
+        x, y, z = int(x), int(y), int(z)
+        key = (x >> CHUNK_BITS, y >> CHUNK_BITS, z >> CHUNK_BITS)
+        local = (x & LAST, y & LAST, z & LAST)
+        row = self._rows().get(key)
+        if row is not None:
+            return self.alive[row], self.state[row], local
+        blocks = self._pending.get(key)
+        if blocks is None:
+            if not create:
+                return None
+            # New chunks wait to be stacked in one go, so setting cells one by one stays cheap
+            blocks = self._pending[key] = (np.zeros(CHUNK_SHAPE, dtype=bool), np.zeros(CHUNK_SHAPE, dtype=np.int32))
+        return blocks[0], blocks[1], local
+
+    def _stack(self):
+        # Append the chunks allocated by edits to the stacked blocks
+        if not self._pending:
+            return
+        keys = list(self._pending)
+        self.chunks = np.concatenate([self.chunks, np.array(keys, dtype=np.int64).reshape(-1, 3)])
+        self.alive = np.concatenate([self.alive, np.stack([self._pending[key][0] for key in keys])])
+        self.state = np.concatenate([self.state, np.stack([self._pending[key][1] for key in keys])])
+        self._pending = {}
+        self._index = None
+
+    def _edited(self):
+        # Forget the counts and the hash after an edit
+        self._counts = None
+        self._hash = None
+
+    def set_cell(self, x, y, z, value=1):
+        # Set the state of a single cell, allocating its chunk if needed
+        alive, state, local = self._block(x, y, z, True)
+        alive[local] = True
+        state[local] = value
+        self._edited()
+
+    def remove_cell(self, x, y, z):
+        # Remove a single cell, doing nothing if it is not alive
+        # An emptied chunk is freed by the next step
+        found = self._block(x, y, z, False)
+        if found is not None:
+            alive, state, local = found
+            alive[local] = False
+            state[local] = 0
+            self._edited()
+
+    def toggle_cell(self, x, y, z):
+        # Toggle a cell between alive and dead
+        found = self._block(x, y, z, False)
+        if found is not None and found[0][found[2]]:
+            self.remove_cell(x, y, z)
+        else:
+            self.set_cell(x, y, z)
+
+    def load_cells(self, cells):
+        # Replace the grid with newly born cells at the given coordinates
+        coords = coord_array(cells)
+        self.set_cells(coords, np.ones(len(coords), dtype=np.int32))
+
+    def set_cells(self, coords, states):
+        # Replace the grid with cells of the given states
+        # The cells are grouped by chunk and written in one go
+        self.clear()
+        coords = coord_array(coords)
+        if len(coords) == 0:
+            return
+        keys, rows = np.unique(pack_array(coords >> CHUNK_BITS), return_inverse=True)
+        self.chunks = unpack_array(keys)
+        self.alive = np.zeros((len(keys),) + CHUNK_SHAPE, dtype=bool)
+        self.state = np.zeros((len(keys),) + CHUNK_SHAPE, dtype=np.int32)
+        x, y, z = (coords & LAST).T
+        self.alive[rows, x, y, z] = True
+        self.state[rows, x, y, z] = np.asarray(states, dtype=np.int32)
+        self._index = None
+
+    def randomize(self, count, rng=random):
+        # Replace the grid with count cells placed at random inside grid_size
+        self.load_cells([(rng.randrange(self.grid_size), rng.randrange(self.grid_size),
+                          rng.randrange(self.grid_size)) for i in range(count)])
+
+    def cells(self):
+        # Iterate over the coordinates and state of every live cell
+        coords, states = self.cell_arrays()
+        for (x, y, z), state in zip(coords.tolist(), states.tolist()):
+            yield x, y, z, state
+
+    def cell_arrays(self):
+        # Return an (N, 3) int64 array of coordinates and an int32 array of states
+        self._stack()
+        rows, x, y, z = np.nonzero(self.alive)
+        coords = np.stack([x, y, z], axis=1).astype(np.int64) + (self.chunks[rows] << CHUNK_BITS)
+        return coords, self.state[rows, x, y, z]
+
+    def _count(self):
+        # Return the chunks whose cells may change next step and the neighbour counts of their cells
+        # The live chunks come first in their row order, followed by the empty chunks next to a live cell
+        chunks, alive = self.chunks, self.alive
+        extra = []
+        for dx in (-1, 0, 1):
+            across_x = _border(alive, dx, 1)
+            for dy in (-1, 0, 1):
+                across_y = _border(across_x, dy, 1)
+                for dz in (-1, 0, 1):
+                    if dx or dy or dz:
+                        extra.append(chunks[_border(across_y, dz, 1)] + (dx, dy, dz))
+        live_keys = pack_array(chunks)
+        extra_keys = np.unique(pack_array(np.concatenate(extra))) if extra else np.zeros(0, dtype=np.int64)
+        extra_keys = extra_keys[~np.isin(extra_keys, live_keys)]
+        candidates = np.concatenate([chunks, unpack_array(extra_keys)])
+        keys = np.concatenate([live_keys, extra_keys])
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+
+        # Copy every live chunk, and its borders, into the padded blocks of the candidates next to it
+        padded = np.zeros((len(candidates),) + (CHUNK_SIZE + 2,) * 3, dtype=np.uint8)
+        for offset, (source, target) in OFFSETS:
+            wanted = pack_array(chunks + offset)
+            place = np.minimum(np.searchsorted(sorted_keys, wanted), len(sorted_keys) - 1)
+            found = sorted_keys[place] == wanted
+            if found.any():
+                padded[(order[place[found]],) + target] = alive[(found,) + source]
+
+        # The 3x3x3 box sums of the padded blocks, one axis at a time, less the cell itself
+        box = padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]
+        box = box[:, :, :-2] + box[:, :, 1:-1] + box[:, :, 2:]
+        box = box[:, :, :, :-2] + box[:, :, :, 1:-1] + box[:, :, :, 2:]
+        box -= padded[:, 1:-1, 1:-1, 1:-1]
+        return candidates, box
+
+    def step(self):
+        # Advance the game by one step
+        # The rules are applied to every candidate chunk at once, then the emptied chunks are freed
+        rule = self.rule
+        self._stack()
+        if self._counts is None:
+            with profiler.section("neighbour counts"):
+                self._counts = self._count()
+        candidates, counts = self._counts
+        live = len(self.chunks)
+        alive = np.zeros((len(candidates),) + CHUNK_SHAPE, dtype=bool)
+        state = np.zeros((len(candidates),) + CHUNK_SHAPE, dtype=np.int32)
+        alive[:live] = self.alive
+        state[:live] = self.state
+        new_alive, new_state = next_generation(alive, state, counts, rule)
+        if self._hash is not None:
+            rows, x, y, z = np.nonzero(new_alive != alive)
+            self._hash_changes(pack_array(np.stack([x, y, z], axis=1) + (candidates[rows] << CHUNK_BITS)))
+        kept = new_alive.any(axis=(1, 2, 3))
+        self.chunks, self.alive, self.state = candidates[kept], new_alive[kept], new_state[kept]
+        self._index = None
+
+        # Count the new generation once: the counts mark the cells that will die next cycle
+        # now and apply the rules next step
+        with profiler.section("neighbour counts"):
+            self._counts = self._count()
+        marks = self.alive & rule.marks[self._counts[1][:len(self.chunks)]]
+        self.state[marks] = -1
+        self.generation += 1
@@ -0,0 +1,283 @@
+"""
+
+This module is the command line entry point for running the 3D Game of Life
+without a window.
+Usage:
+    python -m life3d run cube.lif --generations 1000
+    python -m life3d run cube.lif --generations 1000 --record cube.lifr
+    python -m life3d run cube.lif --generations 1000 --profile --trace cube.trace.json
+    python -m life3d info cube.lifr
+    python -m life3d convert cube.lif cube.lifb
+    python -m life3d list . patterns/
+    python -m life3d sweep --population 100 --grid-size 20 -n 200 -o sweep.csv
+    python -m life3d bench -o bench.json --baseline baseline.json
+Functions:
+    main(argv=None): Parses the command line, runs the chosen command and returns its exit status.
+
+
+"""
+import argparse
+import os
+import time
+
+from . import ENGINES
+from .benchmark import DENSITIES, SIZES, compare, read_results, run_suite
+from .benchmark import write_results as write_benchmark
+from .library import PatternLibrary, default_cache_path
+from .patterns import convert_pattern, read_pattern
+from .profiler import profiler
+from .recording import COMPRESSIONS, Recorder, Recording
+from .sweep import parse_range, random_seed, sweep, write_results
+from .rules import Rule
+
+# The .lif settings that belong to the engine rather than the viewer
+ENGINE_SETTINGS = ("grid_size", "birthrate", "deathrate", "aliverate")
+
+
+def load_engine(file_path, args):
+    # Create an engine from a .lif or .lifb file, letting the command line override its settings
+    cells, settings = read_pattern(file_path)
+    options = {i: settings[i] for i in ENGINE_SETTINGS if i in settings}
+    if args.workers is not None and args.engine == "parallel":
+        options["workers"] = args.workers
+    engine = ENGINES[args.engine](**options)
+    for i in ENGINE_SETTINGS:
+        value = getattr(args, i)
+        if value is not None:
+            setattr(engine, i, value)
+    # A rulestring replaces the rates, from the command line or else from the file
+    if args.rule is not None:
+        engine.rule = args.rule
+    elif settings.get("rulestring"):
+        engine.rule = Rule.parse(settings["rulestring"])
+    engine.load_cells(cells)
+    return engine
+
+
+def parse_rule(text):
+    # Parse a rulestring argument, reporting a bad one as a usage error
+    try:
+        return Rule.parse(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def command_run(args):
+    # Run a pattern for a number of generations and print the timing
+    engine = load_engine(args.pattern, args)
+    print(f"Loaded {args.pattern} into the {args.engine} engine: "
+          f"{engine.population} cells, grid size {engine.grid_size}, rule {engine.rule}")
+    recorder = None
+    if args.record:
+        recorder = Recorder.for_engine(args.record, engine, args.keyframe_interval, args.compression)
+        recorder.record_engine(engine)
+    if args.trace:
+        profiler.start_trace(args.trace)
+    profiler.enabled = args.profile or bool(args.trace)
+    start = time.perf_counter()
+    advance = getattr(engine, "advance", None)
+    if advance is not None and not args.verbose and recorder is None and not profiler.enabled:
+        # Engines that can jump run every generation in one call
+        advance(args.generations)
+    else:
+        for i in range(args.generations):
+            with profiler.section("step"):
+                engine.step()
+            if profiler.enabled:
+                profiler.counter("cells", engine.population)
+            if recorder is not None:
+                with profiler.section("record"):
+                    recorder.record_engine(engine)
+            if args.verbose:
+                print(f"Generation {engine.generation}: {engine.population} cells")
+    elapsed = time.perf_counter() - start
+    rate = args.generations / elapsed if elapsed > 0 else float("inf")
+    print(f"Ran {args.generations} generations in {elapsed:.3f} s "
+          f"({rate:.1f} generations/s), final population {engine.population}")
+    profiler.stop_trace()
+    if args.profile:
+        for name, timer in sorted(profiler.timers.items(), key=lambda item: -item[1].total):
+            print(f"    {name:20} {timer.count:8} calls {1000 * timer.total:10.1f} ms "
+                  f"{1000 * timer.total / timer.count:8.3f} ms/call")
+    if args.trace:
+        print(f"Wrote a trace of every generation to {args.trace}")
+    if recorder is not None:
+        recorder.close()
+        print(f"Recorded {recorder.frames} frames ({recorder.keyframes} keyframes) to {args.record}: "
+              f"{os.path.getsize(args.record)} bytes")
+    close = getattr(engine, "close", None)
+    if close is not None:
+        close()
+
+
+def command_info(args):
+    # Print the settings and size of a recording
+    with Recording(args.recording) as recording:
+        print(f"{args.recording}: {len(recording)} frames, {int(recording.keyframes.sum())} keyframes, "
+              f"{os.path.getsize(args.recording)} bytes")
+        for name, value in recording.header.items():
+            print(f"    {name}: {value}")
+        if len(recording):
+            first, last = recording.generations[0], recording.generations[-1]
+            print(f"Generations {first} to {last}, population {len(recording.frame(0)[0])} "
+                  f"to {len(recording.frame(-1)[0])}")
+
+
+def command_convert(args):
+    # Convert a pattern between the JSON .lif and the binary .lifb formats
+    start = time.perf_counter()
+    count = convert_pattern(args.source, args.target)
+    print(f"Converted {count} cells from {args.source} to {args.target} in {time.perf_counter() - start:.3f} s: "
+          f"{os.path.getsize(args.source)} to {os.path.getsize(args.target)} bytes")
+
+
+def command_list(args):
+    # List the patterns of a set of directories with their sizes and rules, using the index cache
+    library = PatternLibrary(args.directories, None if args.no_cache else default_cache_path())
+    for name in library.names():
+        info = library.info(name)
+        settings = info.settings
+        rule = settings.get("rulestring") or (f"rates {settings.get('birthrate')}/{settings.get('deathrate')}/"
+                                               f"{settings.get('aliverate')}")
+        print(f"{name:24} {info.count:10} cells  box {info.box}  grid {settings.get('grid_size')}  {rule}")
+    library.save_index()
+
+
+def command_sweep(args):
+    # Run a seed under every combination of the rates on a process pool and write a CSV table
+    if args.pattern is not None:
+        cells, settings = read_pattern(args.pattern)
+        grid_size = args.grid_size or settings.get("grid_size", 10)
+    else:
+        grid_size = args.grid_size or 10
+        cells = random_seed(grid_size, args.population, args.seed)
+    births, deaths, alives = parse_range(args.birth), parse_range(args.death), parse_range(args.alive)
+    print(f"Sweeping {len(births) * len(deaths) * len(alives)} rate combinations of {len(cells)} cells "
+          f"on grid size {grid_size} for {args.generations} generations")
+    start = time.perf_counter()
+
+    def progress(done, total):
+        if done == total or done % max(1, total // 20) == 0:
+            print(f"{done}/{total} rules, {time.perf_counter() - start:.1f} s", flush=True)
+
+    results = sweep(cells, grid_size, args.generations, births, deaths, alives, args.engine, args.workers, progress)
+    count = write_results(args.output, results)
+    print(f"Wrote {count} rows to {args.output} in {time.perf_counter() - start:.1f} s")
+
+
+def command_bench(args):
+    # Time the engines and the scene on random populations and patterns, write the results as JSON
+    # and compare them with a baseline, returning 1 if any regressed past the threshold
+    patterns = args.patterns
+    if not patterns:
+        library = PatternLibrary(["."], None)
+        patterns = [library.path(name) for name in library.names()]
+    baseline = read_results(args.baseline) if args.baseline else None
+
+    def progress(result):
+        if result.skipped:
+            print(f"{result.case:28} skipped, {result.skipped}", flush=True)
+            return
+        scene = "" if result.scene_build_ms is None else (f", scene build {result.scene_build_ms:.2f} ms "
+                                                          f"update {result.scene_update_ms:.2f} ms")
+        print(f"{result.case:28} {result.cells:8} cells  {result.step_ms:9.2f} ms/step  "
+              f"{result.generations_per_second:8.1f} gen/s  {result.cells_per_second:12.0f} cells/s{scene}, "
+              f"peak {result.peak_mb:.1f} MiB", flush=True)
+
+    sizes = [int(i) for i in args.sizes.split(",")]
+    densities = [float(i) for i in args.densities.split(",")]
+    results = list(run_suite(args.engines or ["sparse", "dense"], sizes, densities, patterns, args.generations,
+                             args.max_seconds, args.max_cells, args.max_volume, args.seed, progress))
+    write_benchmark(args.output, results)
+    print(f"Wrote {len(results)} results to {args.output}")
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"Regression {regression.case} {regression.measure}: {regression.baseline:.3f} to "
+              f"{regression.value:.3f} ({regression.change:+.0%})")
+    print(f"{len(regressions)} regressions over {args.threshold:.0%} from {args.baseline}")
+    return 1 if regressions else 0
+
+
+def build_parser():
+    # Build the argument parser for every command
+    parser = argparse.ArgumentParser(prog="life3d", description="Headless 3D Game of Life")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run a .lif or .lifb pattern for N generations")
+    run.add_argument("pattern", help="the .lif or .lifb file to load")
+    run.add_argument("-n", "--generations", type=int, default=100)
+    run.add_argument("-e", "--engine", choices=sorted(ENGINES), default="sparse")
+    run.add_argument("--workers", type=int, help="the number of processes for the parallel engine")
+    run.add_argument("--grid-size", dest="grid_size", type=int)
+    run.add_argument("--birthrate", type=int)
+    run.add_argument("--deathrate", type=int)
+    run.add_argument("--aliverate", type=int)
+    run.add_argument("--rule", type=parse_rule, help="a B/S rulestring such as B5/S45, replacing the rates")
+    run.add_argument("-v", "--verbose", action="store_true", help="print the population every generation")
+    run.add_argument("--record", metavar="PATH", help="record every generation to a recording file")
+    run.add_argument("--profile", action="store_true", help="print the time spent in each hot path")
+    run.add_argument("--trace", metavar="PATH", help="write the time of every generation to a Chrome trace file")
+    run.add_argument("--keyframe-interval", dest="keyframe_interval", type=int, default=100,
+                     help="the most frames between keyframes of the recording")
+    run.add_argument("--compression", choices=COMPRESSIONS, default="zlib",
+                     help="how the recording is compressed, zstd when the zstandard package is installed")
+    run.set_defaults(func=command_run)
+
+    info = commands.add_parser("info", help="describe a recording")
+    info.add_argument("recording", help="the recording file to read")
+    info.set_defaults(func=command_info)
+
+    convert = commands.add_parser("convert", help="convert a pattern between .lif and .lifb")
+    convert.add_argument("source", help="the .lif or .lifb file to read")
+    convert.add_argument("target", help="the file to write, binary if it ends in .lifb and JSON otherwise")
+    convert.set_defaults(func=command_convert)
+
+    patterns = commands.add_parser("list", help="list the patterns of directories and LIFE3D_PATTERNS")
+    patterns.add_argument("directories", nargs="*", default=["."], help="the directories to list")
+    patterns.add_argument("--no-cache", dest="no_cache", action="store_true",
+                          help="parse every pattern instead of using the index cache")
+    patterns.set_defaults(func=command_list)
+
+    rates = commands.add_parser("sweep", help="run a seed under many rates and tabulate the results")
+    rates.add_argument("pattern", nargs="?", help="the .lif or .lifb seed, or a random population if omitted")
+    rates.add_argument("--population", type=int, default=10, help="the number of random cells without a pattern")
+    rates.add_argument("--seed", type=int, default=0, help="the random seed for the random population")
+    rates.add_argument("--grid-size", dest="grid_size", type=int)
+    rates.add_argument("-n", "--generations", type=int, default=100)
+    rates.add_argument("--birth", default="0-24", help="the birth rates, such as 0-24 or 3,5,7")
+    rates.add_argument("--death", default="0-24", help="the death rates")
+    rates.add_argument("--alive", default="0-24", help="the alive rates")
+    rates.add_argument("-e", "--engine", choices=sorted(ENGINES), default="dense")
+    rates.add_argument("--workers", type=int, help="the number of processes")
+    rates.add_argument("-o", "--output", default="sweep.csv", help="the CSV file to write")
+    rates.set_defaults(func=command_sweep)
+
+    bench = commands.add_parser("bench", help="time the engines and the scene and compare with a baseline")
+    bench.add_argument("patterns", nargs="*",
+                       help="the pattern files to time, the .lif and .lifb files here if omitted")
+    bench.add_argument("-e", "--engine", dest="engines", action="append", choices=sorted(ENGINES),
+                       help="an engine to time, may be given more than once, sparse and dense if omitted")
+    bench.add_argument("--sizes", default=",".join(map(str, SIZES)), help="the grid sizes of the random cases")
+    bench.add_argument("--densities", default=",".join(map(str, DENSITIES)),
+                       help="the fractions of the grid filled at random")
+    bench.add_argument("-n", "--generations", type=int, default=20, help="the most generations timed in a case")
+    bench.add_argument("--max-seconds", dest="max_seconds", type=float, default=2.0,
+                       help="stop timing a case after this long, once a generation has run")
+    bench.add_argument("--max-cells", dest="max_cells", type=int, default=100000,
+                       help="skip the cases with more live cells")
+    bench.add_argument("--max-volume", dest="max_volume", type=int, default=1 << 24,
+                       help="skip the grids with more cells for the engines that allocate the whole grid")
+    bench.add_argument("--seed", type=int, default=0, help="the random seed of the random cases")
+    bench.add_argument("-o", "--output", default="bench.json", help="the JSON file to write")
+    bench.add_argument("--baseline", help="a JSON file written by an earlier run to compare with")
+    bench.add_argument("--threshold", type=float, default=0.2,
+                       help="the growth in a time or in memory reported as a regression, 0.2 for 20%%")
+    bench.set_defaults(func=command_bench)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
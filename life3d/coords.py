@@ -0,0 +1,67 @@
+"""
+
+This module packs 3D cell coordinates into single integer keys.
+Each axis gets a 21 bit field with a bias, so coordinates from -2**20 to
+2**20 - 1 fit in one int64 and negative coordinates round trip. Because the
+fields never carry into each other inside that range, moving to a neighbour
+is a single integer add of a precomputed delta.
+Functions:
+    pack(x, y, z): Packs a coordinate into an integer key.
+    unpack(key): Unpacks an integer key into a coordinate.
+    pack_array(coords): Packs an (N, 3) array of coordinates into int64 keys.
+    unpack_array(keys): Unpacks an array of int64 keys into an (N, 3) array of coordinates.
+    coord_array(cells): Turns any sequence of (x, y, z) cells into an (N, 3) int64 array.
+
+
+"""
+import numpy as np
+
+# The number of bits per axis and the bias that makes negative coordinates positive
+AXIS_BITS = 21
+BIAS = 1 << (AXIS_BITS - 1)
+MASK = (1 << AXIS_BITS) - 1
+X_SHIFT = 2 * AXIS_BITS
+Y_SHIFT = AXIS_BITS
+# The key of the coordinate (0, 0, 0)
+ORIGIN = (BIAS << X_SHIFT) | (BIAS << Y_SHIFT) | BIAS
+
+
+def pack(x, y, z):
+    # Pack a coordinate into an integer key
+    return ((int(x) + BIAS) << X_SHIFT) | ((int(y) + BIAS) << Y_SHIFT) | (int(z) + BIAS)
+
+
+def unpack(key):
+    # Unpack an integer key into a coordinate
+    return ((key >> X_SHIFT) & MASK) - BIAS, ((key >> Y_SHIFT) & MASK) - BIAS, (key & MASK) - BIAS
+
+
+def pack_array(coords):
+    # Pack an (N, 3) array of coordinates into an array of int64 keys
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3) + BIAS
+    return (coords[:, 0] << X_SHIFT) | (coords[:, 1] << Y_SHIFT) | coords[:, 2]
+
+
+def unpack_array(keys):
+    # Unpack an array of int64 keys into an (N, 3) array of coordinates
+    keys = np.asarray(keys, dtype=np.int64)
+    coords = np.empty((len(keys), 3), dtype=np.int64)
+    coords[:, 0] = (keys >> X_SHIFT) & MASK
+    coords[:, 1] = (keys >> Y_SHIFT) & MASK
+    coords[:, 2] = keys & MASK
+    coords -= BIAS
+    return coords
+
+
+def coord_array(cells):
+    # Turn an array, list or iterator of (x, y, z) cells into an (N, 3) int64 array
+    # Arrays are converted in one go rather than row by row
+    if not isinstance(cells, np.ndarray):
+        cells = list(cells)
+    return np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+
+
+# The 26 neighbour offsets of a cell and the same offsets as key deltas
+NEIGHBOR_OFFSETS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                    if not (dx == dy == dz == 0)]
+NEIGHBOR_DELTAS = [(dx << X_SHIFT) + (dy << Y_SHIFT) + dz for dx, dy, dz in NEIGHBOR_OFFSETS]
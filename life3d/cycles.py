@@ -0,0 +1,129 @@
+"""
+
+This module detects when a pattern dies out, settles or starts repeating.
+Every generation gets a 64 bit Zobrist style hash: each cell position maps to
+a pseudo random 64 bit value, and the hash of a generation is the XOR of the
+values of its live cells. A step only has to XOR in the values of the cells
+that were born or died, so the engines keep the hash up to date for the cost
+of their changes. The next generation only depends on which cells are alive,
+so once a hash comes round again the pattern repeats from there on: after one
+generation it is a still life, after more an oscillator of that period.
+Classes:
+    GenerationHash: Mixin giving an engine the hash of its live cells.
+    Cycle: A detected end state, its kind, period and first generation.
+    CycleDetector: Finds extinction, still lifes and oscillators from the hashes of recent generations.
+Functions:
+    zobrist(keys): Returns the XOR of the Zobrist values of an array of packed keys.
+    describe(cycle): Describes a cycle for the HUD.
+
+
+"""
+from collections import deque, namedtuple
+
+import numpy as np
+
+from .coords import pack_array
+
+# The kinds of cycle
+EXTINCT = "extinct"
+STILL = "still life"
+OSCILLATOR = "oscillator"
+
+# A detected end state. period is 1 for a still life or an extinct pattern, start is the
+# first generation of the repeating state
+Cycle = namedtuple("Cycle", ["kind", "period", "start"])
+
+
+def zobrist(keys):
+    # Return the XOR of the Zobrist values of an array of packed keys as an int
+    # A cell's value is the splitmix64 hash of its key, so no table is needed for an unbounded grid
+    z = np.asarray(keys, dtype=np.int64).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return int(np.bitwise_xor.reduce(z)) if len(z) else 0
+
+
+class GenerationHash:
+    """
+    Mixin giving an engine the hash of its live cells.
+    The hash is worked out from every cell the first time it is read, then
+    kept up to date by the engine's step XORing in the cells that changed.
+    An edit forgets it, so it is worked out again when next read. Until the
+    hash is first read, stepping does no hashing at all.
+    Attributes:
+        hash (int): The Zobrist hash of the live cells.
+    """
+
+    _hash = None
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            coords, _ = self.cell_arrays()
+            self._hash = zobrist(pack_array(coords))
+        return self._hash
+
+    def _hash_changes(self, keys):
+        # XOR the packed keys of the cells born or died into the hash, if it is being kept
+        if self._hash is not None:
+            self._hash ^= zobrist(keys)
+
+
+class CycleDetector:
+    """
+    Finds extinction, still lifes and oscillators from the hashes of recent generations.
+    Call update after every generation. A gap in the generations, such as a
+    jump or a load, starts the detection again.
+    Attributes:
+        history (int): The number of recent generations remembered, the longest period found.
+        cycle (Cycle): The end state found, or None while the pattern is still changing.
+    Methods:
+        update(generation, hash, population): Adds a generation and returns the cycle found, or None.
+        reset(): Forgets every generation.
+    """
+
+    def __init__(self, history=256):
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        # Forget every generation
+        self._seen = {}
+        self._order = deque()
+        self._last = None
+        self.cycle = None
+
+    def update(self, generation, hash, population):
+        # Add the hash of a generation and return the cycle found, or None
+        if self._last is not None and generation != self._last + 1:
+            self.reset()
+        self._last = generation
+        if population == 0:
+            if self.cycle is None or self.cycle.kind != EXTINCT:
+                self.cycle = Cycle(EXTINCT, 1, generation)
+            return self.cycle
+        first = self._seen.get(hash)
+        if first is None:
+            self.cycle = None
+        elif self.cycle is None or self.cycle.period != generation - first:
+            period = generation - first
+            self.cycle = Cycle(STILL if period == 1 else OSCILLATOR, period, first)
+        self._seen[hash] = generation
+        self._order.append((hash, generation))
+        while len(self._order) > self.history:
+            old, when = self._order.popleft()
+            if self._seen.get(old) == when:
+                del self._seen[old]
+        return self.cycle
+
+
+def describe(cycle):
+    # Describe a cycle for the HUD
+    if cycle is None:
+        return ""
+    if cycle.kind == EXTINCT:
+        return f"Extinct at generation {cycle.start}"
+    if cycle.kind == STILL:
+        return f"Still life since generation {cycle.start}"
+    return f"Oscillator with period {cycle.period} since generation {cycle.start}"
@@ -0,0 +1,400 @@
+"""
+
+This module defines a dense NumPy engine for the 3D Game of Life.
+The whole grid is held in arrays and the 26 neighbour counts of every cell
+are computed in one batched pass with a separable 3x3x3 box filter, so a
+step costs a handful of array operations instead of a Python loop per cell.
+Only the active part of the grid is stepped. The grid is split into chunks
+and a cell can only change if a cell next to it changed in the last
+generation, so just the chunks next to a change are processed; empty and
+settled chunks are skipped and a small pattern in a large grid steps in
+time that follows the pattern, not the grid.
+The neighbour counts of the grid are kept between steps. A step counts the
+new generation once, next to the cells that changed, and those counts both
+mark the dying cells and apply the rules in the following step.
+Classes:
+    DenseEngine: Array backed engine giving the same results as SparseEngine.
+Functions:
+    neighbor_counts(alive): Counts the alive neighbours of every cell.
+    next_generation(alive, state, counts, rule): Applies the rules to arrays of cells.
+
+
+"""
+import random
+
+import numpy as np
+
+from .coords import coord_array, pack_array
+from .cycles import GenerationHash
+from .profiler import profiler
+from .rules import RuleSettings
+
+# The chunk offsets of a chunk and its 26 neighbours
+CHUNK_OFFSETS = np.array([(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)])
+
+
+def neighbor_counts(alive):
+    # Count the alive neighbours of every cell of a 3D boolean array
+    # Cells outside the array count as dead. The 3x3x3 box sum is done one axis
+    # at a time with sliced adds, then the cell itself is subtracted
+    box = alive.astype(np.uint8)
+    for axis in range(3):
+        total = box.copy()
+        low = [slice(None)] * 3
+        high = [slice(None)] * 3
+        low[axis] = slice(None, -1)
+        high[axis] = slice(1, None)
+        total[tuple(high)] += box[tuple(low)]
+        total[tuple(low)] += box[tuple(high)]
+        box = total
+    box -= alive
+    return box
+
+
+def next_generation(alive, state, counts, rule):
+    # Apply a compiled rule to arrays of cells and return the new alive and state arrays
+    # The dying marks are not set, they need the neighbour counts of the new generation
+    survive = alive & rule.table[1][counts]
+    born = ~alive & rule.table[0][counts]
+    new_state = np.where(survive, state + 1, 0).astype(np.int32)
+    new_state[born] = 1
+    return survive | born, new_state
+
+
+class DenseEngine(RuleSettings, GenerationHash):
+    """
+    NumPy backed 3D Game of Life engine.
+    The grid is stored as a boolean alive array and an int32 state array that
+    holds the same values as SparseEngine: 1 is newly born, greater than 1 is
+    alive and mature, -1 is dead next cycle. Cells outside the grid are ignored.
+    The engine tracks the bounding box of the live cells and the chunks that
+    may change next generation, and steps only those chunks. Changing a rule
+    or the grid size makes the next step process the whole live region.
+    Attributes:
+        grid_size (int): The size of the grid along each axis. Changing it keeps the cells that still fit.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+        rule (Rule): The rule compiled from the rates, or set from a rulestring.
+        generation (int): The number of steps taken since the last clear or load.
+        alive (ndarray): Boolean array of the live cells indexed [x, y, z].
+        state (ndarray): Int32 array of the cell states indexed [x, y, z].
+        counts (ndarray): Uint8 array of the alive neighbours of every cell, kept up to date.
+        chunk_size (int): The edge length of the chunks activity is tracked in.
+        live_box (tuple): The (low, high) corners bounding the live cells, or None when empty.
+        hash (int): The Zobrist hash of the live cells, kept up to date by step once read.
+    Methods:
+        clear(): Removes every cell from the grid.
+        set_cell(x, y, z, value=1): Sets the state of a cell.
+        remove_cell(x, y, z): Removes a cell from the grid.
+        toggle_cell(x, y, z): Toggles a cell between alive and dead.
+        load_cells(cells): Replaces the grid with newly born cells.
+        set_cells(coords, states): Replaces the grid with cells of the given states.
+        randomize(count, rng=random): Replaces the grid with randomly placed cells.
+        cells(): Iterates over (x, y, z, state) for every live cell.
+        cell_arrays(): Returns the coordinates and states of the live cells as arrays.
+        step(): Advances the game by one generation.
+    """
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2, chunk_size=8):
+        self._grid_size = grid_size
+        self._set_rates(birthrate, deathrate, aliverate)
+        self.chunk_size = chunk_size
+        self.generation = 0
+        self.alive, self.state, self.counts = self._allocate(grid_size)
+        self.live_box = None
+        # The chunks to process next step as an (N, 3) array, or None for the whole live region
+        self._active = None
+        # The cells edited since the last step, whose chunks are processed next step
+        self._edited = []
+        self._stepped_rule = None
+
+    def _allocate(self, grid_size):
+        # Allocate empty alive, state and neighbour count arrays for a grid size
+        shape = (grid_size,) * 3
+        return np.zeros(shape, dtype=bool), np.zeros(shape, dtype=np.int32), np.zeros(shape, dtype=np.uint8)
+
+    @property
+    def grid_size(self):
+        return self._grid_size
+
+    @grid_size.setter
+    def grid_size(self, value):
+        # Reallocate the arrays, keeping the cells that fit in the new size
+        if value == self._grid_size:
+            return
+        keep = min(value, self._grid_size)
+        alive, state, counts = self._allocate(value)
+        alive[:keep, :keep, :keep] = self.alive[:keep, :keep, :keep]
+        state[:keep, :keep, :keep] = self.state[:keep, :keep, :keep]
+        counts[...] = neighbor_counts(alive)
+        self._grid_size = value
+        self.alive = alive
+        self.state = state
+        self.counts = counts
+        self.live_box = self._find_box(((0, 0, 0), (keep, keep, keep)))
+        self._active = None
+        self._hash = None
+
+    @property
+    def population(self):
+        # The number of live cells
+        if self.live_box is None:
+            return 0
+        return int(np.count_nonzero(self.alive[self._slices(self.live_box)]))
+
+    def in_bounds(self, x, y, z):
+        # Check a coordinate lies inside the grid
+        return 0 <= x < self._grid_size and 0 <= y < self._grid_size and 0 <= z < self._grid_size
+
+    def clear(self):
+        # Remove every cell from the grid
+        self.alive[...] = False
+        self.state[...] = 0
+        self.counts[...] = 0
+        self.generation = 0
+        self.live_box = None
+        self._active = np.empty((0, 3), dtype=np.int64)
+        self._edited = []
+        self._hash = None
+
+    def set_cell(self, x, y, z, value=1):
+        # Set the state of a single cell
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z):
+            if not self.alive[x, y, z]:
+                self._count_neighbor(x, y, z, 1)
+            self.alive[x, y, z] = True
+            self.state[x, y, z] = value
+            self._edited.append((x, y, z))
+            self._hash = None
+            if self.live_box is None:
+                self.live_box = ((x, y, z), (x + 1, y + 1, z + 1))
+            else:
+                low, high = self.live_box
+                self.live_box = ((min(low[0], x), min(low[1], y), min(low[2], z)),
+                                 (max(high[0], x + 1), max(high[1], y + 1), max(high[2], z + 1)))
+
+    def remove_cell(self, x, y, z):
+        # Remove a single cell, doing nothing if it is not alive
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z):
+            if self.alive[x, y, z]:
+                self._count_neighbor(x, y, z, -1)
+            self.alive[x, y, z] = False
+            self.state[x, y, z] = 0
+            self._edited.append((x, y, z))
+            self._hash = None
+
+    def _count_neighbor(self, x, y, z, change):
+        # Add change to the neighbour counts around a cell that is born or removed
+        around = self.counts[max(x - 1, 0):x + 2, max(y - 1, 0):y + 2, max(z - 1, 0):z + 2]
+        if change > 0:
+            around += 1
+            self.counts[x, y, z] -= 1
+        else:
+            # The cell itself first, so its own count never goes below zero
+            self.counts[x, y, z] += 1
+            around -= 1
+
+    def toggle_cell(self, x, y, z):
+        # Toggle a cell between alive and dead
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z) and self.alive[x, y, z]:
+            self.remove_cell(x, y, z)
+        else:
+            self.set_cell(x, y, z)
+
+    def load_cells(self, cells):
+        # Replace the grid with newly born cells at the given coordinates
+        coords = coord_array(cells)
+        self.set_cells(coords, np.ones(len(coords), dtype=np.int32))
+
+    def set_cells(self, coords, states):
+        # Replace the grid with cells of the given states
+        # The cells are written in one go and only the box around them is counted
+        self.clear()
+        coords = coord_array(coords)
+        inside = np.all((coords >= 0) & (coords < self._grid_size), axis=1)
+        coords, states = coords[inside], np.asarray(states, dtype=np.int32)[inside]
+        if len(coords) == 0:
+            return
+        x, y, z = coords.T
+        self.alive[x, y, z] = True
+        self.state[x, y, z] = states
+        self.live_box = (tuple(coords.min(axis=0).tolist()), tuple((coords.max(axis=0) + 1).tolist()))
+        low, high = self.live_box
+        halo = (tuple(max(n - 1, 0) for n in low), tuple(min(n + 1, self._grid_size) for n in high))
+        self.counts[self._slices(halo)] = self._box_counts(halo)
+        # The next step looks at the whole live box rather than at edited chunks
+        self._active = None
+
+    def randomize(self, count, rng=random):
+        # Replace the grid with count randomly placed cells
+        self.clear()
+        for i in range(count):
+            self.set_cell(rng.randrange(self._grid_size), rng.randrange(self._grid_size),
+                          rng.randrange(self._grid_size))
+
+    def cells(self):
+        # Iterate over the coordinates and state of every live cell
+        coords, states = self.cell_arrays()
+        for (x, y, z), state in zip(coords.tolist(), states.tolist()):
+            yield x, y, z, state
+
+    def cell_arrays(self):
+        # Return an (N, 3) int64 array of coordinates and an int32 array of states
+        # Only the live bounding box is searched
+        if self.live_box is None:
+            return np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int32)
+        box = self._slices(self.live_box)
+        alive = self.alive[box]
+        coords = np.argwhere(alive).astype(np.int64) + self.live_box[0]
+        return coords, self.state[box][alive]
+
+    def step(self):
+        # Advance the game by one step
+        # The rules are applied to the active boxes as boolean masks. Every other
+        # cell keeps its alive flag, so the live cells outside them only age
+        rule = self.rule
+        whole = self._active is None or rule != self._stepped_rule
+        if whole:
+            boxes = self._whole_boxes(self.live_box)
+        else:
+            active = self._active
+            if self._edited:
+                edited = np.array(self._edited, dtype=np.int64) // self.chunk_size
+                active = self._grow(np.concatenate([active, edited]))
+            boxes = self._chunk_boxes(active)
+        results = []
+        for box in boxes:
+            slices = self._slices(box)
+            results.append(next_generation(self.alive[slices], self.state[slices], self.counts[slices], rule))
+        if self.live_box is not None:
+            slices = self._slices(self.live_box)
+            ages = self.state[slices]
+            ages[self.alive[slices]] += 1
+        changed = []
+        for box, (new_alive, new_state) in zip(boxes, results):
+            slices = self._slices(box)
+            flips = new_alive != self.alive[slices]
+            changed.append(self._changed_chunks(flips, box[0]))
+            if self._hash is not None:
+                self._hash_changes(pack_array(np.argwhere(flips) + box[0]))
+            self.alive[slices] = new_alive
+            self.state[slices] = new_state
+        self.live_box = self._find_box(self._union([self.live_box] + boxes))
+        active = self._grow(np.concatenate(changed) if changed else np.empty((0, 3), dtype=np.int64))
+        # Count the new generation, which only changes next to a changed cell. The
+        # counts mark the cells that will die next cycle now and apply the rules
+        # next step, so every generation is counted once
+        with profiler.section("neighbour counts"):
+            for box in self._chunk_boxes(active):
+                slices = self._slices(box)
+                counts = self._box_counts(box)
+                self.counts[slices] = counts
+                if not whole:
+                    marks = self.state[slices]
+                    marks[self.alive[slices] & rule.marks[counts]] = -1
+        if whole:
+            # The rules changed, so every mark is redone from the counts
+            for box in self._whole_boxes(self.live_box):
+                slices = self._slices(box)
+                marks = self.state[slices]
+                marks[self.alive[slices] & rule.marks[self.counts[slices]]] = -1
+        self._active = active
+        self._edited = []
+        self._stepped_rule = rule
+        self.generation += 1
+
+    def _forget_activity(self):
+        # Make the next step process the whole grid, after the arrays were changed directly
+        size = self._grid_size
+        self.live_box = ((0, 0, 0), (size, size, size)) if size else None
+        self._active = None
+        self._edited = []
+        self._hash = None
+
+    def _slices(self, box):
+        # Turn a (low, high) box into a tuple of slices
+        low, high = box
+        return tuple(slice(int(lo), int(hi)) for lo, hi in zip(low, high))
+
+    def _box_counts(self, box):
+        # Count the alive neighbours of the cells of a box using a one cell halo around it
+        low, high = box
+        halo_low = [max(int(lo) - 1, 0) for lo in low]
+        halo_high = [min(int(hi) + 1, self._grid_size) for hi in high]
+        counts = neighbor_counts(self.alive[self._slices((halo_low, halo_high))])
+        return counts[tuple(slice(int(lo) - h, int(hi) - h) for lo, hi, h in zip(low, high, halo_low))]
+
+    def _find_box(self, box):
+        # Return the bounding box of the live cells inside a box, or None if there are none
+        if box is None:
+            return None
+        alive = self.alive[self._slices(box)]
+        if not alive.any():
+            return None
+        low, high = [], []
+        for axis in range(3):
+            hits = np.flatnonzero(alive.any(axis=tuple(a for a in range(3) if a != axis)))
+            low.append(int(box[0][axis] + hits[0]))
+            high.append(int(box[0][axis] + hits[-1] + 1))
+        return tuple(low), tuple(high)
+
+    def _union(self, boxes):
+        # Return the box bounding a list of boxes, skipping None
+        boxes = [box for box in boxes if box is not None]
+        if not boxes:
+            return None
+        return (tuple(min(int(box[0][axis]) for box in boxes) for axis in range(3)),
+                tuple(max(int(box[1][axis]) for box in boxes) for axis in range(3)))
+
+    def _whole_boxes(self, live_box):
+        # The box around the live cells grown by one cell and out to whole chunks
+        if live_box is None:
+            return []
+        low = [max(lo - 1, 0) // self.chunk_size * self.chunk_size for lo in live_box[0]]
+        high = [min(hi + 1, self._grid_size) for hi in live_box[1]]
+        return [(tuple(low), tuple(high))]
+
+    def _chunk_boxes(self, chunks):
+        # Turn active chunks into boxes of cells to process
+        # Chunks packed closely are processed as one box around them, scattered ones one by one
+        if len(chunks) == 0:
+            return []
+        size = self.chunk_size
+        low = chunks.min(axis=0)
+        high = chunks.max(axis=0) + 1
+        if len(chunks) * 4 >= np.prod(high - low):
+            return [(tuple(low * size), tuple(np.minimum(high * size, self._grid_size)))]
+        return [(tuple(chunk * size), tuple(np.minimum((chunk + 1) * size, self._grid_size)))
+                for chunk in chunks]
+
+    def _changed_chunks(self, changed, low):
+        # Return the chunks holding a changed cell of a box starting on a chunk corner
+        size = self.chunk_size
+        padded = [-(-n // size) * size for n in changed.shape]
+        if padded != list(changed.shape):
+            changed = np.pad(changed, [(0, p - n) for p, n in zip(padded, changed.shape)])
+        chunks = changed.reshape(padded[0] // size, size, padded[1] // size, size,
+                                 padded[2] // size, size).any(axis=(1, 3, 5))
+        return np.argwhere(chunks) + np.array(low, dtype=np.int64) // size
+
+    def _grow(self, chunks):
+        # Return the chunks next to any of the given chunks, including themselves, once each
+        if len(chunks) == 0:
+            return np.empty((0, 3), dtype=np.int64)
+        count = -(-self._grid_size // self.chunk_size)
+        low = np.maximum(chunks.min(axis=0) - 1, 0)
+        high = np.minimum(chunks.max(axis=0) + 2, count)
+        if len(chunks) * len(CHUNK_OFFSETS) < np.prod(high - low):
+            # Few scattered chunks, add the offsets directly
+            grown = (chunks[:, None, :] + CHUNK_OFFSETS[None, :, :]).reshape(-1, 3)
+            grown = grown[((grown >= 0) & (grown < count)).all(axis=1)]
+            return np.unique(grown, axis=0)
+        # Many chunks, grow them as a mask over their bounding box
+        mask = np.zeros(high - low, dtype=bool)
+        mask[tuple((chunks - low).T)] = True
+        mask |= neighbor_counts(mask) > 0
+        return np.argwhere(mask) + low
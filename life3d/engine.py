@@ -0,0 +1,194 @@
+"""
+
+This module defines the headless simulation engine for the 3D Game of Life.
+Nothing in here depends on Panda3D or PyQt6, so the rules can be imported,
+tested and benchmarked without opening a window.
+Classes:
+    SparseEngine: Dictionary backed engine that only stores the live cells.
+
+
+"""
+import random
+
+import numpy as np
+
+from .coords import NEIGHBOR_DELTAS, NEIGHBOR_OFFSETS, coord_array, pack, pack_array, unpack, unpack_array
+from .cycles import GenerationHash
+from .profiler import profiler
+from .rules import RuleSettings
+
+
+class SparseEngine(RuleSettings, GenerationHash):
+    """
+    Dictionary backed 3D Game of Life engine.
+    Only live cells are stored, keyed by coordinates packed into integers with
+    life3d.coords.pack. The value of a cell is its state:
+    1 is newly born, greater than 1 is alive and mature, -1 is dead next cycle.
+    Attributes:
+        grid_size (int): The size of the grid along each axis.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+        rule (Rule): The rule compiled from the rates, or set from a rulestring.
+        generation (int): The number of steps taken since the last clear or load.
+        grid (dict): The live cells keyed by packed coordinates.
+        hash (int): The Zobrist hash of the live cells, kept up to date by step once read.
+    Methods:
+        clear(): Removes every cell from the grid.
+        set_cell(x, y, z, value=1): Sets the state of a cell.
+        remove_cell(x, y, z): Removes a cell from the grid.
+        toggle_cell(x, y, z): Toggles a cell between alive and dead.
+        load_cells(cells): Replaces the grid with newly born cells.
+        set_cells(coords, states): Replaces the grid with cells of the given states.
+        randomize(count, rng=random): Replaces the grid with randomly placed cells.
+        cells(): Iterates over (x, y, z, state) for every live cell.
+        cell_arrays(): Returns the coordinates and states of the live cells as arrays.
+        count_alive_neighbors(x, y, z): Counts the alive neighbours of a cell.
+        neighbor_counts(): Counts the alive neighbours of every cell next to a live cell.
+        step(): Advances the game by one generation.
+    """
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2):
+        self.grid_size = grid_size
+        self._set_rates(birthrate, deathrate, aliverate)
+        self.generation = 0
+        self.grid = {}
+        # The neighbour counts of the grid from the last step, with the grid and size they are for
+        self._counts = None
+
+    @property
+    def population(self):
+        # The number of live cells
+        return len(self.grid)
+
+    def clear(self):
+        # Remove every cell from the grid
+        self.grid = {}
+        self._counts = None
+        self._hash = None
+        self.generation = 0
+
+    def set_cell(self, x, y, z, value=1):
+        # Set the state of a single cell
+        self.grid[pack(x, y, z)] = value
+        self._counts = None
+        self._hash = None
+
+    def remove_cell(self, x, y, z):
+        # Remove a single cell, doing nothing if it is not alive
+        self.grid.pop(pack(x, y, z), None)
+        self._counts = None
+        self._hash = None
+
+    def toggle_cell(self, x, y, z):
+        # Toggle a cell between alive and dead
+        key = pack(x, y, z)
+        if key in self.grid:
+            del self.grid[key]
+        else:
+            self.grid[key] = 1
+        self._counts = None
+        self._hash = None
+
+    def load_cells(self, cells):
+        # Replace the grid with newly born cells at the given coordinates
+        # The keys are packed in one pass over the array of cells
+        self.clear()
+        self.grid = dict.fromkeys(pack_array(coord_array(cells)).tolist(), 1)
+
+    def set_cells(self, coords, states):
+        # Replace the grid with cells of the given states, the last state given for a cell wins
+        self.clear()
+        keys = pack_array(coord_array(coords)).tolist()
+        self.grid = dict(zip(keys, np.asarray(states, dtype=np.int32).tolist()))
+
+    def randomize(self, count, rng=random):
+        # Replace the grid with count randomly placed cells
+        self.clear()
+        for i in range(count):
+            self.set_cell(rng.randrange(self.grid_size), rng.randrange(self.grid_size),
+                          rng.randrange(self.grid_size))
+
+    def cells(self):
+        # Iterate over the coordinates and state of every live cell
+        for key, state in self.grid.items():
+            x, y, z = unpack(key)
+            yield x, y, z, state
+
+    def cell_arrays(self):
+        # Return an (N, 3) int64 array of coordinates and an int32 array of states
+        keys = np.fromiter(self.grid.keys(), dtype=np.int64, count=len(self.grid))
+        states = np.fromiter(self.grid.values(), dtype=np.int32, count=len(self.grid))
+        return unpack_array(keys), states
+
+    def count_alive_neighbors(self, x, y, z):
+        # Count the number of alive neighbours of a single cell
+        # Neighbours outside the grid are not counted
+        size = self.grid_size
+        key = pack(x, y, z)
+        count = 0
+        for (dx, dy, dz), delta in zip(NEIGHBOR_OFFSETS, NEIGHBOR_DELTAS):
+            if 0 <= x + dx < size and 0 <= y + dy < size and 0 <= z + dz < size and key + delta in self.grid:
+                count += 1
+        return count
+
+    def neighbor_counts(self):
+        # Count the alive neighbours of every cell that has at least one
+        # Each live cell inside the grid adds one to its 26 neighbours. Only cells
+        # on the border of the grid need the per-neighbour bounds checks, and empty
+        # cells outside the grid are never counted so they can never be born
+        grid = self.grid
+        size = self.grid_size
+        last = size - 1
+        counts = {}
+        get = counts.get
+        for key in grid:
+            x, y, z = unpack(key)
+            if 0 < x < last and 0 < y < last and 0 < z < last:
+                for delta in NEIGHBOR_DELTAS:
+                    n = key + delta
+                    counts[n] = get(n, 0) + 1
+            elif 0 <= x < size and 0 <= y < size and 0 <= z < size:
+                for (dx, dy, dz), delta in zip(NEIGHBOR_OFFSETS, NEIGHBOR_DELTAS):
+                    n = key + delta
+                    if n in grid or (0 <= x + dx < size and 0 <= y + dy < size and 0 <= z + dz < size):
+                        counts[n] = get(n, 0) + 1
+        return counts
+
+    def step(self):
+        # Advance the game by one step
+        grid = self.grid
+        # The counts of the last step are used when the grid has not changed since
+        if self._counts is not None and self._counts[0] is grid and self._counts[1] == self.grid_size:
+            counts = self._counts[2]
+        else:
+            with profiler.section("neighbour counts"):
+                counts = self.neighbor_counts()
+        # The rule tables are looked up by the number of alive neighbours
+        born, survive = self.rule.table.tolist()
+        dying = self.rule.marks.tolist()
+        new_grid = {}
+        # If the cell is alive and has the right number of alive neighbors, keep it alive
+        for key, state in grid.items():
+            if survive[counts.get(key, 0)]:
+                new_grid[key] = state + 1
+        # Empty cells next to a live cell are born if they have the right number of alive neighbors
+        for key, alive_neighbors in counts.items():
+            if born[alive_neighbors] and key not in grid:
+                new_grid[key] = 1
+
+        # Update the grid with the new state
+        # The cells in only one of the grids were born or died, which is all the hash needs
+        if self._hash is not None:
+            self._hash_changes(np.fromiter(grid.keys() ^ new_grid.keys(), dtype=np.int64))
+        self.grid = new_grid
+
+        # Count the new grid once: the counts mark the cells that will die next cycle
+        # now and apply the rules next step
+        with profiler.section("neighbour counts"):
+            counts = self.neighbor_counts()
+        for key in new_grid:
+            if dying[counts.get(key, 0)]:
+                new_grid[key] = -1
+        self._counts = (new_grid, self.grid_size, counts)
+        self.generation += 1
@@ -0,0 +1,131 @@
+"""
+
+This module draws a file picker with DirectGui, for choosing files inside the
+Panda3D window when PyQt6 is not installed.
+The picker lists the folders and the matching files of a directory. Clicking
+a folder opens it, clicking a file puts its name in the entry, and OK or
+Enter hands the chosen path to a callback, which gets an empty path if the
+picker is cancelled, like a Qt dialog. Unlike the rest of life3d this module
+needs Panda3D, so it is not imported by life3d/__init__.py.
+Classes:
+    FilePicker: A DirectGui window for choosing a file to open or save.
+
+
+"""
+import os
+
+from direct.gui.DirectGui import DirectButton, DirectEntry, DirectFrame, DirectLabel, DirectScrolledList
+
+# The colours of the picker
+FRAME_COLOR = (0.15, 0.15, 0.2, 0.92)
+FOLDER_COLOR = (0.8, 0.8, 0.5, 1)
+FILE_COLOR = (0.9, 0.9, 0.9, 1)
+# The number of names shown at once in the list
+VISIBLE_ITEMS = 12
+
+
+class FilePicker:
+    """
+    A DirectGui window for choosing a file to open or save.
+    Attributes:
+        directory (str): The directory listed.
+        extensions (tuple): The extensions of the files listed, such as (".lif",), or empty for every file.
+        save (bool): Whether the file is to be saved, which allows names that do not exist yet.
+        callback (function): Called with the chosen path, or with "" if the picker is cancelled.
+        frame (DirectFrame): The window holding the picker.
+    Methods:
+        show_directory(directory): Lists a directory.
+        choose(name): Opens a folder or puts a file name in the entry.
+        accept(text=None): Hands the path in the entry to the callback and closes the picker.
+        cancel(): Hands an empty path to the callback and closes the picker.
+        close(): Removes the picker.
+    """
+
+    def __init__(self, title, extensions, save, callback, directory=None):
+        self.directory = os.path.abspath(directory or os.getcwd())
+        self.extensions = tuple(extensions)
+        self.save = save
+        self.callback = callback
+        self.frame = DirectFrame(frameColor=FRAME_COLOR, frameSize=(-0.8, 0.8, -0.75, 0.75), pos=(0, 0, 0))
+        DirectLabel(parent=self.frame, text=title, scale=0.06, pos=(0, 0, 0.66), frameColor=(0, 0, 0, 0),
+                    text_fg=(1, 1, 1, 1))
+        self.pathLabel = DirectLabel(parent=self.frame, text="", scale=0.04, pos=(0, 0, 0.58),
+                                     frameColor=(0, 0, 0, 0), text_fg=(0.8, 0.8, 0.8, 1))
+        self.entry = DirectEntry(parent=self.frame, scale=0.05, width=22, numLines=1, pos=(-0.74, 0, -0.58),
+                                 command=self.accept, focus=1)
+        DirectButton(parent=self.frame, text="Save" if save else "Open", scale=0.06, pos=(0.5, 0, -0.68),
+                     command=self.accept)
+        DirectButton(parent=self.frame, text="Cancel", scale=0.06, pos=(0.68, 0, -0.68), command=self.cancel)
+        self.list = None
+        self.show_directory(self.directory)
+
+    def _entries(self, directory):
+        # The folders and then the matching files of a directory, each sorted by name
+        folders, files = [], []
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name.lower())
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                folders.append(entry.name)
+            elif not self.extensions or entry.name.endswith(self.extensions):
+                files.append(entry.name)
+        return folders, files
+
+    def show_directory(self, directory):
+        # List a directory, replacing the list shown before
+        self.directory = os.path.abspath(directory)
+        self.pathLabel["text"] = self.directory
+        if self.list is not None:
+            self.list.destroy()
+        folders, files = self._entries(self.directory)
+        items = [DirectButton(text=name + "/", text_scale=0.05, text_align=0, text_fg=FOLDER_COLOR, relief=None,
+                              command=self.choose, extraArgs=[name]) for name in [".."] + folders]
+        items += [DirectButton(text=name, text_scale=0.05, text_align=0, text_fg=FILE_COLOR, relief=None,
+                               command=self.choose, extraArgs=[name]) for name in files]
+        self.list = DirectScrolledList(
+            parent=self.frame, pos=(-0.7, 0, 0.5), frameSize=(-0.04, 1.44, -0.96, 0.04),
+            frameColor=(0, 0, 0, 0.3), items=items, numItemsVisible=VISIBLE_ITEMS, forceHeight=0.075,
+            itemFrame_frameSize=(-0.02, 1.3, -0.9, 0.04), itemFrame_pos=(0, 0, 0), itemFrame_frameColor=(0, 0, 0, 0),
+            decButton_text="^", decButton_text_scale=0.05, decButton_pos=(1.38, 0, 0), decButton_borderWidth=(0.01, 0.01),
+            incButton_text="v", incButton_text_scale=0.05, incButton_pos=(1.38, 0, -0.9),
+            incButton_borderWidth=(0.01, 0.01))
+
+    def choose(self, name):
+        # Open a folder, or put a file name in the entry, opening it straight away unless saving
+        path = os.path.join(self.directory, name)
+        if os.path.isdir(path):
+            self.show_directory(path)
+        else:
+            self.entry.enterText(name)
+            if not self.save:
+                self.accept()
+
+    def accept(self, text=None):
+        # Hand the path in the entry to the callback and close the picker
+        name = self.entry.get().strip()
+        if not name:
+            return
+        path = os.path.join(self.directory, os.path.expanduser(name))
+        if os.path.isdir(path):
+            self.entry.enterText("")
+            self.show_directory(path)
+            return
+        if self.save and self.extensions and not path.endswith(self.extensions):
+            path += self.extensions[0]
+        self.close()
+        self.callback(path)
+
+    def cancel(self):
+        # Hand an empty path to the callback and close the picker
+        self.close()
+        self.callback("")
+
+    def close(self):
+        # Remove the picker
+        if self.frame is not None:
+            self.frame.destroy()
+            self.frame = None
@@ -0,0 +1,471 @@
+"""
+
+This module defines a memoized octree engine for the 3D Game of Life, a 3D
+analogue of Hashlife.
+The grid is an octree of canonical nodes: two cubes holding the same cells
+are the same node, so repeated structure is stored once. For every node the
+engine remembers the centre cube a power of two generations later, built
+from the results of its sub-cubes, so a periodic or stable pattern is only
+ever computed once and the grid can jump 2**k generations in one call.
+Whether a cell is alive next generation only depends on the alive cells
+around it, so the octree holds alive cells only. Cells outside the grid are
+wall cells that are never alive and never counted, which keeps the results
+the same as the bounded grid of the other engines. The caches of nodes and
+results are bounded and evict the least recently used entries.
+Classes:
+    Node: One cube of the octree.
+    HashlifeEngine: Engine stepping a memoized octree, able to jump many generations at once.
+
+
+"""
+import random
+from collections import OrderedDict
+
+import numpy as np
+
+from .coords import NEIGHBOR_DELTAS, coord_array, pack_array
+from .cycles import GenerationHash, zobrist
+from .rules import RuleSettings
+
+# The values of a single cell
+DEAD = 0
+ALIVE = 1
+WALL = 2
+# The state reported for mature cells, whose exact age is not kept
+MATURE = 2
+
+
+def _base_neighbors():
+    # The flat indexes into a 4x4x4 cube of the 26 neighbours of each of its 8 centre cells
+    neighbors = []
+    for q in range(8):
+        x, y, z = 1 + (q >> 2), 1 + (q >> 1 & 1), 1 + (q & 1)
+        neighbors.append([(x + dx) * 16 + (y + dy) * 4 + z + dz
+                          for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                          if dx or dy or dz])
+    return neighbors
+
+
+BASE_NEIGHBORS = _base_neighbors()
+# The flat index into a 4x4x4 cube of each of its 8 centre cells
+BASE_CENTERS = [(1 + (q >> 2)) * 16 + (1 + (q >> 1 & 1)) * 4 + 1 + (q & 1) for q in range(8)]
+# The flat index into a 4x4x4 cube of each cell of each octant, as (octant, sub octant) pairs
+BASE_CELLS = [((a >> 1) * 4 + (b >> 1) * 2 + (c >> 1), (a & 1) * 4 + (b & 1) * 2 + (c & 1))
+              for a in range(4) for b in range(4) for c in range(4)]
+# The octant offsets, octant q being x = q >> 2, y = q >> 1 & 1, z = q & 1
+OCTANTS = [(q >> 2, q >> 1 & 1, q & 1) for q in range(8)]
+
+
+class Node:
+    """
+    One cube of the octree, 2**level cells along each axis.
+    Nodes are canonical and never change, so they are compared by identity.
+    Attributes:
+        level (int): The log2 of the cube size. Level 1 nodes hold cell values.
+        children (tuple): The 8 octants, octant q being x = q >> 2, y = q >> 1 & 1, z = q & 1.
+        population (int): The number of alive cells in the cube.
+    """
+    __slots__ = ("level", "children", "population")
+
+    def __init__(self, level, children, population):
+        self.level = level
+        self.children = children
+        self.population = population
+
+
+class HashlifeEngine(RuleSettings, GenerationHash):
+    """
+    Memoized octree 3D Game of Life engine.
+    It gives the same alive cells as the other engines. Only the newly born
+    and dying states are exact: ages are not kept through a jump, so every
+    other live cell reports MATURE. advance(n) steps n generations with
+    jumps of powers of two, which is what makes generation 10**6 of a
+    periodic pattern cheap.
+    Attributes:
+        grid_size (int): The size of the grid along each axis. Changing it keeps the cells that still fit.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+        rule (Rule): The rule compiled from the rates, or set from a rulestring.
+        generation (int): The number of steps taken since the last clear or load.
+        cache_size (int): The most nodes and the most results kept in the caches.
+        root (Node): The octree of the grid.
+        max_age (int): The highest state reported for a live cell, MATURE.
+        hash (int): The Zobrist hash of the live cells, worked out once for each root.
+    Methods:
+        clear(): Removes every cell from the grid.
+        set_cell(x, y, z, value=1): Sets the state of a cell.
+        remove_cell(x, y, z): Removes a cell from the grid.
+        toggle_cell(x, y, z): Toggles a cell between alive and dead.
+        load_cells(cells): Replaces the grid with newly born cells.
+        set_cells(coords, states): Replaces the grid with cells of the given states.
+        randomize(count, rng=random): Replaces the grid with randomly placed cells.
+        cells(): Iterates over (x, y, z, state) for every live cell.
+        cell_arrays(): Returns the coordinates and states of the live cells as arrays.
+        step(): Advances the game by one generation.
+        advance(n): Advances the game by n generations.
+        jump(k): Advances the game by 2**k generations.
+    """
+
+    # Live cells stop ageing at MATURE, which a recording needs to predict the states
+    max_age = MATURE
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2, cache_size=1 << 20):
+        self._set_rates(birthrate, deathrate, aliverate)
+        self.cache_size = cache_size
+        self.generation = 0
+        self._nodes = OrderedDict()
+        self._results = OrderedDict()
+        self._filled = {}
+        self._stepped_rule = None
+        self._hash_root = None
+        self._grid_size = grid_size
+        self._level = max(2, (grid_size - 1).bit_length())
+        self.root = self._build(self._level, (0, 0, 0), np.zeros((0, 3), dtype=np.int64))
+        self._reset_states()
+
+    @property
+    def grid_size(self):
+        return self._grid_size
+
+    @grid_size.setter
+    def grid_size(self, value):
+        # Rebuild the octree for the new size, keeping the cells that fit and their states
+        if value == self._grid_size:
+            return
+        coords, states = self.cell_arrays()
+        inside = np.all(coords < value, axis=1)
+        coords, states = coords[inside], states[inside]
+        self._grid_size = value
+        self._level = max(2, (value - 1).bit_length())
+        # The cells outside the old grid were walls, so no result still holds
+        self._filled = {}
+        self._results.clear()
+        self.root = self._build(self._level, (0, 0, 0), coords)
+        self._reset_states()
+        self._edits = dict(zip(pack_array(coords).tolist(), states.tolist()))
+
+    @property
+    def population(self):
+        # The number of live cells
+        return self.root.population
+
+    def in_bounds(self, x, y, z):
+        # Check a coordinate lies inside the grid
+        return 0 <= x < self._grid_size and 0 <= y < self._grid_size and 0 <= z < self._grid_size
+
+    def clear(self):
+        # Remove every cell from the grid
+        self.root = self._build(self._level, (0, 0, 0), np.zeros((0, 3), dtype=np.int64))
+        self._reset_states()
+        self.generation = 0
+
+    def set_cell(self, x, y, z, value=1):
+        # Set the state of a single cell
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z):
+            self.root = self._with(self.root, x, y, z, ALIVE)
+            self._edits[int(pack_array([(x, y, z)])[0])] = value
+            self._arrays = None
+
+    def remove_cell(self, x, y, z):
+        # Remove a single cell, doing nothing if it is not alive
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z):
+            self.root = self._with(self.root, x, y, z, DEAD)
+            self._edits.pop(int(pack_array([(x, y, z)])[0]), None)
+            self._arrays = None
+
+    def toggle_cell(self, x, y, z):
+        # Toggle a cell between alive and dead
+        x, y, z = int(x), int(y), int(z)
+        if self.in_bounds(x, y, z) and self._get(self.root, x, y, z) == ALIVE:
+            self.remove_cell(x, y, z)
+        else:
+            self.set_cell(x, y, z)
+
+    def load_cells(self, cells):
+        # Replace the grid with newly born cells at the given coordinates
+        coords = coord_array(cells)
+        coords = coords[np.all((coords >= 0) & (coords < self._grid_size), axis=1)]
+        self.root = self._build(self._level, (0, 0, 0), np.unique(coords, axis=0))
+        self._reset_states()
+        self.generation = 0
+
+    def set_cells(self, coords, states):
+        # Replace the grid with cells of the given states, the last state given for a cell wins
+        # The states are kept as edits over the octree of the alive cells
+        coords = coord_array(coords)
+        inside = np.all((coords >= 0) & (coords < self._grid_size), axis=1)
+        coords, states = coords[inside], np.asarray(states, dtype=np.int32)[inside]
+        self.root = self._build(self._level, (0, 0, 0), np.unique(coords, axis=0))
+        self._reset_states()
+        self._edits = dict(zip(pack_array(coords).tolist(), states.tolist()))
+        self.generation = 0
+
+    def randomize(self, count, rng=random):
+        # Replace the grid with count randomly placed cells
+        self.load_cells([(rng.randrange(self._grid_size), rng.randrange(self._grid_size),
+                          rng.randrange(self._grid_size)) for i in range(count)])
+
+    def cells(self):
+        # Iterate over the coordinates and state of every live cell
+        coords, states = self.cell_arrays()
+        for (x, y, z), state in zip(coords.tolist(), states.tolist()):
+            yield x, y, z, state
+
+    def cell_arrays(self):
+        # Return an (N, 3) int64 array of coordinates and an int32 array of states
+        # The states are worked out from the generation before and the counts of the last step
+        if self._arrays is None:
+            coords = self._coords(self.root)
+            keys = pack_array(coords)
+            states = np.full(len(keys), MATURE, dtype=np.int32)
+            states[~np.isin(keys, self._keys(self._previous))] = 1
+            if self._mark_rule is not None:
+                stepped = self._keys(self._stepped)
+                counts = np.zeros(len(keys), dtype=np.int32)
+                for delta in NEIGHBOR_DELTAS:
+                    counts += np.isin(keys + delta, stepped)
+                states[self._mark_rule.marks[counts]] = -1
+            if self._edits:
+                edited = np.array(list(self._edits), dtype=np.int64)
+                index = np.searchsorted(keys, edited)
+                states[index] = np.array(list(self._edits.values()), dtype=np.int32)
+            self._arrays = coords, states
+        coords, states = self._arrays
+        return coords.copy(), states.copy()
+
+    def step(self):
+        # Advance the game by one step
+        self.advance(1)
+
+    def advance(self, n):
+        # Advance the game by n generations, the last one on its own so the newly born cells are known
+        if n <= 0:
+            return
+        self._check_rules()
+        for k in range((n - 1).bit_length()):
+            if (n - 1) >> k & 1:
+                self._jump(k)
+        self._previous = self.root
+        self._jump(0)
+        self._stepped = self.root
+        self._mark_rule = self.rule
+        self._edits = {}
+        self._arrays = None
+        self.generation += n
+
+    def jump(self, k):
+        # Advance the game by 2**k generations
+        self.advance(1 << k)
+
+    @property
+    def hash(self):
+        # Equal grids share a root node, so the hash only changes with the root
+        if self._hash_root is not self.root:
+            self._hash = zobrist(self._keys(self.root))
+            self._hash_root = self.root
+        return self._hash
+
+    def _reset_states(self):
+        # Forget the earlier generations, so every live cell reads as newly born
+        self._previous = self._build(self._level, (0, 0, 0), np.zeros((0, 3), dtype=np.int64))
+        self._stepped = None
+        self._mark_rule = None
+        self._edits = {}
+        self._arrays = None
+
+    def _check_rules(self):
+        # Drop the remembered results when the rules change
+        if self.rule != self._stepped_rule:
+            self._results.clear()
+            self._stepped_rule = self.rule
+            self._born, self._survive = self.rule.table.tolist()
+
+    def _node(self, level, children):
+        # Return the canonical node for a level and children
+        node = self._nodes.get(children)
+        if node is None:
+            if level == 1:
+                population = children.count(ALIVE)
+            else:
+                population = sum(child.population for child in children)
+            node = Node(level, children, population)
+            self._nodes[children] = node
+            if len(self._nodes) > self.cache_size:
+                self._nodes.popitem(last=False)
+        else:
+            self._nodes.move_to_end(children)
+        return node
+
+    def _build(self, level, origin, coords):
+        # Build the node of a cube from the sorted coordinates of the alive cells inside it
+        if len(coords) == 0:
+            inside = tuple(min(max(self._grid_size - o, 0), 1 << level) for o in origin)
+            return self._fill(level, inside)
+        half = 1 << (level - 1)
+        children = []
+        for ox, oy, oz in OCTANTS:
+            low = (origin[0] + ox * half, origin[1] + oy * half, origin[2] + oz * half)
+            mask = np.all((coords >= low) & (coords < np.add(low, half)), axis=1)
+            if level == 1:
+                children.append(ALIVE if mask.any() else DEAD if self.in_bounds(*low) else WALL)
+            else:
+                children.append(self._build(level - 1, low, coords[mask]))
+        return self._node(level, tuple(children))
+
+    def _fill(self, level, inside):
+        # Return the node of a cube without alive cells whose low corner box of size inside is in the grid
+        key = (level, inside)
+        node = self._filled.get(key)
+        if node is None:
+            half = 1 << (level - 1)
+            children = []
+            for octant in OCTANTS:
+                part = tuple(min(max(n - o * half, 0), half) for n, o in zip(inside, octant))
+                if level == 1:
+                    children.append(DEAD if min(part) else WALL)
+                else:
+                    children.append(self._fill(level - 1, part))
+            node = self._filled[key] = self._node(level, tuple(children))
+        return node
+
+    def _with(self, node, x, y, z, value):
+        # Return a node with the cell at x, y, z inside it set to value
+        half = 1 << (node.level - 1)
+        q = (x >= half) << 2 | (y >= half) << 1 | (z >= half)
+        children = list(node.children)
+        if node.level == 1:
+            children[q] = value
+        else:
+            children[q] = self._with(children[q], x % half, y % half, z % half, value)
+        return self._node(node.level, tuple(children))
+
+    def _get(self, node, x, y, z):
+        # Return the value of the cell at x, y, z inside a node
+        while True:
+            half = 1 << (node.level - 1)
+            q = (x >= half) << 2 | (y >= half) << 1 | (z >= half)
+            if node.level == 1:
+                return node.children[q]
+            node = node.children[q]
+            x, y, z = x % half, y % half, z % half
+
+    def _coords(self, node):
+        # Return the sorted coordinates of the alive cells of a node
+        found = []
+        self._collect(node, 0, 0, 0, found)
+        coords = np.array(found, dtype=np.int64).reshape(-1, 3)
+        return coords[np.argsort(pack_array(coords), kind="stable")]
+
+    def _collect(self, node, x, y, z, found):
+        # Add the coordinates of the alive cells of a node at x, y, z to found
+        if node.population == 0:
+            return
+        if node.level == 1:
+            for (ox, oy, oz), value in zip(OCTANTS, node.children):
+                if value == ALIVE:
+                    found.append((x + ox, y + oy, z + oz))
+            return
+        half = 1 << (node.level - 1)
+        for (ox, oy, oz), child in zip(OCTANTS, node.children):
+            self._collect(child, x + ox * half, y + oy * half, z + oz * half, found)
+
+    def _keys(self, node):
+        # Return the sorted packed keys of the alive cells of a node
+        return pack_array(self._coords(node))
+
+    def _jump(self, k):
+        # Advance the octree by 2**k generations
+        # The grid is put at the low corner of the centre of a larger cube of
+        # walls, whose centre 2**k generations on is worked out
+        level = max(self._level, k) + 2
+        result = self._advance(self._embed(level, (0, 0, 0), 1 << (level - 2)), k)
+        while result.level > self._level:
+            result = result.children[0]
+        self.root = result
+
+    def _embed(self, level, origin, offset):
+        # Return the node of a cube at origin of walls holding the grid at offset along each axis
+        size = 1 << level
+        if level == self._level and origin == (offset,) * 3:
+            return self.root
+        if any(o + size <= offset or o >= offset + (1 << self._level) for o in origin):
+            return self._fill(level, (0, 0, 0))
+        half = size >> 1
+        return self._node(level, tuple(self._embed(level - 1, (origin[0] + ox * half, origin[1] + oy * half,
+                                                               origin[2] + oz * half), offset)
+                                       for ox, oy, oz in OCTANTS))
+
+    def _center(self, node):
+        # Return the centre cube of a node, half its size
+        return self._node(node.level - 1, tuple(child.children[7 - q] for q, child in enumerate(node.children)))
+
+    def _advance(self, node, k):
+        # Return the centre cube of a node 2**k generations later, k being at most level - 2
+        if node.population == 0:
+            # Nothing can be born without an alive neighbour
+            return self._center(node)
+        key = (node, k)
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            return result
+        if node.level == 2:
+            result = self._base(node)
+        else:
+            result = self._recurse(node, k)
+        self._results[key] = result
+        if len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+        return result
+
+    def _recurse(self, node, k):
+        # Work out the centre of a node from its 27 overlapping sub-cubes
+        # The first pass steps each sub-cube half way, or just takes its centre
+        # when fewer generations are asked for, and the second pass steps the
+        # 8 cubes made from those results the rest of the way
+        level = node.level
+        grand = [None] * 64
+        for q, child in enumerate(node.children):
+            ox, oy, oz = OCTANTS[q]
+            for p, grandchild in enumerate(child.children):
+                px, py, pz = OCTANTS[p]
+                grand[(ox * 2 + px) * 16 + (oy * 2 + py) * 4 + oz * 2 + pz] = grandchild
+        full = k == level - 2
+        middle = {}
+        for i in range(3):
+            for j in range(3):
+                for l in range(3):
+                    parts = [grand[(i + ox) * 16 + (j + oy) * 4 + l + oz] for ox, oy, oz in OCTANTS]
+                    if full:
+                        middle[i, j, l] = self._advance(self._node(level - 1, tuple(parts)), level - 3)
+                    else:
+                        middle[i, j, l] = self._node(level - 2, tuple(part.children[7 - q]
+                                                                      for q, part in enumerate(parts)))
+        step = level - 3 if full else k
+        children = []
+        for qx, qy, qz in OCTANTS:
+            cube = self._node(level - 1, tuple(middle[qx + ox, qy + oy, qz + oz] for ox, oy, oz in OCTANTS))
+            children.append(self._advance(cube, step))
+        return self._node(level - 1, tuple(children))
+
+    def _base(self, node):
+        # Step the centre 2x2x2 cells of a 4x4x4 node by one generation
+        values = [node.children[q].children[p] for q, p in BASE_CELLS]
+        children = []
+        for center, neighbors in zip(BASE_CENTERS, BASE_NEIGHBORS):
+            value = values[center]
+            if value == WALL:
+                children.append(WALL)
+                continue
+            count = 0
+            for i in neighbors:
+                if values[i] == ALIVE:
+                    count += 1
+            if value == ALIVE:
+                children.append(ALIVE if self._survive[count] else DEAD)
+            else:
+                children.append(ALIVE if self._born[count] else DEAD)
+        return self._node(1, tuple(children))
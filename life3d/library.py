@@ -0,0 +1,174 @@
+"""
+
+This module keeps a library of the pattern files in a set of directories.
+Listing the library only reads the directories, so a dropdown of hundreds of
+patterns fills without parsing any of them. The number of cells, bounding box
+and rule settings of a pattern are parsed the first time they are asked for
+and kept in an index cache on disk, checked against the file's modification
+time and size, so later runs only parse the files that changed. Parsed
+patterns are kept in a least recently used cache, so going back to a preset
+does not read its file again.
+The directories are the ones passed in, followed by those listed in the
+LIFE3D_PATTERNS environment variable. A name found in more than one
+directory is taken from the first.
+Classes:
+    PatternInfo: The summary of a pattern kept in the index.
+    PatternLibrary: Lists, describes and loads the patterns of a set of directories.
+Functions:
+    default_cache_path(): Returns the per-user path of the index cache.
+    pattern_directories(directories): Adds the directories of LIFE3D_PATTERNS to a list of directories.
+
+
+"""
+import json
+import os
+from collections import OrderedDict, namedtuple
+
+from .patterns import BINARY_EXTENSION, read_pattern
+
+# The extensions of the pattern files in a library
+EXTENSIONS = (".lif", BINARY_EXTENSION)
+# The settings of a pattern kept in the index, the ones that describe its rule and grid
+INDEX_SETTINGS = ("grid_size", "birthrate", "deathrate", "aliverate", "rulestring")
+# The version of the index cache file, a cache of another version is ignored
+INDEX_VERSION = 1
+
+# The summary of a pattern. box is ((low x, y, z), (high x, y, z)) with high exclusive, or None if empty
+PatternInfo = namedtuple("PatternInfo", ["name", "path", "count", "box", "settings"])
+
+
+def default_cache_path():
+    # The per-user path of the index cache
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "life3d", "patterns.json")
+
+
+def pattern_directories(directories=()):
+    # Add the directories listed in LIFE3D_PATTERNS to a list of directories
+    extra = [d for d in os.environ.get("LIFE3D_PATTERNS", "").split(os.pathsep) if d]
+    return list(directories) + extra
+
+
+class PatternLibrary:
+    """
+    Lists, describes and loads the patterns of a set of directories.
+    Attributes:
+        directories (list): The directories searched for pattern files, in order.
+        cache_path (str): The file the index is kept in between runs, or None to keep it in memory.
+        max_patterns (int): The most parsed patterns kept in memory.
+    Methods:
+        names(): Returns the sorted names of the patterns, without parsing them.
+        path(name): Returns the file of a pattern.
+        info(name): Returns the PatternInfo of a pattern, parsing it only if the index is stale.
+        load(name): Returns the cells and settings of a pattern, from memory if it was loaded recently.
+        refresh(): Lists the directories again on the next call.
+        save_index(): Writes the index cache if it changed.
+    """
+
+    def __init__(self, directories, cache_path=None, max_patterns=32):
+        self.directories = [os.path.abspath(d) for d in pattern_directories(directories)]
+        self.cache_path = cache_path
+        self.max_patterns = max_patterns
+        self._files = None
+        self._index = self._read_index()
+        self._index_changed = False
+        self._patterns = OrderedDict()
+
+    def _read_index(self):
+        # Read the index cache, starting empty if there is none or it cannot be read
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != INDEX_VERSION:
+            return {}
+        return data.get("patterns", {})
+
+    def save_index(self):
+        # Write the index cache if it changed, a cache that cannot be written is skipped
+        if self.cache_path is None or not self._index_changed:
+            return
+        # Forget the files of these directories that are gone
+        for path in list(self._index):
+            if os.path.dirname(path) in self.directories and not os.path.exists(path):
+                del self._index[path]
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, 'w', encoding='utf-8') as file:
+                json.dump({"version": INDEX_VERSION, "patterns": self._index}, file)
+            self._index_changed = False
+        except OSError:
+            pass
+
+    def refresh(self):
+        # List the directories again on the next call, for files added or removed since
+        self._files = None
+
+    def _scan(self):
+        # Map the name of every pattern file to its path, the first directory winning
+        if self._files is None:
+            files = {}
+            for directory in self.directories:
+                try:
+                    entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+                except OSError:
+                    continue
+                for entry in entries:
+                    name, extension = os.path.splitext(entry.name)
+                    if extension in EXTENSIONS and name not in files and entry.is_file():
+                        files[name] = entry.path
+            self._files = files
+        return self._files
+
+    def names(self):
+        # Return the sorted names of the patterns, without parsing them
+        return sorted(self._scan())
+
+    def path(self, name):
+        # Return the file of a pattern
+        try:
+            return self._scan()[name]
+        except KeyError:
+            raise KeyError(f"No pattern named {name!r} in {', '.join(self.directories)}") from None
+
+    def _stamp(self, path):
+        # The modification time and size that tell whether a file changed
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def info(self, name):
+        # Return the PatternInfo of a pattern, parsing it only if the index is stale
+        path = self.path(name)
+        entry = self._index.get(path)
+        if entry is None or entry["stamp"] != self._stamp(path):
+            self.load(name)
+            entry = self._index[path]
+        box = tuple(map(tuple, entry["box"])) if entry["box"] is not None else None
+        return PatternInfo(name, path, entry["count"], box, entry["settings"])
+
+    def load(self, name):
+        # Return the (N, 3) cells and the settings of a pattern
+        # A pattern loaded recently comes from memory unless its file changed since
+        path = self.path(name)
+        stamp = self._stamp(path)
+        cached = self._patterns.get(path)
+        if cached is not None and cached[0] == stamp:
+            self._patterns.move_to_end(path)
+            return cached[1], dict(cached[2])
+        cells, settings = read_pattern(path)
+        cells.setflags(write=False)
+        self._patterns[path] = (stamp, cells, settings)
+        self._patterns.move_to_end(path)
+        while len(self._patterns) > self.max_patterns:
+            self._patterns.popitem(last=False)
+        if len(cells):
+            box = [cells.min(axis=0).tolist(), (cells.max(axis=0) + 1).tolist()]
+        else:
+            box = None
+        self._index[path] = {"stamp": stamp, "count": len(cells), "box": box,
+                             "settings": {i: settings[i] for i in INDEX_SETTINGS if i in settings}}
+        self._index_changed = True
+        return cells, dict(settings)
@@ -0,0 +1,187 @@
+"""
+
+This module defines a multi-core version of the dense engine.
+The grid lives in shared memory and is cut into slabs along its outermost
+axis, which is the contiguous one in memory. Each generation every slab is
+stepped by a worker process that reads its slab plus a one cell halo on
+either side straight from the shared grid, so there is no copying between
+processes. The generation is double buffered: workers read the old buffers
+and write the new ones, so a slab never sees its neighbour half updated.
+The neighbour counts are a fifth shared buffer: the second phase of a step
+counts the new generation once, marking the dying cells with those counts
+and leaving them for the first phase of the next step.
+Classes:
+    ParallelDenseEngine: DenseEngine whose steps run on a process pool over shared memory.
+
+
+"""
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .coords import pack_array
+from .dense import DenseEngine, neighbor_counts, next_generation
+from .profiler import profiler
+
+# The shared buffers a worker process has attached to, keyed by name
+_attached = {}
+
+
+def _view(name, shape, dtype):
+    # Attach to a shared buffer in a worker process and return it as an array
+    # Worker processes share the engine's resource tracker, so attaching does not
+    # hand the buffer to a tracker that would free it when the worker exits
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+def _release(keep):
+    # Detach from the shared buffers of an earlier grid
+    for name in list(_attached):
+        if name not in keep:
+            _attached.pop(name).close()
+
+
+def _slab_counts(alive, lo, hi):
+    # Count the alive neighbours of the slab lo:hi using a one cell halo on either side
+    halo_lo = max(lo - 1, 0)
+    halo_hi = min(hi + 1, alive.shape[0])
+    return neighbor_counts(alive[halo_lo:halo_hi])[lo - halo_lo:hi - halo_lo]
+
+
+def _step_slab(task):
+    # Step one slab in a worker process
+    # Phase 0 applies the rules from the source buffers into the other buffers
+    # using the shared counts. Phase 1 counts the source buffers into the shared
+    # counts and marks the cells that will die next cycle
+    phase, names, shape, source, lo, hi, rule = task
+    _release(names)
+    alive = [_view(names[i], shape, bool) for i in (0, 1)]
+    state = [_view(names[i + 2], shape, np.int32) for i in (0, 1)]
+    counts = _view(names[4], shape, np.uint8)
+    if phase == 0:
+        new_alive, new_state = next_generation(alive[source][lo:hi], state[source][lo:hi], counts[lo:hi], rule)
+        alive[1 - source][lo:hi] = new_alive
+        state[1 - source][lo:hi] = new_state
+    else:
+        counts[lo:hi] = _slab_counts(alive[source], lo, hi)
+        slab = state[source][lo:hi]
+        slab[alive[source][lo:hi] & rule.marks[counts[lo:hi]]] = -1
+    return 0
+
+
+def _unlink(blocks):
+    # Free shared buffers that are no longer used
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # An array still points into the buffer, the mapping goes when it does
+            pass
+        block.unlink()
+
+
+class ParallelDenseEngine(DenseEngine):
+    """
+    DenseEngine whose steps run on a process pool over shared memory.
+    It gives the same cells and states as DenseEngine and SparseEngine. Grids
+    smaller than min_parallel_size are stepped in this process, where the
+    cost of the pool would outweigh the work.
+    Attributes:
+        workers (int): The number of worker processes and slabs.
+        min_parallel_size (int): The smallest grid size stepped on the pool.
+        pool (ProcessPoolExecutor): The worker processes, started on the first parallel step.
+    Methods:
+        step(): Advances the game by one generation.
+        close(): Stops the worker processes and frees the shared memory.
+    """
+
+    def __init__(self, grid_size=10, birthrate=3, deathrate=4, aliverate=2, workers=None, min_parallel_size=64):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel_size = min_parallel_size
+        self.pool = None
+        self._blocks = []
+        self._finalizer = None
+        DenseEngine.__init__(self, grid_size, birthrate, deathrate, aliverate)
+
+    def _allocate(self, grid_size):
+        # Allocate the two alive and two state buffers and the counts in shared memory
+        # The engine's alive and state arrays are the current pair of buffers
+        shape = (grid_size,) * 3
+        cells = max(1, grid_size ** 3)
+        blocks = [shared_memory.SharedMemory(create=True, size=cells * size) for size in (1, 1, 4, 4, 1)]
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                  for block, dtype in zip(blocks, (bool, bool, np.int32, np.int32, np.uint8))]
+        for array in arrays:
+            array[...] = 0
+        self._blocks = blocks
+        self._buffers = arrays
+        self._source = 0
+        self._finalizer = weakref.finalize(self, _unlink, blocks)
+        return arrays[0], arrays[2], arrays[4]
+
+    def _set_grid_size(self, value):
+        # Resize as DenseEngine does, then free the shared buffers of the old size
+        finalizer = self._finalizer
+        DenseEngine.grid_size.fset(self, value)
+        if finalizer is not self._finalizer:
+            finalizer()
+
+    grid_size = property(DenseEngine.grid_size.fget, _set_grid_size)
+
+    def step(self):
+        # Advance the game by one step
+        # The whole grid is stepped, so the active region tracking of DenseEngine is reset
+        # The old generation stays in the other pair of buffers, so the cells that changed
+        # can be found for the hash afterwards
+        old, kept = self.alive, self._hash
+        if self.grid_size < self.min_parallel_size or self.workers < 2:
+            self._step_serial()
+        else:
+            self._run_phase(0, self._source)
+            self._source = 1 - self._source
+            self._run_phase(1, self._source)
+            self.alive = self._buffers[self._source]
+            self.state = self._buffers[self._source + 2]
+        self._forget_activity()
+        if kept is not None:
+            self._hash = kept
+            self._hash_changes(pack_array(np.argwhere(old != self.alive)))
+        self.generation += 1
+
+    def _step_serial(self):
+        # Step in this process, writing into the other pair of shared buffers
+        target = 1 - self._source
+        new_alive, new_state = next_generation(self.alive, self.state, self.counts, self.rule)
+        with profiler.section("neighbour counts"):
+            self.counts[...] = neighbor_counts(new_alive)
+        new_state[new_alive & self.rule.marks[self.counts]] = -1
+        self._buffers[target][...] = new_alive
+        self._buffers[target + 2][...] = new_state
+        self._source = target
+        self.alive = self._buffers[target]
+        self.state = self._buffers[target + 2]
+
+    def _run_phase(self, phase, source):
+        # Run one phase over every slab and wait for all of them, which is the halo barrier
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+        names = [block.name for block in self._blocks]
+        bounds = np.linspace(0, self.grid_size, min(self.workers, self.grid_size) + 1).astype(int)
+        tasks = [(phase, names, self.alive.shape, source, int(lo), int(hi), self.rule)
+                 for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        with profiler.section("slab phase", phase=phase):
+            list(self.pool.map(_step_slab, tasks))
+
+    def close(self):
+        # Stop the worker processes and free the shared memory
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.alive = self.state = None
+        self._buffers = []
+        self._finalizer()
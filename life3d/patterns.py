@@ -0,0 +1,136 @@
+"""
+
+This module reads and writes the JSON .lif and binary .lifb pattern files.
+A .lif file holds the live cells under "grid" as a list of [x, y, z]
+coordinates, and the viewer and rule settings under "griditems".
+A .lifb file holds the same settings in a JSON header, then the cells as a
+payload that is memory mapped and handed to the engine as one array instead
+of being parsed cell by cell. The payload is whichever is smaller of the
+coordinates as int32 triples, or a bitmap of the box around the cells with
+one bit per cell, which suits dense patterns.
+File layout of .lifb:
+    The magic bytes, then the length and text of a JSON header holding the
+    "griditems" settings, the "encoding" (coords or bitmap), the number of
+    cells and, for a bitmap, the "origin" and "shape" of its box.
+    Padding up to a multiple of 8 bytes, then the payload.
+Functions:
+    read_lif(file_path): Reads a .lif file and returns its cells and settings.
+    write_lif(file_path, cells, settings): Writes cells and settings to a .lif file.
+    read_pattern(file_path): Reads a .lif or .lifb file and returns its cells as an array and its settings.
+    write_pattern(file_path, cells, settings, encoding=None): Writes cells and settings to a .lifb file.
+    save_pattern(file_path, cells, settings): Writes a .lif or .lifb file chosen by the extension.
+    convert_pattern(source, target): Converts a pattern file to the format of the target extension.
+
+
+"""
+import json
+import struct
+
+import numpy as np
+
+from .coords import coord_array, pack_array, unpack_array
+
+BINARY_MAGIC = b"LIFEPAT1"
+# The extension of binary pattern files
+BINARY_EXTENSION = ".lifb"
+ENCODINGS = ("coords", "bitmap")
+
+
+def read_lif(file_path):
+    # Read a .lif file and return the list of (x, y, z) cells and the settings dictionary
+    with open(file_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    cells = [(int(x), int(y), int(z)) for x, y, z in data["grid"]]
+    return cells, data.get("griditems", {})
+
+
+def write_lif(file_path, cells, settings):
+    # Write the (x, y, z) cells and the settings dictionary to a .lif file
+    gridlist = [(int(x), int(y), int(z)) for x, y, z in cells]
+    json_string = json.dumps({"grid": gridlist, "griditems": settings}, indent=4)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write(json_string)
+
+
+def _payload_offset(header_length):
+    # The payload starts after the header, aligned to 8 bytes so it can be mapped as an array
+    end = len(BINARY_MAGIC) + 4 + header_length
+    return (end + 7) // 8 * 8
+
+
+def write_pattern(file_path, cells, settings, encoding=None):
+    # Write cells and settings to a binary .lifb file
+    # Without an encoding the smaller of the coordinates and the bitmap is written
+    keys = np.sort(pack_array(coord_array(cells)))
+    coords = unpack_array(keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys)
+    header = {"griditems": settings, "count": len(coords)}
+    if len(coords):
+        origin = coords.min(axis=0)
+        shape = coords.max(axis=0) - origin + 1
+    else:
+        origin = shape = np.zeros(3, dtype=np.int64)
+    if encoding is None:
+        encoding = "bitmap" if (int(np.prod(shape)) + 7) // 8 < 12 * len(coords) else "coords"
+    if encoding == "coords":
+        payload = coords.astype("<i4").tobytes()
+    elif encoding == "bitmap":
+        bitmap = np.zeros(tuple(int(n) for n in shape), dtype=bool)
+        bitmap[tuple((coords - origin).T)] = True
+        payload = np.packbits(bitmap.ravel(), bitorder="little").tobytes()
+        header["origin"] = origin.tolist()
+        header["shape"] = shape.tolist()
+    else:
+        raise ValueError(f"Unknown encoding {encoding!r}, expected one of {', '.join(ENCODINGS)}")
+    header["encoding"] = encoding
+    text = json.dumps(header).encode("utf-8")
+    padding = _payload_offset(len(text)) - len(BINARY_MAGIC) - 4 - len(text)
+    with open(file_path, "wb") as file:
+        file.write(BINARY_MAGIC + struct.pack("<I", len(text)) + text + bytes(padding))
+        file.write(payload)
+
+
+def _read_binary(file_path):
+    # Read a .lifb file, mapping its payload rather than reading it
+    with open(file_path, "rb") as file:
+        magic = file.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{file_path} is not a binary pattern file")
+        length, = struct.unpack("<I", file.read(4))
+        header = json.loads(file.read(length).decode("utf-8"))
+    offset = _payload_offset(length)
+    count = header["count"]
+    if count == 0:
+        return np.empty((0, 3), dtype=np.int64), header["griditems"]
+    if header["encoding"] == "coords":
+        coords = np.memmap(file_path, dtype="<i4", mode="r", offset=offset, shape=(count, 3))
+        return coords.astype(np.int64), header["griditems"]
+    shape = tuple(header["shape"])
+    bits = np.memmap(file_path, dtype=np.uint8, mode="r", offset=offset, shape=((int(np.prod(shape)) + 7) // 8,))
+    bitmap = np.unpackbits(bits, count=int(np.prod(shape)), bitorder="little").reshape(shape)
+    return np.argwhere(bitmap) + np.asarray(header["origin"], dtype=np.int64), header["griditems"]
+
+
+def read_pattern(file_path):
+    # Read a .lif or .lifb file, whichever it is, and return an (N, 3) int64 array of cells and the settings
+    with open(file_path, "rb") as file:
+        binary = file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    if binary:
+        return _read_binary(file_path)
+    with open(file_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    return coord_array(data["grid"]), data.get("griditems", {})
+
+
+def save_pattern(file_path, cells, settings):
+    # Write a binary pattern for a .lifb path and a JSON .lif file for any other
+    if str(file_path).endswith(BINARY_EXTENSION):
+        write_pattern(file_path, cells, settings)
+    else:
+        write_lif(file_path, coord_array(cells).tolist(), settings)
+
+
+def convert_pattern(source, target):
+    # Convert a pattern file to the format of the target's extension and return the number of cells
+    cells, settings = read_pattern(source)
+    save_pattern(target, cells, settings)
+    return len(cells)
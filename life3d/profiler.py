@@ -0,0 +1,201 @@
+"""
+
+This module times the hot paths of the simulation and the viewer, for seeing
+where the frame time goes in a running demo.
+Code marks a hot path with a section of the shared profiler, and the
+profiler keeps the count, total and recent times of every section and the
+latest value of every counter. While it is disabled a section is a shared
+do-nothing context, so the instrumentation costs one attribute check. The
+profiler can also stream every section and counter to a trace file in the
+Chrome trace event format, which chrome://tracing, Perfetto and Speedscope
+open, with one row per thread, so a generation stepped on the worker thread
+lines up with the frames drawn on the main thread.
+Classes:
+    Timer: The count, total and recent times of one section.
+    Profiler: Times sections and counters and writes them to a trace file.
+Attributes:
+    profiler (Profiler): The profiler shared by the engines, the worker and the viewer, disabled until enabled.
+
+
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+# The number of recent times a section's recent mean is taken over
+RECENT = 60
+
+# The section returned while the profiler is disabled, reusable and doing nothing
+_DISABLED = nullcontext()
+
+
+class Timer:
+    """
+    The count, total and recent times of one section.
+    Attributes:
+        count (int): The number of times the section ran.
+        total (float): The seconds spent in the section.
+        last (float): The seconds the section last took.
+        recent (deque): The seconds of the last RECENT runs.
+    Methods:
+        add(seconds): Adds a run of the section.
+        mean_ms(): Returns the mean of the recent runs in milliseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.recent = deque(maxlen=RECENT)
+
+    def add(self, seconds):
+        # Add a run of the section
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.recent.append(seconds)
+
+    def mean_ms(self):
+        # The mean of the recent runs in milliseconds, 0 if it never ran
+        recent = list(self.recent)
+        return 1000 * sum(recent) / len(recent) if recent else 0.0
+
+
+class _Section:
+    # Times a with block and hands the time to the profiler
+
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Profiler:
+    """
+    Times sections and counters and writes them to a trace file.
+    Sections and counters may be used from any thread.
+    Attributes:
+        enabled (bool): Whether sections are timed. Starting a trace enables the profiler.
+        timers (dict): The Timer of every section by name.
+        counters (dict): The latest value of every counter by name.
+        trace_path (str): The trace file being written, or None.
+    Methods:
+        section(name, **args): Returns a context that times a with block as the section name.
+        add(name, start, seconds, args=None): Adds a run of a section timed by the caller.
+        counter(name, value): Sets a counter, which the trace shows as a graph.
+        mean_ms(name): Returns the recent mean time of a section in milliseconds.
+        reset(): Forgets every time and counter.
+        start_trace(path): Starts writing every section and counter to a trace file.
+        stop_trace(): Finishes the trace file.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self.trace_path = None
+        self._trace = None
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def section(self, name, **args):
+        # Return a context that times a with block as the section name, with args shown in the trace
+        if not self.enabled:
+            return _DISABLED
+        return _Section(self, name, args)
+
+    def add(self, name, start, seconds, args=None):
+        # Add a run of a section that started at perf_counter() time start and took seconds
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.add(seconds)
+            if self._trace is not None:
+                event = {"name": name, "ph": "X", "ts": self._micros(start), "dur": round(seconds * 1e6, 3),
+                         "pid": os.getpid(), "tid": self._thread()}
+                if args:
+                    event["args"] = args
+                self._write(event)
+
+    def counter(self, name, value):
+        # Set a counter, such as the number of live cells, which the trace shows as a graph
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = value
+            if self._trace is not None:
+                self._write({"name": name, "ph": "C", "ts": self._micros(time.perf_counter()),
+                             "pid": os.getpid(), "args": {name: value}})
+
+    def mean_ms(self, name):
+        # The recent mean time of a section in milliseconds, 0 if it never ran
+        timer = self.timers.get(name)
+        return timer.mean_ms() if timer is not None else 0.0
+
+    def reset(self):
+        # Forget every time and counter
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def start_trace(self, path):
+        # Start writing every section and counter to a Chrome trace event file, enabling the profiler
+        # The events are written as they happen, so a trace cut short by a crash still opens
+        self.stop_trace()
+        with self._lock:
+            self._trace = open(path, 'w', encoding='utf-8')
+            self._trace.write('[\n')
+            self._threads = {}
+            self._first = True
+            self.trace_path = path
+        self.enabled = True
+
+    def stop_trace(self):
+        # Finish the trace file, leaving the profiler enabled
+        with self._lock:
+            if self._trace is None:
+                return
+            self._trace.write('\n]\n')
+            self._trace.close()
+            self._trace = None
+            self.trace_path = None
+
+    def _micros(self, seconds):
+        # Turn a perf_counter() time into trace microseconds
+        return round((seconds - self._origin) * 1e6, 3)
+
+    def _thread(self):
+        # The trace id of the current thread, naming the thread in the trace the first time it is seen
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            tid = self._threads[ident] = len(self._threads) + 1
+            self._write({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                         "args": {"name": threading.current_thread().name}})
+        return tid
+
+    def _write(self, event):
+        # Write an event to the trace file, called holding the lock
+        if not self._first:
+            self._trace.write(',\n')
+        self._first = False
+        self._trace.write(json.dumps(event, separators=(',', ':')))
+
+
+# The profiler shared by the engines, the worker and the viewer
+profiler = Profiler()
@@ -0,0 +1,355 @@
+"""
+
+This module records every generation of a run to disk so it can be replayed
+or analysed later without simulating it again.
+A recording holds one frame per recorded generation. Most frames are deltas:
+the cells born, the cells that died and the cells marked as dying, from which
+the ages of every other cell follow because a surviving cell ages by one, up
+to the engine's max_age. The few cells whose state does not follow, such as
+cells edited between generations, are stored with their states. Every
+keyframe_interval frames, and whenever a frame is not the generation after
+the one before or most of its states do not follow, a keyframe holds every
+cell and its state instead. Cells are sorted packed keys stored as the first
+key and the gaps to the next, in the smallest integer type that fits, so a
+frame compresses to a few bytes per changed cell.
+File layout:
+    The magic bytes, then the length and text of a JSON header with the
+    grid size, rule and any settings passed to the recorder.
+    One chunk per frame: its kind (K or D), generation and length, then the
+    frame compressed with zlib, or with zstd when the zstandard package is
+    installed and asked for.
+    The index written on close: the generation, offset and kind of every
+    frame, then a footer pointing at the index. A recording that was never
+    closed has no index and is indexed by scanning its chunks instead.
+Classes:
+    Recorder: Streams generations to a recording file.
+    Recording: Reads frames of a recording file by position or generation.
+
+
+"""
+import json
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from .coords import pack_array, unpack_array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The compressions that can be written here, zstd only when zstandard is installed
+COMPRESSIONS = ("zlib", "zstd") if zstandard is not None else ("zlib",)
+
+MAGIC = b"LIFEREC1"
+END_MAGIC = b"LIFEEND1"
+# A chunk header: the kind, the generation and the length of the compressed frame
+CHUNK = struct.Struct("<cqI")
+# The footer: the offset of the index, the number of frames and END_MAGIC
+FOOTER = struct.Struct("<qq8s")
+KEYFRAME = b"K"
+DELTA = b"D"
+# An entry of the index: the generation, chunk offset and kind of a frame
+INDEX_DTYPE = np.dtype([("generation", "<i8"), ("offset", "<i8"), ("keyframe", "u1")])
+# The header holding the length of a key list, its first key and the size of its gaps
+KEYS = struct.Struct("<IqB")
+
+
+def _encode_keys(keys):
+    # Store sorted keys as the first key and the gaps to the next in the smallest type that fits
+    if len(keys) == 0:
+        return KEYS.pack(0, 0, 1)
+    gaps = np.diff(keys)
+    largest = int(gaps.max()) if len(gaps) else 0
+    size = next(size for size in (1, 2, 4, 8) if largest < 1 << (8 * size - 1))
+    return KEYS.pack(len(keys), int(keys[0]), size) + gaps.astype(f"<i{size}").tobytes()
+
+
+def _decode_keys(data, offset):
+    # Read a key list written by _encode_keys and return it with the offset after it
+    count, first, size = KEYS.unpack_from(data, offset)
+    offset += KEYS.size
+    if count == 0:
+        return np.empty(0, dtype=np.int64), offset
+    keys = np.empty(count, dtype=np.int64)
+    keys[0] = first
+    gaps = np.frombuffer(data, dtype=f"<i{size}", count=count - 1, offset=offset)
+    np.cumsum(gaps, out=keys[1:])
+    keys[1:] += first
+    return keys, offset + (count - 1) * size
+
+
+def _compressor(name):
+    # Return the compress and decompress functions of a compression name
+    if name == "zlib":
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    if name == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f"Unknown compression {name!r}, expected zlib or zstd")
+
+
+def _sorted_cells(coords, states):
+    # Pack cells into sorted keys with their states in the same order
+    keys = pack_array(coords)
+    order = np.argsort(keys)
+    return keys[order], np.asarray(states, dtype=np.int32)[order]
+
+
+def _apply_delta(keys, states, born, died, dying, max_age):
+    # Step the sorted cells of a frame on to the next frame
+    # Survivors age by one up to max_age, the born cells start at 1 and the dying cells are marked -1
+    survive = ~np.isin(keys, died, assume_unique=True)
+    aged = states[survive] + 1
+    if max_age is not None:
+        np.minimum(aged, max_age, out=aged)
+    keys = np.concatenate((keys[survive], born))
+    states = np.concatenate((aged, np.ones(len(born), dtype=np.int32)))
+    order = np.argsort(keys, kind="stable")
+    keys, states = keys[order], states[order]
+    states[np.searchsorted(keys, dying)] = -1
+    return keys, states
+
+
+def _decode_delta(data, keys, states, max_age):
+    # Apply a delta frame to the sorted cells of the frame before it
+    born, offset = _decode_keys(data, 0)
+    died, offset = _decode_keys(data, offset)
+    dying, offset = _decode_keys(data, offset)
+    restated, offset = _decode_keys(data, offset)
+    keys, states = _apply_delta(keys, states, born, died, dying, max_age)
+    states[np.searchsorted(keys, restated)] = np.frombuffer(data, dtype="<i4", count=len(restated), offset=offset)
+    return keys, states
+
+
+class Recorder:
+    """
+    Streams generations to a recording file.
+    Call record with the cells of each generation, or record_engine with the
+    engine after each step. Frames are written as they are recorded,
+    so a long run never holds more than two generations in memory.
+    Attributes:
+        path (str): The path of the recording file.
+        header (dict): The grid size, rule and settings written at the start of the file.
+        keyframe_interval (int): The largest number of frames between keyframes.
+        max_age (int): The age at which the engine stops counting, or None if it never does.
+        frames (int): The number of frames recorded.
+        keyframes (int): The number of those frames that are keyframes.
+    Methods:
+        for_engine(path, engine, ...): Creates a recorder with the grid size, rule and age limit of an engine.
+        record(generation, coords, states): Records the cells of a generation.
+        record_engine(engine): Records the current generation of an engine.
+        close(): Writes the index and closes the file.
+    """
+
+    def __init__(self, path, grid_size, rule, keyframe_interval=100, compression="zlib", max_age=None,
+                 settings=None):
+        self.path = path
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.max_age = max_age
+        self._compress = _compressor(compression)[0]
+        self.header = dict(settings or {}, grid_size=int(grid_size), rule=str(rule),
+                           keyframe_interval=self.keyframe_interval, compression=compression, max_age=max_age)
+        self.frames = 0
+        self.keyframes = 0
+        self._index = []
+        self._previous = None
+        self._since_keyframe = 0
+        self._file = open(path, "wb")
+        header = json.dumps(self.header).encode("utf-8")
+        self._file.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def record(self, generation, coords, states):
+        # Record the cells of a generation as a delta from the last frame, or as a keyframe
+        keys, states = _sorted_cells(coords, states)
+        payload = None
+        if self._previous is not None and self._since_keyframe < self.keyframe_interval:
+            payload = self._delta(generation, keys, states)
+        if payload is None:
+            kind = KEYFRAME
+            payload = _encode_keys(keys) + states.astype("<i4").tobytes()
+            self._since_keyframe = 0
+            self.keyframes += 1
+        else:
+            kind = DELTA
+        self._since_keyframe += 1
+        data = self._compress(payload)
+        self._index.append((generation, self._file.tell(), kind == KEYFRAME))
+        self._file.write(CHUNK.pack(kind, generation, len(data)) + data)
+        self._previous = (generation, keys, states)
+        self.frames += 1
+
+    @classmethod
+    def for_engine(cls, path, engine, keyframe_interval=100, compression="zlib", settings=None):
+        # Create a recorder with the grid size, rule and age limit of an engine
+        return cls(path, engine.grid_size, engine.rule, keyframe_interval, compression,
+                   getattr(engine, "max_age", None), settings)
+
+    def record_engine(self, engine):
+        # Record the current generation of an engine
+        coords, states = engine.cell_arrays()
+        self.record(engine.generation, coords, states)
+
+    def _delta(self, generation, keys, states):
+        # Encode the change from the last frame, or return None if the frame does not follow from it
+        last_generation, last_keys, last_states = self._previous
+        if generation != last_generation + 1:
+            return None
+        born = keys[~np.isin(keys, last_keys, assume_unique=True)]
+        died = last_keys[~np.isin(last_keys, keys, assume_unique=True)]
+        dying = keys[states == -1]
+        _, expected = _apply_delta(last_keys, last_states, born, died, dying, self.max_age)
+        restated = np.flatnonzero(expected != states)
+        if 2 * len(restated) > len(states):
+            # Most of the states do not follow, so a keyframe is as small
+            return None
+        return (_encode_keys(born) + _encode_keys(died) + _encode_keys(dying) + _encode_keys(keys[restated])
+                + states[restated].astype("<i4").tobytes())
+
+    def close(self):
+        # Write the index and the footer and close the file
+        if self._file.closed:
+            return
+        index_offset = self._file.tell()
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        self._file.write(index.tobytes())
+        self._file.write(FOOTER.pack(index_offset, len(index), END_MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Recording:
+    """
+    Reads frames of a recording file by position or generation.
+    The file is memory mapped and the index is read in place, so opening a
+    long recording costs the same as a short one and only the frames read
+    are paged in. Reading a frame decodes the keyframe before it and applies
+    at most keyframe_interval deltas, so seeking anywhere takes about the
+    same time. Reading the frame after the last one read applies one delta.
+    Attributes:
+        path (str): The path of the recording file.
+        header (dict): The grid size, rule and settings the recording was made with.
+        generations (ndarray): The generation of every frame.
+        offsets (ndarray): The file offset of every frame's chunk.
+        keyframes (ndarray): Whether every frame is a keyframe.
+    Methods:
+        frame(position): Returns the coords and states of the frame at a position.
+        find(generation): Returns the position of the last frame of a generation.
+        close(): Unmaps and closes the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped
+            self._file.close()
+            raise ValueError(f"{path} is not a recording") from None
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a recording")
+        length, = struct.unpack_from("<I", self._map, len(MAGIC))
+        self._start = len(MAGIC) + 4 + length
+        self.header = json.loads(self._map[len(MAGIC) + 4:self._start].decode("utf-8"))
+        self._decompress = _compressor(self.header.get("compression", "zlib"))[1]
+        self._read_index()
+        # The positions of the keyframes, which every frame is decoded from
+        self._keyframe_positions = np.flatnonzero(self.keyframes)
+        self._cached = None
+
+    def _read_index(self):
+        # Point at the index in the mapped file, or rebuild it by scanning the chunks
+        end = len(self._map)
+        footer = None
+        if end - self._start >= FOOTER.size:
+            footer = FOOTER.unpack_from(self._map, end - FOOTER.size)
+        if footer is not None and footer[2] == END_MAGIC:
+            index_offset, count, _ = footer
+            index = np.frombuffer(self._map, dtype=INDEX_DTYPE, count=count, offset=index_offset)
+        else:
+            index = self._scan(end)
+        self.generations = index["generation"]
+        self.offsets = index["offset"]
+        self.keyframes = index["keyframe"].view(bool)
+
+    def _scan(self, end):
+        # Index a recording that was not closed, stopping at a chunk cut short
+        entries = []
+        offset = self._start
+        while offset + CHUNK.size <= end:
+            kind, generation, length = CHUNK.unpack_from(self._map, offset)
+            if kind not in (KEYFRAME, DELTA) or offset + CHUNK.size + length > end:
+                break
+            entries.append((generation, offset, kind == KEYFRAME))
+            offset += CHUNK.size + length
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.generations)
+
+    def _payload(self, position):
+        # Decompress the frame at a position straight from the mapped file
+        offset = int(self.offsets[position])
+        _, _, length = CHUNK.unpack_from(self._map, offset)
+        start = offset + CHUNK.size
+        return self._decompress(self._map[start:start + length])
+
+    def _keys(self, position):
+        # Return the sorted keys and states of the frame at a position
+        keyframe = int(self._keyframe_positions[np.searchsorted(self._keyframe_positions, position, "right") - 1])
+        if self._cached is not None and keyframe <= self._cached[0] <= position:
+            # Carry on from the last frame read instead of going back to the keyframe
+            start, keys, states = self._cached
+        else:
+            start = keyframe
+            data = self._payload(start)
+            keys, offset = _decode_keys(data, 0)
+            states = np.frombuffer(data, dtype="<i4", count=len(keys), offset=offset).astype(np.int32)
+        for i in range(start + 1, position + 1):
+            keys, states = _decode_delta(self._payload(i), keys, states, self.header.get("max_age"))
+        self._cached = (position, keys, states)
+        return keys, states
+
+    def frame(self, position):
+        # Return the (N, 3) coords and the states of the frame at a position
+        if not -len(self) <= position < len(self):
+            raise IndexError(f"Frame {position} is outside the {len(self)} frames of the recording")
+        keys, states = self._keys(position % len(self))
+        return unpack_array(keys), states.copy()
+
+    def find(self, generation):
+        # Return the position of the last frame recorded for a generation
+        positions = np.flatnonzero(self.generations == generation)
+        if len(positions) == 0:
+            raise KeyError(f"Generation {generation} is not in the recording")
+        return int(positions[-1])
+
+    def close(self):
+        # Unmap and close the file
+        # The index arrays point into the mapping, so they go with it
+        self.generations = self.offsets = self.keyframes = None
+        self._keyframe_positions = np.empty(0, dtype=np.int64)
+        self._cached = None
+        try:
+            self._map.close()
+        except BufferError:
+            # An array taken from the index still points into the mapping, it goes when that does
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,653 @@
+"""
+
+This module draws the live cells of an engine with Panda3D.
+Every live cell becomes a cube in one procedurally built vertex buffer, so the
+whole population is a single GeomNode and a single draw call instead of one
+loadModel("models/box") node per cell. Each cell keeps its slot in the buffer
+between generations, so an update only writes the cubes of cells that were
+born or died and the colours of cells whose state changed. SurfaceMesh draws
+the cells as solid voxels instead, with only the faces between live and dead
+cells, and each plane of faces of one colour merged into as few rectangles as
+the greedy meshing of its rows finds. It only finds the faces again in the
+chunks of 16 cells a side the last generation changed, and draws the chunks
+of a region of 4 chunks a side as one Geom. Seen from far away a cell covers
+less than a pixel, so LodMesh only draws the cells near the camera with one
+of these and merges the cells further away into blocks of 2, 4 or 8 cells a
+side, each drawn as one translucent voxel shaded by how full it is. Unlike
+the rest of life3d this module needs Panda3D, so it is not imported by
+life3d/__init__.py.
+Classes:
+    CellMesh: A single GeomNode holding a cube for every live cell.
+    SurfaceMesh: A single GeomNode holding the merged surface faces of the live cells, a Geom per region of chunks.
+    LodMesh: Cubes or surfaces for the cells near the camera and density voxels for the cells further away.
+Functions:
+    state_classes(states): Maps cell states to new, mature and dying colour classes.
+    state_colors(states): Maps cell states to RGBA byte colours.
+    cube_vertices(coords, colors, cube_size): Builds the vertex rows for a cube per cell.
+    cube_indices(count, base=0, rows=CUBE_ROWS, pattern=CUBE_INDICES): Builds the triangle indices for count cubes.
+    cube_geom(vertices, rows=CUBE_ROWS, pattern=CUBE_INDICES): Builds a Geom from the vertex rows of whole cubes.
+    voxel_vertices(blocks, level, colors, cube_size): Builds the vertex rows for a voxel per block.
+    surface_quads(coords, labels, keys, chunks, axis, side): Finds the merged faces of cells along one direction.
+    quad_vertices(quads, origins, axis, side, cube_size): Builds the vertex rows for a quad per merged face.
+
+
+"""
+import numpy as np
+from panda3d.core import (Geom, GeomEnums, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat,
+                          TransparencyAttrib)
+
+from .chunked import CHUNK_BITS, CHUNK_SIZE
+from .coords import pack_array, unpack_array
+
+# The colours of the cell states, 1 is alive, -1 is dead next cycle, anything else is alive and mature
+NEW_COLOR = (0, 255, 0, 255)
+DYING_COLOR = (255, 0, 0, 255)
+MATURE_COLOR = (0, 0, 255, 255)
+# The colour classes of the cell states, indexing CLASS_COLORS
+NEW, MATURE, DYING = 0, 1, 2
+CLASS_COLORS = np.array([NEW_COLOR, MATURE_COLOR, DYING_COLOR], dtype=np.uint8)
+# The smallest number of cube slots allocated in the vertex buffer
+MIN_CAPACITY = 64
+# The camera distances, in cells, beyond which LodMesh merges cells into blocks of 2, 4 and 8 a side
+LOD_DISTANCES = (300, 600, 1200)
+# The largest block is 8 cells a side, the block the level of detail is chosen for
+LOD_LEVELS = len(LOD_DISTANCES)
+# The most voxels drawn. Sparse far cells fill a voxel each, so past this the far blocks are merged
+# again, up to MAX_LEVEL, 32 cells a side
+VOXEL_BUDGET = 50000
+MAX_LEVEL = 5
+# SurfaceMesh draws the chunks of a region of 4 chunks a side as one Geom
+REGION_BITS = 2
+# The ways LodMesh can draw the cells near the camera, solid surfaces or a cube per cell
+MESHES = ("surface", "cubes")
+# The opacity of a voxel holding one cell and of a full voxel, out of 255
+VOXEL_ALPHA = (40, 230)
+
+# Vertex rows are a position, a normal and a byte colour, matching GeomVertexFormat.getV3n3c4()
+VERTEX_FORMAT = GeomVertexFormat.getV3n3c4()
+VERTEX_DTYPE = np.dtype([("vertex", "<f4", (3,)), ("normal", "<f4", (3,)), ("color", "u1", (4,))])
+
+
+def _unit_cube():
+    # Build the 24 corners (4 per face, so each face has its own normal) of a cube
+    # spanning 0 to 1, the same extent as models/box, and the 36 triangle indices
+    corners = []
+    normals = []
+    indices = []
+    square = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    for axis in range(3):
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        for side in (0, 1):
+            # u x v points along +axis, so the far face keeps the winding and the near face reverses it
+            order = square if side else square[::-1]
+            base = len(corners)
+            for a, b in order:
+                corner = [0, 0, 0]
+                corner[axis], corner[u], corner[v] = side, a, b
+                corners.append(corner)
+                normal = [0, 0, 0]
+                normal[axis] = 1 if side else -1
+                normals.append(normal)
+            indices += [base, base + 1, base + 2, base, base + 2, base + 3]
+    return (np.array(corners, dtype=np.float32), np.array(normals, dtype=np.float32),
+            np.array(indices, dtype=np.uint32))
+
+
+CUBE_CORNERS, CUBE_NORMALS, CUBE_INDICES = _unit_cube()
+CUBE_ROWS = len(CUBE_CORNERS)
+# A quad is one face of the cube, its 4 corners and 2 triangles
+QUAD_ROWS = 4
+QUAD_INDICES = CUBE_INDICES[:6]
+# The corners of a quad as (u, v) steps, anticlockwise seen from the +axis side
+QUAD_CORNERS = np.array([(0, 0), (1, 0), (1, 1), (0, 1)])
+
+
+def state_classes(states):
+    # Map an array of cell states to colour classes
+    # 1 is alive, -1 is dead next cycle, anything else is alive and mature
+    states = np.asarray(states)
+    classes = np.full(len(states), MATURE, dtype=np.uint8)
+    classes[states == 1] = NEW
+    classes[states == -1] = DYING
+    return classes
+
+
+def state_colors(states):
+    # Map an array of cell states to an (N, 4) array of RGBA byte colours
+    return CLASS_COLORS[state_classes(states)]
+
+
+def cube_vertices(coords, colors, cube_size):
+    # Build the vertex rows of a cube per cell, placed the way create_cubes placed models/box
+    coords = np.asarray(coords, dtype=np.float32).reshape(-1, 3)
+    rows = np.empty((len(coords), CUBE_ROWS), dtype=VERTEX_DTYPE)
+    rows["vertex"] = coords[:, None, :] * (cube_size * 2) + CUBE_CORNERS[None, :, :] * cube_size
+    rows["normal"] = CUBE_NORMALS[None, :, :]
+    rows["color"] = np.asarray(colors, dtype=np.uint8)[:, None, :]
+    return rows.reshape(-1)
+
+
+def cube_indices(count, base=0, rows=CUBE_ROWS, pattern=CUBE_INDICES):
+    # Build the triangle indices for count cubes whose rows start at cube number base
+    # rows and pattern give the shape repeated, QUAD_ROWS and QUAD_INDICES for quads
+    starts = (np.arange(base, base + count, dtype=np.uint32) * rows)[:, None]
+    return (starts + pattern[None, :]).reshape(-1)
+
+
+def cube_geom(vertices, rows=CUBE_ROWS, pattern=CUBE_INDICES):
+    # Build a Geom drawing the vertex rows of whole cubes, rows rows per cube
+    count = len(vertices) // rows
+    vdata = GeomVertexData("cells", VERTEX_FORMAT, Geom.UH_dynamic)
+    vdata.uncleanSetNumRows(len(vertices))
+    vdata.modifyArrayHandle(0).copyDataFrom(vertices)
+    triangles = GeomTriangles(Geom.UH_static)
+    triangles.setIndexType(GeomEnums.NT_uint32)
+    indices = cube_indices(count, 0, rows, pattern)
+    handle = triangles.modifyVertices()
+    handle.uncleanSetNumRows(len(indices))
+    handle.modifyHandle().copyDataFrom(indices)
+    geom = Geom(vdata)
+    geom.addPrimitive(triangles)
+    return geom
+
+
+def voxel_vertices(blocks, level, colors, cube_size):
+    # Build the vertex rows of a voxel per block of 2**level cells a side, covering the
+    # cubes of the cells in the block
+    spacing = cube_size * 2
+    side = 1 << level
+    blocks = np.asarray(blocks, dtype=np.float32).reshape(-1, 3)
+    rows = np.empty((len(blocks), CUBE_ROWS), dtype=VERTEX_DTYPE)
+    rows["vertex"] = (blocks[:, None, :] * (side * spacing)
+                      + CUBE_CORNERS[None, :, :] * (side * spacing - spacing + cube_size))
+    rows["normal"] = CUBE_NORMALS[None, :, :]
+    rows["color"] = np.asarray(colors, dtype=np.uint8)[:, None, :]
+    return rows.reshape(-1)
+
+
+def surface_quads(coords, labels, keys, chunks, axis, side):
+    # Find the merged faces of the cells facing along axis towards side, 1 or -1, with labels
+    # 1 plus their colour classes, keys the sorted packed keys of every live cell and chunks
+    # the sorted packed chunks the cells are in
+    # Returns an (M, 7) array of chunk index, layer, u0, u1, v0, v1 and label, in chunk order,
+    # where u and v are the axes after axis, as in the cube faces. Faces are first merged into
+    # runs along v, then runs with the same ends and colour in successive rows u into
+    # rectangles, never across the face of a chunk
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    step = np.zeros(3, dtype=np.int64)
+    step[axis] = side
+    neighbours = pack_array(coords + step)
+    index = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+    exposed = keys[index] != neighbours
+    if not exposed.any():
+        return np.zeros((0, 7), dtype=np.int64)
+    cells, label = coords[exposed], labels[exposed].astype(np.int64)
+    chunk = np.searchsorted(chunks, pack_array(cells >> CHUNK_BITS))
+    local = cells & (CHUNK_SIZE - 1)
+
+    # Every face is one key of its chunk, colour, layer, row u and v, so a face is the one
+    # before it along v plus one, unless v wrapped round to 0
+    faces = np.sort((chunk << 14) | (label << 12) | (local[:, axis] << 8) | (local[:, u] << 4) | local[:, v])
+    starts = np.flatnonzero(np.concatenate([[True], (faces[1:] != faces[:-1] + 1) | (faces[1:] & 15 == 0)]))
+    ends = np.append(starts[1:], len(faces)) - 1
+    # A run is a key of its chunk, colour, layer, first v, last v and row u, so a run continues
+    # the one in the row before it in the same way
+    first, last = faces[starts], faces[ends]
+    runs = np.sort(((first >> 8) << 12) | ((first & 15) << 8) | ((last & 15) << 4) | ((first >> 4) & 15))
+    starts = np.flatnonzero(np.concatenate([[True], (runs[1:] != runs[:-1] + 1) | (runs[1:] & 15 == 0)]))
+    ends = np.append(starts[1:], len(runs)) - 1
+    first, last = runs[starts], runs[ends]
+    return np.stack([first >> 18, (first >> 12) & 15, first & 15, (last & 15) + 1,
+                     (first >> 8) & 15, ((first >> 4) & 15) + 1, (first >> 16) & 3], axis=1).reshape(-1, 7)
+
+
+def quad_vertices(quads, origins, axis, side, cube_size):
+    # Build the vertex rows of a quad per merged face from surface_quads, with origins the
+    # first cell of each chunk. The cells are solid voxels centred on their cubes
+    spacing = cube_size * 2
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    corners = np.empty((len(quads), QUAD_ROWS, 3), dtype=np.int64)
+    corners[:, :, axis] = (quads[:, 1] + (side > 0))[:, None]
+    us = quads[:, 2:4][:, QUAD_CORNERS[:, 0]]
+    vs = quads[:, 4:6][:, QUAD_CORNERS[:, 1]]
+    # The far face keeps the winding and the near face reverses it, as in the cube
+    if side < 0:
+        us, vs = us[:, ::-1], vs[:, ::-1]
+    corners[:, :, u] = us
+    corners[:, :, v] = vs
+    corners += origins[quads[:, 0]][:, None, :]
+    rows = np.empty((len(quads), QUAD_ROWS), dtype=VERTEX_DTYPE)
+    rows["vertex"] = corners * spacing + (cube_size - spacing) / 2
+    normal = np.zeros(3, dtype=np.float32)
+    normal[axis] = side
+    rows["normal"] = normal
+    rows["color"] = CLASS_COLORS[quads[:, 6] - 1][:, None, :]
+    return rows.reshape(-1)
+
+
+def _member(keys, sorted_keys):
+    # Whether each key is in an array of sorted keys
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    return sorted_keys[np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)] == keys
+
+
+def _touched_chunks(coords):
+    # The packed chunks whose faces a change to the cells can alter: their own chunks, and the
+    # chunk across the face of every cell on the face of its chunk
+    home = coords >> CHUNK_BITS
+    local = coords & (CHUNK_SIZE - 1)
+    chunks = [home]
+    for axis in range(3):
+        for edge, step in ((0, -1), (CHUNK_SIZE - 1, 1)):
+            across = home[local[:, axis] == edge]
+            across[:, axis] += step
+            chunks.append(across)
+    return np.unique(pack_array(np.concatenate(chunks)))
+
+
+class CellMesh:
+    """
+    A single GeomNode holding a cube for every live cell.
+    The vertex buffer is split into slots of one cube each. The mesh keeps a
+    map from every drawn cell to its slot, and update() diffs the new cells
+    against it: dead cells have their slot collapsed to a point and freed,
+    new cells are written into free slots, and surviving cells only have their
+    colour rewritten when their state class changes. The buffer is rebuilt
+    from scratch only when it runs out of slots, becomes mostly empty or the
+    cube size changes.
+    Attributes:
+        cube_size (float): The size of each cube, as used by create_cubes.
+        node (GeomNode): The node holding the cell geometry.
+        nodepath (NodePath): The node path of node under the parent.
+        capacity (int): The number of cube slots in the vertex buffer.
+        keys (ndarray): The sorted packed keys of the drawn cells.
+        slots (ndarray): The slot of each cell in keys.
+        classes (ndarray): The colour class of each cell in keys.
+        free (ndarray): The unused slots.
+    Methods:
+        update(coords, states): Applies the births, deaths and colour changes since the last update.
+        rebuild(coords, states): Rebuilds the whole vertex buffer.
+        clear(): Removes all of the geometry.
+        removeNode(): Removes the node from the scene graph.
+    """
+
+    def __init__(self, parent, cube_size=0.5, name="cells"):
+        self.cube_size = cube_size
+        self.node = GeomNode(name)
+        self.nodepath = parent.attachNewNode(self.node)
+        self.clear()
+
+    def update(self, coords, states):
+        # Apply the births, deaths and colour changes since the last update
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        keys = pack_array(coords)
+        order = np.argsort(keys)
+        keys, coords, classes = keys[order], coords[order], state_classes(states)[order]
+
+        # Match the cells against the cells already drawn
+        if len(self.keys):
+            index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[index] == keys
+        else:
+            index = np.zeros(len(keys), dtype=np.intp)
+            found = np.zeros(len(keys), dtype=bool)
+        kept = np.zeros(len(self.keys), dtype=bool)
+        kept[index[found]] = True
+        dead_slots = self.slots[~kept]
+        born = ~found
+        free = np.concatenate([self.free, dead_slots])
+        if (self.capacity == 0 or self.built_size != self.cube_size or np.count_nonzero(born) > len(free)
+                or (self.capacity > MIN_CAPACITY and len(keys) * 4 < self.capacity)):
+            self.rebuild(coords, classes=classes, sorted_keys=keys)
+            return
+
+        rows = self._rows()
+        # Collapse the cubes of cells that died so their triangles have no area
+        rows["vertex"][dead_slots] = 0
+        # Write the cubes of cells that were born into free slots
+        born_slots = free[:np.count_nonzero(born)]
+        rows[born_slots] = cube_vertices(coords[born], CLASS_COLORS[classes[born]],
+                                         self.cube_size).reshape(-1, CUBE_ROWS)
+        # Recolour the surviving cells whose state class changed
+        kept_slots = self.slots[index[found]]
+        changed = self.classes[index[found]] != classes[found]
+        rows["color"][kept_slots[changed]] = CLASS_COLORS[classes[found][changed]][:, None, :]
+
+        slots = np.empty(len(keys), dtype=np.int64)
+        slots[found] = kept_slots
+        slots[born] = born_slots
+        self.keys, self.slots, self.classes = keys, slots, classes
+        self.free = free[len(born_slots):]
+
+    def rebuild(self, coords, states=None, classes=None, sorted_keys=None):
+        # Rebuild the whole vertex buffer with room for twice the live cells
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        if sorted_keys is None:
+            keys = pack_array(coords)
+            order = np.argsort(keys)
+            sorted_keys, coords = keys[order], coords[order]
+            classes = state_classes(states)[order]
+        self.node.removeAllGeoms()
+        count = len(sorted_keys)
+        capacity = max(MIN_CAPACITY, 2 * count)
+        vertices = np.zeros((capacity, CUBE_ROWS), dtype=VERTEX_DTYPE)
+        vertices[:count] = cube_vertices(coords, CLASS_COLORS[classes], self.cube_size).reshape(-1, CUBE_ROWS)
+        self.node.addGeom(cube_geom(vertices.reshape(-1)))
+        self.capacity = capacity
+        self.built_size = self.cube_size
+        self.keys = sorted_keys
+        self.slots = np.arange(count, dtype=np.int64)
+        self.classes = classes
+        self.free = np.arange(count, capacity, dtype=np.int64)
+
+    def _rows(self):
+        # Return a writable (capacity, CUBE_ROWS) view of the vertex buffer
+        vdata = self.node.modifyGeom(0).modifyVertexData()
+        rows = np.asarray(memoryview(vdata.modifyArray(0))).view(VERTEX_DTYPE)
+        return rows.reshape(self.capacity, CUBE_ROWS)
+
+    def clear(self):
+        # Remove all of the geometry
+        self.node.removeAllGeoms()
+        self.capacity = 0
+        self.built_size = self.cube_size
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.slots = np.zeros(0, dtype=np.int64)
+        self.classes = np.zeros(0, dtype=np.uint8)
+        self.free = np.zeros(0, dtype=np.int64)
+
+    def removeNode(self):
+        # Remove the node from the scene graph
+        self.nodepath.removeNode()
+
+
+class SurfaceMesh:
+    """
+    A single GeomNode holding the merged surface faces of the live cells, a Geom per region of chunks.
+    The cells are drawn as solid voxels filling the grid, so a face between
+    two live cells is never seen and is left out, and the faces left in each
+    plane are merged into rectangles of one colour. update() diffs the new
+    cells against the drawn ones and finds the faces again only for the chunks
+    of 16 cells a side holding a cell that was born, died or changed colour,
+    or next to one across a chunk face, all in one batched pass. The faces of
+    every chunk are kept, and the chunks of a region of 4 chunks a side are
+    drawn as one Geom, rebuilt from the kept faces when one of its chunks
+    changes, so a sparse pattern does not cost a draw call per chunk. A blob
+    like cube.lif then costs the faces of its surface, and a still region of
+    a busy grid costs nothing to update.
+    Attributes:
+        cube_size (float): Half the spacing of the cells, as used by create_cubes.
+        node (GeomNode): The node holding the faces.
+        nodepath (NodePath): The node path of node under the parent.
+        keys (ndarray): The sorted packed keys of the drawn cells.
+        labels (ndarray): 1 plus the colour class of each cell in keys.
+        faces (dict): The vertex rows of the faces of every chunk with any, by packed chunk coordinates.
+        regions (dict): The index of the Geom of every drawn region in node, by packed region coordinates.
+        quad_count (int): The number of merged faces drawn.
+    Methods:
+        update(coords, states): Rebuilds the chunks changed since the last update.
+        rebuild(coords, states): Rebuilds every chunk.
+        clear(): Removes all of the geometry.
+        removeNode(): Removes the node from the scene graph.
+    """
+
+    def __init__(self, parent, cube_size=0.5, name="surface"):
+        self.cube_size = cube_size
+        self.node = GeomNode(name)
+        self.nodepath = parent.attachNewNode(self.node)
+        self.clear()
+
+    def update(self, coords, states, rebuild=False):
+        # Rebuild the chunks changed since the last update, or every chunk if rebuild is set
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        keys = pack_array(coords)
+        order = np.argsort(keys)
+        keys, coords = keys[order], coords[order]
+        labels = (state_classes(states)[order] + 1).astype(np.int8)
+        if rebuild or self.built_size != self.cube_size:
+            self.clear()
+            dirty = np.unique(pack_array(coords >> CHUNK_BITS))
+        else:
+            # The cells born, died or recoloured, and the chunks holding them or a face neighbour
+            old = _member(self.keys, keys)
+            new = _member(keys, self.keys)
+            recoloured = keys[new][self.labels[old] != labels[new]]
+            changed = unpack_array(np.concatenate([self.keys[~old], keys[~new], recoloured]))
+            dirty = _touched_chunks(changed)
+        self.keys, self.labels = keys, labels
+        if len(dirty):
+            self._build(dirty, coords, labels)
+
+    def _build(self, dirty, coords, labels):
+        # Find the faces of the dirty chunks, given as sorted packed chunk coordinates, and
+        # rebuild the Geoms of their regions
+        # The faces of the cells in the dirty chunks are found for every chunk at once, one
+        # direction at a time, in chunk order
+        inside = np.isin(pack_array(coords >> CHUNK_BITS), dirty)
+        cells, cell_labels = coords[inside], labels[inside]
+        chunks = unpack_array(dirty)
+        origins = chunks << CHUNK_BITS
+        directions = []
+        for axis in range(3):
+            for side in (1, -1):
+                quads = surface_quads(cells, cell_labels, self.keys, dirty, axis, side)
+                vertices = quad_vertices(quads, origins, axis, side, self.cube_size).reshape(-1, QUAD_ROWS)
+                directions.append((vertices, np.searchsorted(quads[:, 0], np.arange(len(dirty) + 1)).tolist()))
+        regions = pack_array(chunks >> REGION_BITS).tolist()
+        for i, (key, region) in enumerate(zip(dirty.tolist(), regions)):
+            vertices = np.concatenate([vertices[bounds[i]:bounds[i + 1]] for vertices, bounds in directions])
+            if len(vertices):
+                self.faces[key] = vertices.reshape(-1)
+                self._region_chunks.setdefault(region, set()).add(key)
+            elif key in self.faces:
+                del self.faces[key]
+                self._region_chunks[region].discard(key)
+        for region in set(regions):
+            members = self._region_chunks.get(region)
+            self._set_region(region, np.concatenate([self.faces[key] for key in sorted(members)])
+                             if members else np.zeros(0, dtype=VERTEX_DTYPE))
+            if not members:
+                self._region_chunks.pop(region, None)
+
+    def _set_region(self, key, vertices):
+        # Replace the Geom of a region, removing it when the region has no faces
+        # A removed Geom is swapped with the last one, so the Geoms stay packed
+        index = self.regions.get(key)
+        quads = len(vertices) // QUAD_ROWS
+        self.quad_count += quads - self._quads.pop(key, 0)
+        if quads:
+            geom = cube_geom(vertices, QUAD_ROWS, QUAD_INDICES)
+            self._quads[key] = quads
+            if index is None:
+                self.regions[key] = self.node.getNumGeoms()
+                self._order.append(key)
+                self.node.addGeom(geom)
+            else:
+                self.node.setGeom(index, geom)
+        elif index is not None:
+            last = self.node.getNumGeoms() - 1
+            moved = self._order[last]
+            self.node.setGeom(index, self.node.modifyGeom(last))
+            self.node.removeGeom(last)
+            self._order[index] = moved
+            self.regions[moved] = index
+            self._order.pop()
+            del self.regions[key]
+
+    def rebuild(self, coords, states):
+        # Rebuild every chunk
+        self.update(coords, states, rebuild=True)
+
+    def clear(self):
+        # Remove all of the geometry
+        self.node.removeAllGeoms()
+        self.built_size = self.cube_size
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.labels = np.zeros(0, dtype=np.int8)
+        self.faces = {}
+        self.regions = {}
+        # The chunks with faces in every region, the region of every Geom of the node, in order,
+        # and the number of faces of every region
+        self._region_chunks = {}
+        self._order = []
+        self._quads = {}
+        self.quad_count = 0
+
+    def removeNode(self):
+        # Remove the node from the scene graph
+        self.nodepath.removeNode()
+
+
+class LodMesh:
+    """
+    Cubes or surfaces for the cells near the camera and density voxels for the cells further away.
+    Space is split into blocks of 8 cells a side, and each block is drawn at
+    the level of detail its distance from the camera calls for: the cells
+    themselves within the first of the distances, beyond each further distance a
+    voxel per block of 2, 4 and then 8 cells a side. A voxel has the mean
+    colour of its cells and is more opaque the more of its cells are alive.
+    The near cells are drawn by a SurfaceMesh, or a CellMesh when mesh is
+    "cubes", so only their changes are written each generation, and the
+    voxels are rebuilt in one pass. Far cells too
+    sparse to share a voxel would give a voxel each, so while there are more
+    than budget voxels every far block is merged one level coarser, which
+    keeps the voxels drawn bounded whatever the population. Moving
+    the camera only redraws anything when a block changes level. Until a
+    camera position is set every cell is drawn near.
+    Attributes:
+        cube_size (float): The size of each cube, as used by create_cubes.
+        distances (tuple): The camera distances in cells beyond which blocks of 2, 4 and 8 cells a side are merged.
+        budget (int): The most voxels drawn before the far blocks are merged coarser.
+        mesh (str): How the cells near the camera are drawn, one of MESHES.
+        cells (SurfaceMesh): The mesh of the cells near the camera, a CellMesh when mesh is "cubes".
+        voxels (GeomNode): The node holding the voxels.
+        camera (ndarray): The camera position in cells, or None to draw every cell near.
+        population (int): The number of cells drawn, near or in voxels.
+        voxel_count (int): The number of voxels drawn.
+        triangle_count (int): The number of triangles drawn.
+    Methods:
+        set_camera(position): Moves the camera, redrawing the blocks that changed level.
+        set_mesh(mesh): Changes how the cells near the camera are drawn.
+        update(coords, states): Draws a new generation, writing only the changes of the near cells.
+        rebuild(coords, states): Redraws a new generation from scratch.
+        clear(): Removes all of the geometry.
+        removeNode(): Removes the nodes from the scene graph.
+    """
+
+    def __init__(self, parent, cube_size=0.5, distances=LOD_DISTANCES, budget=VOXEL_BUDGET, mesh="surface"):
+        self.cube_size = cube_size
+        self.distances = distances
+        self.budget = budget
+        self._meshes = {"surface": SurfaceMesh(parent, cube_size), "cubes": CellMesh(parent, cube_size)}
+        self.mesh = mesh
+        self.cells = self._meshes[mesh]
+        self.voxels = GeomNode("voxels")
+        self.voxel_path = parent.attachNewNode(self.voxels)
+        # The voxels are see through and sorted back to front, and do not hide the cubes behind them
+        self.voxel_path.setTransparency(TransparencyAttrib.MAlpha)
+        self.voxel_path.setDepthWrite(False)
+        self.camera = None
+        self.clear()
+
+    def set_camera(self, position):
+        # Move the camera to a position in the parent's coordinates, redrawing if a block changed level
+        self.camera = np.array(position, dtype=np.float64) / (self.cube_size * 2)
+        if len(self.coords) and not np.array_equal(self._levels(self.coords)[0], self.levels):
+            self.update(self.coords, self.states)
+
+    def set_mesh(self, mesh):
+        # Change how the cells near the camera are drawn, "surface" or "cubes"
+        if mesh not in self._meshes:
+            raise ValueError(f"Unknown mesh {mesh!r}, expected one of {', '.join(MESHES)}")
+        if mesh == self.mesh:
+            return
+        self.cells.clear()
+        self.mesh = mesh
+        self.cells = self._meshes[mesh]
+        self.rebuild(self.coords, self.states)
+
+    @property
+    def triangle_count(self):
+        # The number of triangles drawn, 2 per surface face and 12 per cube or voxel
+        if self.mesh == "surface":
+            near = 2 * self.cells.quad_count
+        else:
+            near = 12 * len(self.cells.keys)
+        return near + 12 * self.voxel_count
+
+    def _levels(self, coords):
+        # Return the level of detail of every cell, 0 for near, and the level of every block of 8
+        if self.camera is None or len(coords) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(len(coords), dtype=np.intp)
+        blocks, inverse = np.unique(pack_array(coords >> LOD_LEVELS), return_inverse=True)
+        centres = (unpack_array(blocks) << LOD_LEVELS) + (1 << LOD_LEVELS) / 2
+        distances = np.sqrt(((centres - self.camera) ** 2).sum(axis=1))
+        levels = np.searchsorted(np.asarray(self.distances), distances, side='right')
+        return levels, levels[inverse.reshape(-1)]
+
+    def _voxels(self, coords, colors, level):
+        # Return the blocks of 2**level cells a side holding the cells, and the colour of each:
+        # the mean colour of its cells, more opaque the fuller it is
+        if len(coords) == 0:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros((0, 4), dtype=np.uint8)
+        blocks, inverse, counts = np.unique(pack_array(coords >> level), return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        voxel_colors = np.empty((len(blocks), 4), dtype=np.uint8)
+        for channel in range(3):
+            voxel_colors[:, channel] = np.bincount(inverse, colors[:, channel], len(blocks)) / counts
+        # By the square root of the fill, so sparse blocks still show
+        fill = np.sqrt((counts - 1) / ((1 << (3 * level)) - 1))
+        voxel_colors[:, 3] = VOXEL_ALPHA[0] + (VOXEL_ALPHA[1] - VOXEL_ALPHA[0]) * fill
+        return unpack_array(blocks), voxel_colors
+
+    def update(self, coords, states, rebuild=False):
+        # Draw a new generation, writing only the changes of the near cells unless rebuild is set
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        states = np.asarray(states).reshape(-1)
+        self.coords, self.states = coords, states
+        self.levels, levels = self._levels(coords)
+        near = levels == 0
+        self.cells.cube_size = self.cube_size
+        if rebuild:
+            self.cells.rebuild(coords[near], states[near])
+        else:
+            self.cells.update(coords[near], states[near])
+
+        # Merge the far cells into a voxel per block, coarser while there are too many voxels
+        far = ~near
+        colors = CLASS_COLORS[state_classes(states[far])]
+        far_coords, levels = coords[far], levels[far]
+        while True:
+            voxels = [self._voxels(far_coords[levels == level], colors[levels == level], level)
+                      for level in range(1, MAX_LEVEL + 1)]
+            if sum(len(i[0]) for i in voxels) <= self.budget or levels.min(initial=MAX_LEVEL) >= MAX_LEVEL:
+                break
+            levels = np.minimum(levels + 1, MAX_LEVEL)
+        self.voxels.removeAllGeoms()
+        vertices = [voxel_vertices(blocks, level, voxel_colors, self.cube_size)
+                    for level, (blocks, voxel_colors) in enumerate(voxels, 1) if len(blocks)]
+        if vertices:
+            self.voxels.addGeom(cube_geom(np.concatenate(vertices)))
+        self.voxel_count = sum(len(i) for i in vertices) // CUBE_ROWS
+        self.population = len(states)
+
+    def rebuild(self, coords, states):
+        # Redraw a new generation from scratch
+        self.update(coords, states, rebuild=True)
+
+    def clear(self):
+        # Remove all of the geometry
+        self.cells.clear()
+        self.voxels.removeAllGeoms()
+        self.coords = np.zeros((0, 3), dtype=np.int64)
+        self.states = np.zeros(0, dtype=np.int32)
+        self.levels = np.zeros(0, dtype=np.intp)
+        self.population = 0
+        self.voxel_count = 0
+
+    def removeNode(self):
+        # Remove the nodes from the scene graph
+        for mesh in self._meshes.values():
+            mesh.removeNode()
+        self.voxel_path.removeNode()
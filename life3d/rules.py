@@ -0,0 +1,172 @@
+"""
+
+This module compiles the rules of the 3D Game of Life into lookup tables.
+A cell has at most 26 alive neighbours, so every rule is a table of 27
+entries for each of the dead and alive states, plus the counts at which a
+live cell is marked as dying next cycle. The table is compiled once when the
+rule changes and every engine indexes it with its neighbour counts, so no
+engine compares counts against the rates while stepping.
+Rules are given either as the birth, death and alive rates of the gui or as
+a B/S rulestring such as "B5/S45". In a rulestring each digit is a count,
+unless the counts are separated by commas, which allows counts above 9 and
+ranges such as "B5,6/S4-8,12".
+Classes:
+    Rule: Birth, survival and dying counts compiled into lookup tables.
+    RuleSettings: Base class giving an engine a rule and the rates that compile it.
+
+
+"""
+import numpy as np
+
+# The number of possible neighbour counts, 0 to 26
+COUNTS = 27
+
+
+def _parse_counts(text, rulestring):
+    # Parse the counts of one half of a rulestring
+    counts = set()
+    if "," in text or "-" in text:
+        parts = [part for part in text.split(",") if part]
+    else:
+        parts = list(text)
+    for part in parts:
+        low, _, high = part.partition("-")
+        try:
+            low, high = int(low), int(high or low)
+        except ValueError:
+            raise ValueError(f"Bad rule {rulestring!r}: {part!r} is not a count") from None
+        if not 0 <= low <= high < COUNTS:
+            raise ValueError(f"Bad rule {rulestring!r}: counts must be between 0 and {COUNTS - 1}")
+        counts.update(range(low, high + 1))
+    return counts
+
+
+class Rule:
+    """
+    Birth, survival and dying counts compiled into lookup tables.
+    A dead cell is born with a count in birth, a live cell survives with a
+    count in survive, and a live cell with a count in dying is marked -1, dead
+    next cycle. Rules are compared by their counts.
+    Attributes:
+        birth (frozenset): The neighbour counts at which a dead cell is born.
+        survive (frozenset): The neighbour counts at which a live cell stays alive.
+        dying (frozenset): The neighbour counts at which a live cell is marked as dying.
+        table (ndarray): Boolean (2, 27) table of the next alive state indexed [alive, count].
+        marks (ndarray): Boolean table of the dying mark indexed by count.
+    Methods:
+        from_rates(birthrate, deathrate, aliverate): Compiles the rates of the gui.
+        parse(text): Compiles a B/S rulestring.
+    """
+
+    def __init__(self, birth, survive, dying=None):
+        self.birth = frozenset(int(n) for n in birth)
+        self.survive = frozenset(int(n) for n in survive)
+        if dying is None:
+            # Overcrowded cells are marked, the counts above every survival count
+            dying = range(max(self.survive, default=-1) + 1, COUNTS)
+        self.dying = frozenset(int(n) for n in dying)
+        if 0 in self.birth:
+            raise ValueError("Rules with birth on 0 neighbours are not supported, every empty cell would be born")
+        if not all(0 <= n < COUNTS for n in self.birth | self.survive | self.dying):
+            raise ValueError(f"Neighbour counts must be between 0 and {COUNTS - 1}")
+        self.table = np.zeros((2, COUNTS), dtype=bool)
+        self.table[0, sorted(self.birth)] = True
+        self.table[1, sorted(self.survive)] = True
+        self.marks = np.zeros(COUNTS, dtype=bool)
+        self.marks[sorted(self.dying)] = True
+
+    @classmethod
+    def from_rates(cls, birthrate, deathrate, aliverate):
+        # Compile the rates of the gui
+        # Cells survive from aliverate up to deathrate and are born from birthrate up
+        # to deathrate, but only next to a live cell. From deathrate up they are dying
+        deathrate = min(deathrate, COUNTS)
+        return cls(range(max(birthrate, 1), deathrate), range(max(aliverate, 0), deathrate),
+                   range(max(deathrate, 0), COUNTS))
+
+    @classmethod
+    def parse(cls, text):
+        # Compile a B/S rulestring such as "B5/S45", the halves in either order
+        halves = {}
+        for half in text.strip().upper().split("/"):
+            if not half or half[0] not in "BS" or half[0] in halves:
+                raise ValueError(f"Bad rule {text!r}: expected a rulestring like B5/S45")
+            halves[half[0]] = _parse_counts(half[1:], text)
+        if set(halves) != {"B", "S"}:
+            raise ValueError(f"Bad rule {text!r}: expected a rulestring like B5/S45")
+        if 0 in halves["B"]:
+            raise ValueError(f"Bad rule {text!r}: B0 would give birth to every empty cell")
+        return cls(halves["B"], halves["S"])
+
+    def __str__(self):
+        # The rulestring, with commas when a count needs two digits
+        def counts(values):
+            values = sorted(values)
+            if values and values[-1] > 9:
+                return ",".join(str(n) for n in values)
+            return "".join(str(n) for n in values)
+        return f"B{counts(self.birth)}/S{counts(self.survive)}"
+
+    def __repr__(self):
+        return f"Rule({sorted(self.birth)}, {sorted(self.survive)}, {sorted(self.dying)})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return (self.birth, self.survive, self.dying) == (other.birth, other.survive, other.dying)
+
+    def __hash__(self):
+        return hash((self.birth, self.survive, self.dying))
+
+
+class RuleSettings:
+    """
+    Base class giving an engine a rule and the rates that compile it.
+    Setting birthrate, deathrate or aliverate compiles a new rule from the
+    three rates. A rule can also be set directly, for example from a
+    rulestring; the rates then keep their old values until one is set again.
+    set_rule sets the rates and a rule already compiled together, without
+    compiling anything.
+    Attributes:
+        rule (Rule): The compiled rule the engine steps with.
+        birthrate (int): The minimum number of neighbours for a cell to be born.
+        deathrate (int): The number of neighbours at which a cell dies.
+        aliverate (int): The minimum number of neighbours for a cell to stay alive.
+    Methods:
+        set_rule(rule, birthrate, deathrate, aliverate): Sets the rule and the rates without compiling the rates.
+    """
+
+    def set_rule(self, rule, birthrate, deathrate, aliverate):
+        # Set a compiled rule and the rates shown with it, such as a rulestring chosen in the gui
+        self._birthrate = birthrate
+        self._deathrate = deathrate
+        self._aliverate = aliverate
+        self.rule = rule
+
+    def _set_rates(self, birthrate, deathrate, aliverate):
+        # Set all three rates and compile them into the rule once
+        self.set_rule(Rule.from_rates(birthrate, deathrate, aliverate), birthrate, deathrate, aliverate)
+
+    @property
+    def birthrate(self):
+        return self._birthrate
+
+    @birthrate.setter
+    def birthrate(self, value):
+        self._set_rates(value, self._deathrate, self._aliverate)
+
+    @property
+    def deathrate(self):
+        return self._deathrate
+
+    @deathrate.setter
+    def deathrate(self, value):
+        self._set_rates(self._birthrate, value, self._aliverate)
+
+    @property
+    def aliverate(self):
+        return self._aliverate
+
+    @aliverate.setter
+    def aliverate(self, value):
+        self._set_rates(self._birthrate, self._deathrate, value)
@@ -0,0 +1,84 @@
+"""
+
+This module decides how many generations to step each frame from wall clock
+time, so the simulation speed no longer depends on the frame rate.
+Classes:
+    StepScheduler: Fixed-step scheduler with catch up, frame skipping and a max speed mode.
+
+
+"""
+import time
+
+
+class StepScheduler:
+    """
+    Fixed-step scheduler driven by wall clock time.
+    Time since the last frame is turned into owed generations at
+    generations_per_second. When a frame falls behind the scheduler catches up
+    with several steps, but never more than max_catchup or the frame budget
+    allows; the rest of the backlog is dropped so a slow grid cannot stall
+    the render loop. In max speed mode it steps for as long as the frame
+    budget allows instead.
+    Attributes:
+        generations_per_second (float): The target simulation rate.
+        max_speed (bool): Whether to run as many generations as fit in the frame budget.
+        frame_budget (float): The number of seconds per frame that stepping may use.
+        max_catchup (int): The most generations stepped in one frame when behind.
+        owed (float): The generations owed but not yet stepped.
+        last_time (float): The wall clock time of the last call to run, or None.
+        skipped (int): The number of owed generations dropped under load.
+    Methods:
+        reset(now=None): Forgets the owed generations, for example after a pause.
+        steps_due(now): Returns how many generations are owed at time now.
+        run(step, now=None, clock=time.perf_counter): Steps the owed generations and returns how many ran.
+    """
+
+    def __init__(self, generations_per_second=6.0, max_speed=False, frame_budget=1 / 30, max_catchup=5):
+        self.generations_per_second = generations_per_second
+        self.max_speed = max_speed
+        self.frame_budget = frame_budget
+        self.max_catchup = max_catchup
+        self.owed = 0.0
+        self.last_time = None
+        self.skipped = 0
+
+    def reset(self, now=None):
+        # Forget the owed generations so a pause is not followed by a burst of steps
+        self.owed = 0.0
+        self.last_time = now
+
+    def steps_due(self, now):
+        # Add the generations owed since the last call and return the whole number due
+        if self.last_time is not None:
+            self.owed += max(0.0, now - self.last_time) * self.generations_per_second
+        self.last_time = now
+        return int(self.owed)
+
+    def run(self, step, now=None, clock=time.perf_counter):
+        # Call step for the generations due at time now and return how many ran
+        # clock is read between steps to stay inside the frame budget
+        if now is None:
+            now = clock()
+        start = clock()
+        if self.max_speed:
+            self.last_time = now
+            self.owed = 0.0
+            count = 0
+            while True:
+                step()
+                count += 1
+                if clock() - start >= self.frame_budget:
+                    return count
+        due = self.steps_due(now)
+        count = 0
+        while count < min(due, self.max_catchup):
+            step()
+            count += 1
+            if clock() - start >= self.frame_budget:
+                break
+        self.owed -= count
+        if count < due:
+            # Drop the rest of the backlog rather than falling further behind
+            self.skipped += int(self.owed)
+            self.owed -= int(self.owed)
+        return count
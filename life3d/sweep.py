@@ -0,0 +1,150 @@
+"""
+
+This module runs a seed pattern under many birth, death and alive rates on a
+pool of processes and tabulates how each rule behaves.
+Every combination of the rates asked for is run for a number of generations
+from the same seed, a pattern file or a random population placed like the
+Reset button does. Many combinations compile to the same rule, for example
+every birth rate at or above the death rate gives no births, so each distinct
+rule is run once and its result is reported for every combination that
+compiles to it. A run stops early when the pattern dies out or repeats a
+generation it has already reached, since nothing new can happen after that,
+which the engine's generation hash finds for the cost of each step's changes.
+Results are written to a CSV file as they arrive, so a long sweep can be
+stopped and still leave every finished row behind.
+Classes:
+    SweepResult: The outcome of running one rule from the seed.
+Functions:
+    parse_range(text): Parses rates such as "0-24" or "3,5,7".
+    random_seed(grid_size, count, seed): Places count random cells like the Reset button.
+    run_rule(task): Runs one rule from the seed in a worker process.
+    sweep(cells, grid_size, generations, births, deaths, alives, ...): Runs every combination of the rates.
+    write_results(file_path, results): Writes sweep results to a CSV file.
+
+
+"""
+import csv
+import os
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .cycles import EXTINCT, CycleDetector
+from .rules import Rule
+
+# The columns of the results table, in order
+COLUMNS = ["birthrate", "deathrate", "aliverate", "rule", "generations", "final_population", "max_population",
+           "extinct_generation", "period", "period_start", "box_start", "box_end", "box_growth", "seconds"]
+
+# The outcome of running one rule. extinct_generation, period and period_start are None when
+# the pattern did not die out or repeat. box_growth is the volume of the final bounding box over
+# the volume of the first
+SweepResult = namedtuple("SweepResult", COLUMNS)
+
+
+def parse_range(text):
+    # Parse rates given as single values, ranges or both, such as "0-24" or "3,5,7-9"
+    values = []
+    for part in str(text).split(","):
+        low, _, high = part.strip().partition("-")
+        values.extend(range(int(low), int(high or low) + 1))
+    return sorted(set(values))
+
+
+def random_seed(grid_size, count, seed=None):
+    # Place count random cells in the grid, like the Reset button, from a repeatable seed
+    rng = random.Random(seed)
+    return np.array([(rng.randrange(grid_size), rng.randrange(grid_size), rng.randrange(grid_size))
+                     for i in range(count)], dtype=np.int64).reshape(-1, 3)
+
+
+def _box(coords):
+    # The bounding box of an (N, 3) array of cells as (low, high), high exclusive, or None if empty
+    if len(coords) == 0:
+        return None
+    return tuple(coords.min(axis=0).tolist()), tuple((coords.max(axis=0) + 1).tolist())
+
+
+def _volume(box):
+    # The number of cells in a bounding box
+    if box is None:
+        return 0
+    low, high = box
+    return int(np.prod([hi - lo for lo, hi in zip(low, high)]))
+
+
+def run_rule(task):
+    # Run one rule from the seed in a worker process and return its row without the rates
+    # The run stops when the pattern dies out or reaches a generation it has been in before
+    from . import ENGINES
+    engine_name, grid_size, cells, rule, generations = task
+    start = time.perf_counter()
+    engine = ENGINES[engine_name](grid_size)
+    engine.rule = rule
+    engine.load_cells(cells)
+    coords, _ = engine.cell_arrays()
+    box_start = _box(coords)
+    max_population = len(coords)
+    detector = CycleDetector(history=generations + 1)
+    extinct = period = period_start = None
+    while True:
+        population = engine.population
+        max_population = max(max_population, population)
+        cycle = detector.update(engine.generation, engine.hash, population)
+        if cycle is not None:
+            if cycle.kind == EXTINCT:
+                extinct = cycle.start
+            else:
+                period, period_start = cycle.period, cycle.start
+            break
+        if engine.generation == generations:
+            break
+        engine.step()
+    coords, _ = engine.cell_arrays()
+    box_end = _box(coords)
+    growth = _volume(box_end) / _volume(box_start) if box_start is not None else None
+    close = getattr(engine, "close", None)
+    if close is not None:
+        close()
+    return (str(rule), engine.generation, len(coords), max_population, extinct, period, period_start,
+            box_start, box_end, growth, time.perf_counter() - start)
+
+
+def sweep(cells, grid_size, generations, births, deaths, alives, engine="dense", workers=None, progress=None):
+    # Run every combination of the rates from the seed cells and yield a SweepResult for each,
+    # rule by rule in the order the rules were first met. progress(done, total) is called after every rule
+    rules = {}
+    for birthrate in births:
+        for deathrate in deaths:
+            for aliverate in alives:
+                rule = Rule.from_rates(birthrate, deathrate, aliverate)
+                rules.setdefault(rule, []).append((birthrate, deathrate, aliverate))
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+    tasks = [(engine, grid_size, cells, rule, generations) for rule in rules]
+    workers = workers or os.cpu_count() or 1
+    done = 0
+    with ProcessPoolExecutor(workers) as pool:
+        chunksize = max(1, len(tasks) // (workers * 16))
+        for rates, row in zip(rules.values(), pool.map(run_rule, tasks, chunksize=chunksize)):
+            done += 1
+            if progress is not None:
+                progress(done, len(tasks))
+            for birthrate, deathrate, aliverate in rates:
+                yield SweepResult(birthrate, deathrate, aliverate, *row)
+
+
+def write_results(file_path, results):
+    # Write sweep results to a CSV file as they arrive and return how many were written
+    count = 0
+    with open(file_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for result in results:
+            writer.writerow(["" if value is None else round(value, 4) if isinstance(value, float) else value
+                             for value in result])
+            file.flush()
+            count += 1
+    return count
@@ -0,0 +1,326 @@
+"""
+
+This module runs an engine on a background thread so stepping a large grid
+never blocks the render loop.
+The worker owns the engine. Everything else talks to it with messages and
+reads the newest finished generation from a snapshot that is swapped in
+whole after every change, so the reader never waits and never sees a half
+stepped grid. While a recorder is attached every generation stepped is also
+streamed to it. The worker hashes every generation to find when the
+pattern dies out, settles or repeats, and can then pause itself or fast
+forward through the cycle by showing the generations of one period again
+instead of computing them. NumPy releases the GIL for the dense engine's array work, so
+the render thread keeps running while a generation is computed. A message or generation that
+raises an error does not end the thread: the worker prints it, pauses, drops the recorder and
+publishes the error with the snapshot, then goes on handling messages.
+Classes:
+    Snapshot: The cells of one finished generation.
+    SimulationWorker: Background thread that steps an engine and publishes snapshots.
+
+
+"""
+import queue
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from .cycles import CycleDetector
+from .profiler import profiler
+from .scheduler import StepScheduler
+
+# The cells of one finished generation. version increases with every published change, cycle
+# is the Cycle the pattern is in, or None, and error describes the last message or generation
+# that failed, or is None
+Snapshot = namedtuple("Snapshot", ["version", "generation", "coords", "states", "cycle", "error"])
+
+# What the worker does when it finds a cycle: keep stepping, pause, or fast forward
+CYCLE_ACTIONS = ("run", "pause", "fast-forward")
+
+# The message that stops the worker thread
+_SHUTDOWN = object()
+
+
+class SimulationWorker(threading.Thread):
+    """
+    Background thread that steps an engine and publishes snapshots.
+    Start, stop, step and clear, edits to the cells and changes to the rules
+    are all messages handled on the worker thread between generations.
+    While running, the worker paces itself with a StepScheduler.
+    Attributes:
+        engine: The engine being stepped. Only touch it from the worker thread.
+        scheduler (StepScheduler): Paces the generations while running.
+        running (bool): Whether the worker is stepping continuously.
+        latest (Snapshot): The newest finished generation.
+        commands (Queue): The pending messages.
+        recorder (Recorder): The recorder every stepped generation is written to, or None.
+        detector (CycleDetector): Finds the cycle of the pattern from the hash of every generation.
+        cycle (Cycle): The cycle the pattern is in, or None while it is still changing.
+        cycle_action (str): What to do on finding a cycle, one of CYCLE_ACTIONS.
+        auto_paused (bool): Whether the worker paused itself on finding a cycle.
+        error (str): The last message or generation that failed, or None since a message succeeded.
+    Methods:
+        resume(): Starts stepping continuously.
+        pause(): Stops stepping continuously.
+        step(): Steps a single generation.
+        clear(): Removes every cell.
+        call(name, *args): Calls a method of the engine on the worker thread.
+        configure(**attributes): Sets attributes of the engine on the worker thread.
+        replace_engine(make): Replaces the engine with make(engine) on the worker thread.
+        start_recording(make): Records every generation to the recorder make(engine) returns.
+        stop_recording(): Closes the recorder.
+        set_cycle_action(action): Sets what to do on finding a cycle.
+        shutdown(): Stops the worker thread.
+    """
+
+    def __init__(self, engine, scheduler=None):
+        threading.Thread.__init__(self, name="life3d-worker", daemon=True)
+        self.engine = engine
+        self.scheduler = scheduler if scheduler is not None else StepScheduler()
+        self.running = False
+        self.recorder = None
+        self.detector = CycleDetector()
+        self.cycle = None
+        self.cycle_action = "run"
+        self.auto_paused = False
+        self.error = None
+        # While fast forwarding, the cells of each generation of one period from _loop_start,
+        # and the generation shown
+        self._frames = None
+        self._loop_start = self._loop_generation = 0
+        self.commands = queue.Queue()
+        self._version = 0
+        self.latest = None
+        self._observe()
+        self.publish()
+
+    def resume(self):
+        # Start stepping continuously
+        self.auto_paused = False
+        self.commands.put((self._set_running, (True,)))
+
+    def pause(self):
+        # Stop stepping continuously
+        self.commands.put((self._set_running, (False,)))
+
+    def step(self):
+        # Step a single generation
+        self.commands.put((self._step, ()))
+
+    def clear(self):
+        # Remove every cell
+        self.call("clear")
+
+    def call(self, name, *args):
+        # Call a method of the engine on the worker thread
+        self.commands.put((self._call, (name, args)))
+
+    def configure(self, **attributes):
+        # Set attributes of the engine, such as the rules or the grid size, on the worker thread
+        # A compiled rule given as rule is set with the rates given alongside it in one message
+        self.commands.put((self._configure, (attributes,)))
+
+    def replace_engine(self, make):
+        # Replace the engine with make(engine) on the worker thread
+        self.commands.put((self._replace_engine, (make,)))
+
+    def start_recording(self, make):
+        # Record every generation from now on to the recorder make(engine) returns on the worker thread
+        self.commands.put((self._start_recording, (make,)))
+
+    def stop_recording(self):
+        # Close the recorder, writing its index
+        self.commands.put((self._stop_recording, ()))
+
+    def set_cycle_action(self, action):
+        # Set what to do on finding a cycle, one of CYCLE_ACTIONS
+        if action not in CYCLE_ACTIONS:
+            raise ValueError(f"Unknown cycle action {action!r}, expected one of {', '.join(CYCLE_ACTIONS)}")
+        self.commands.put((self._set_cycle_action, (action,)))
+
+    def shutdown(self):
+        # Stop the worker thread after the pending messages
+        self.commands.put(_SHUTDOWN)
+
+    def publish(self):
+        # Swap in a snapshot of the engine's current cells, or of the generation shown while fast forwarding
+        if self._frames is not None:
+            generation = self._loop_generation
+            coords, states = self._frames[(generation - self._loop_start) % self.cycle.period]
+        else:
+            generation = self.engine.generation
+            with profiler.section("snapshot"):
+                coords, states = self.engine.cell_arrays()
+        self._version += 1
+        self.latest = Snapshot(self._version, generation, coords, states, self.cycle, self.error)
+
+    def run(self):
+        # Handle messages and step the engine until shut down
+        while True:
+            try:
+                command = self.commands.get(timeout=self._wait_time())
+            except queue.Empty:
+                command = None
+            while command is not None:
+                if command is _SHUTDOWN:
+                    self._stop_recording()
+                    return
+                handler, args = command
+                try:
+                    self.error = None
+                    handler(*args)
+                except Exception as e:
+                    self._fail(args[0] if handler == self._call else handler.__name__.strip('_').replace('_', ' '), e)
+                try:
+                    command = self.commands.get_nowait()
+                except queue.Empty:
+                    command = None
+            try:
+                if self.running and self.scheduler.run(self._run_step):
+                    self.publish()
+            except Exception as e:
+                self._fail("step", e)
+
+    def _fail(self, what, error):
+        # Print an error raised handling a message or stepping, pause and drop the recorder,
+        # and publish the error so the gui can show it
+        print(f"Simulation worker: {what} failed")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.error = f"{what} failed: {error}"
+        self.running = False
+        self.auto_paused = False
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            try:
+                recorder.close()
+            except Exception:
+                traceback.print_exc()
+        try:
+            self.publish()
+        except Exception:
+            # The cells cannot be read, so the error goes out with the last snapshot's cells
+            traceback.print_exc()
+            self._version += 1
+            self.latest = self.latest._replace(version=self._version, error=self.error)
+
+    def _wait_time(self):
+        # How long to wait for a message before the next generation is due
+        if not self.running:
+            return None
+        if self.scheduler.max_speed:
+            return 0
+        owed = self.scheduler.owed
+        if self.scheduler.last_time is not None:
+            owed += (time.perf_counter() - self.scheduler.last_time) * self.scheduler.generations_per_second
+        return max(0.0, (1.0 - owed) / max(self.scheduler.generations_per_second, 1e-6))
+
+    def _set_running(self, running):
+        self.running = running
+        self.auto_paused = False
+        self.scheduler.reset(time.perf_counter())
+
+    def _run_step(self):
+        # Step while running, the rest of a frame's steps are skipped once the worker pauses itself
+        if self.running:
+            self._step_engine()
+
+    def _step_engine(self):
+        # Step the engine and record the new generation, or show the next generation of the cycle
+        if self._frames is not None:
+            self._loop_step()
+            return
+        with profiler.section("step"):
+            self.engine.step()
+        if profiler.enabled:
+            profiler.counter("generation", self.engine.generation)
+            profiler.counter("cells", self.engine.population)
+        if self.recorder is not None:
+            with profiler.section("record"):
+                self.recorder.record_engine(self.engine)
+        self._observe()
+
+    def _observe(self):
+        # Hash the engine's generation and act on a newly found cycle
+        with profiler.section("cycle detection"):
+            cycle = self.detector.update(self.engine.generation, self.engine.hash, self.engine.population)
+        found = cycle is not None and cycle != self.cycle
+        self.cycle = cycle
+        if not found:
+            return
+        if self.cycle_action == "pause" and self.running:
+            self.running = False
+            self.auto_paused = True
+        elif self.cycle_action == "fast-forward" and self.recorder is None:
+            self._frames = [self.engine.cell_arrays()]
+            self._loop_start = self._loop_generation = self.engine.generation
+
+    def _loop_step(self):
+        # Show the next generation of the cycle. The engine is only stepped until it has
+        # given the cells of every generation of one period
+        if len(self._frames) < self.cycle.period:
+            self.engine.step()
+            self._frames.append(self.engine.cell_arrays())
+        self._loop_generation += 1
+
+    def _settle(self):
+        # Stop fast forwarding, stepping the engine round the cycle to the generation shown
+        # Cells alive through the skipped generations keep the age they had when the cycle was found
+        if self._frames is None:
+            return
+        last = self._loop_start + len(self._frames) - 1
+        for i in range((self._loop_generation - last) % self.cycle.period):
+            self.engine.step()
+        self.engine.generation = self._loop_generation
+        self._frames = None
+
+    def _changed(self):
+        # Look for a cycle afresh after the engine was changed and publish it
+        self.detector.reset()
+        self.cycle = None
+        self._observe()
+        self.publish()
+
+    def _set_cycle_action(self, action):
+        self.cycle_action = action
+        if action != "fast-forward":
+            self._settle()
+            self.publish()
+
+    def _step(self):
+        self._step_engine()
+        self.publish()
+
+    def _call(self, name, args):
+        self._settle()
+        getattr(self.engine, name)(*args)
+        self._changed()
+
+    def _configure(self, attributes):
+        self._settle()
+        attributes = dict(attributes)
+        rule = attributes.pop("rule", None)
+        if rule is not None:
+            # The engine keeps the rates shown with the rule without compiling them again
+            rates = [attributes.pop(name, getattr(self.engine, name))
+                     for name in ("birthrate", "deathrate", "aliverate")]
+            self.engine.set_rule(rule, *rates)
+        for name, value in attributes.items():
+            setattr(self.engine, name, value)
+        self._changed()
+
+    def _replace_engine(self, make):
+        self._settle()
+        self.engine = make(self.engine)
+        self._changed()
+
+    def _start_recording(self, make):
+        # Start a recorder with the current generation as its first keyframe
+        self._settle()
+        self._stop_recording()
+        self.recorder = make(self.engine)
+        self.recorder.record_engine(self.engine)
+
+    def _stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
@@ -0,0 +1,57 @@
+"""
+
+Tests for the simulation worker.
+Classes:
+    SimulationWorkerTest: Checks the worker keeps handling messages after one fails.
+
+
+"""
+import time
+import unittest
+
+from life3d import SparseEngine
+from life3d.worker import SimulationWorker
+
+
+class SimulationWorkerTest(unittest.TestCase):
+    """
+    Checks the worker keeps handling messages after one fails.
+    Methods:
+        wait_for(condition): Waits until condition() is true, failing after a few seconds.
+        test_failing_message(): A message that raises leaves the worker alive and stepping.
+    """
+
+    def setUp(self):
+        # Start a worker on a small grid with one cell
+        engine = SparseEngine(10)
+        engine.set_cell(5, 5, 5, 1)
+        self.worker = SimulationWorker(engine)
+        self.worker.start()
+        self.wait_for(lambda: self.worker.latest is not None)
+
+    def tearDown(self):
+        self.worker.shutdown()
+        self.worker.join(5)
+
+    def wait_for(self, condition):
+        # Poll the condition until it holds or the time runs out
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out waiting for the worker")
+            time.sleep(0.01)
+
+    def test_failing_message(self):
+        # Send a message that raises, then check the error is published and a step still works
+        generation = self.worker.latest.generation
+        self.worker.call("load_cells", "not cells")
+        self.wait_for(lambda: self.worker.latest.error is not None)
+        self.assertIn("load_cells", self.worker.latest.error)
+        self.assertFalse(self.worker.running)
+        self.worker.step()
+        self.wait_for(lambda: self.worker.latest.generation > generation)
+        self.assertTrue(self.worker.is_alive())
+        self.assertIsNone(self.worker.latest.error)
+
+
+if __name__ == "__main__":
+    unittest.main()